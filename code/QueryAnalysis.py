@@ -30,23 +30,19 @@ import dask.array as da
 import gc
 from datetime import datetime
 from scipy.stats import multivariate_normal
+from chainClient import getClient
+from resultCache import streamSnapshot
+from auditLog import getAuditLog
 
 warnings.simplefilter(action='ignore')
 
 
 # In[ ]:
 
-def get_json_payload_from_txid(txid, chainName, datadir):
-    queryCommand = 'multichain-cli {} -datadir={} gettxoutdata {} 0'.format(chainName, datadir, txid)
-    items = subprocess.check_output(queryCommand.split())
-    return items
-
 #Given a chain name subscribe to audit log stream to ensure query is recorded
 def subscribeToStream(chainName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe audit_log'.format(chainName,datadir)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe('audit_log')
     return
 
 def querySamplePCA(chainName, datadir, sampleSearch, kSearch):
@@ -58,8 +54,8 @@ def querySamplePCA(chainName, datadir, sampleSearch, kSearch):
     '''
     #Extract data
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems analysis {} false 9999999'.format(chainName, datadir, "PCA")
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    ##the analysis items are cached until the stream gets new items
+    matches = streamSnapshot(chainName, datadir, 'analysis', 'PCA')
     publishToAuditstream(chainName, datadir, queryCommand)
     #Create DF
     sample_pcs = [(match_['keys'][1], match_['data']['json']) for match_ in matches]
@@ -85,8 +81,7 @@ def querySampleRelatedness(chainName, datadir, sampleSearch):
     '''
     #Extract data
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems analysis {} false 99999999'.format(chainName, datadir, 'Relatedness')
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = streamSnapshot(chainName, datadir, 'analysis', 'Relatedness')
     publishToAuditstream(chainName, datadir, queryCommand)
     #Create DF
     sample_snps = [(match_['keys'][1], match_['data']['json']) for match_ in matches if match_['keys'][1].upper() != 'AF' ]
@@ -98,13 +93,11 @@ def querySampleRelatedness(chainName, datadir, sampleSearch):
         rl_df = rl_df.loc[valid_samples]
     #AF
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems analysis {} false 99999999'.format(chainName, datadir, 'AF')
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    txid = matches[0]['data']['txid']
-    queryCommand = 'multichain-cli {} -datadir={} gettxoutdata {} 0'.format(chainName, datadir, txid)
+    match = getClient(chainName, datadir).latestItem('analysis', 'AF')
+    ##the AF list is stored off-chain, reading the data fetches it with gettxoutdata
+    queryCommand = 'multichain-cli {} -datadir={} gettxoutdata {} 0'.format(chainName, datadir, match['txid'])
     publishToAuditstream(chainName, datadir, queryCommand)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)['json']
+    matches = match['data']['json']
     af = [float(match_) for match_ in matches]
     return rl_df, af
 
@@ -188,8 +181,7 @@ def queryMetadata(chainName, datadir, search_values):
     '''
     #Metadata query
     queryCommand = 'multichain-cli {} -datadir={} liststreamitems mappingData_metadata false 9999999'.format(chainName, datadir)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = streamSnapshot(chainName, datadir, 'mappingData_metadata')
     #Parse the search values specified
     publishToAuditstream(chainName, datadir, queryCommand)
     all_patient_ids = {}
@@ -200,42 +192,17 @@ def queryMetadata(chainName, datadir, search_values):
             filtered_dicts = [d for d in matches if all(key in d['keys'] for key in [search_value])]
             return_value = [[x for x in d["keys"] if x!=search_value][0] for d in filtered_dicts]
             patient_ids = {key:[] for key in return_value}
-            for i, (d, key) in enumerate(zip(filtered_dicts, return_value)):
-                try:
-                    patient_ids[key].extend(d['data']['json'])
-                except:
-                    txid = filtered_dicts[i]['data']['txid']
-                    txid_items = get_json_payload_from_txid(txid, chainName, datadir)
-                    txid_matches = json.loads(txid_items)['json']
-                    patient_ids[key].extend(txid_matches)
+            for d, key in zip(filtered_dicts, return_value):
+                ##off-chain data is already fetched by streamSnapshot, with the vout of each item
+                patient_ids[key].extend(d['data']['json'])
             all_patient_ids[search_value] = patient_ids
     #print(all_patient_ids)
     return all_patient_ids
 
 
 def publishToAuditstream(chainName, datadir, queryCommand):
-    #load wallet
-    walletCommand='multichain-cli {} -datadir={} listaddresses'.format(chainName, datadir)
-    items = subprocess.check_output(walletCommand.split())
-    matches = json.loads(items, parse_int= int)
-    wallets = pd.DataFrame(matches)
-    wallet = wallets['address'][wallets['ismine'] == True][0]
-    
-    #load time and parse query conducted
-    time = str(datetime.utcnow())
-    query = ' '.join(queryCommand.split(' ')[3:])
-    
-    ##publish to auditstream
-    streamKeys = (wallet, time, query)
-    publishCommand = ['multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('audit_log'), 
-            str('["{}", "{}", "{}"]'.format(streamKeys[0], streamKeys[1], streamKeys[2])),
-            '{'+'"json":{}'+'}']
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    ##entries are queued and published in batches by a background thread, everything queued is published at exit
+    getAuditLog(chainName, datadir, '').log(queryCommand)
     return
 
 
@@ -12,6 +12,7 @@ import argparse
 import subprocess
 from subprocess import Popen, PIPE
 import os
+import itertools
 import psutil
 import time
 import ast
@@ -22,9 +23,18 @@ import json
 import warnings
 import multiprocessing
 from datetime import datetime 
+from chainClient import getClient, PAGE_SIZE
+from auditLog import getAuditLog
+from cohortAlgebra import queryCohort, Concept, PersonBitmap
+from conceptHierarchy import expandConcepts
+from resultCache import streamCounts
 warnings.simplefilter(action='ignore', category=FutureWarning)
 import ast
 
+# a domain bucket is scanned once instead of looked up per person when it holds fewer than DOMAIN_SCAN_RATIO items per
+# person in the cohort (one keyed lookup costs about as much as streaming that many items)
+DOMAIN_SCAN_RATIO = float(os.environ.get('DOMAIN_SCAN_RATIO', 100))
+
 
 # In[ ]:
 
@@ -36,17 +46,10 @@ def parseKeys(cohortKeys, searchKeys):
 
 
 # In[ ]:
-def get_json_payload_from_txid(txid, chainName, datadir):
-    queryCommand = 'multichain-cli {} -datadir={} gettxoutdata {} 0'.format(chainName, datadir, txid)
-    items = subprocess.check_output(queryCommand.split())
-    return items
-
 #Given a chain name subscribe to audit log stream to ensure query is recorded
 def subscribeToStream(chainName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe audit_log'.format(chainName,datadir)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe('audit_log')
     return
 
 
@@ -59,9 +62,7 @@ def queryMappingStream(chainName, multichainLoc, datadir, keys):
     concepts = []
     for key in keys:
         try:
-            queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_clinical {} false 9999'.format(chainName, datadir, key)
-            items = subprocess.check_output(queryCommand.split())
-            response = json.loads(items, parse_int= int)
+            response = list(getClient(chainName, datadir, multichainLoc).streamItems('mappingData_clinical', key))
             for r in response[:80]:
                 if r['keys'][0] == 'StreamsUsed':
                     pass
@@ -85,16 +86,16 @@ def extractDataStream(chainName, multichainLoc, datadir, cohortKeys):
 # In[ ]:
 
 
-def extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys):
+def extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys, include_descendants = False):
+    if include_descendants:
+        ##the concept and every descendant (see conceptHierarchy), read concurrently as one cohort
+        return queryCohort(chainName, multichainLoc, datadir, Concept(cohortKeys[0], include_descendants = True))
     concept_domain, concept_stream, concept_bucket = extractDataStream(chainName, multichainLoc, datadir, cohortKeys)
     matches = []
     for bucket in concept_bucket:
         ##potentially change to liststreamkeyitems
-        queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems {}_id_{}_bucket_{} {} false 999'.format(chainName, datadir,
-                                                                                                               concept_domain, concept_stream,
-                                                                                                               bucket+1, cohortKeys[0])
-        items = subprocess.check_output(queryCommand.split())
-        matches.extend(json.loads(items, parse_int= int))
+        streamName = '{}_id_{}_bucket_{}'.format(concept_domain, concept_stream, bucket+1)
+        matches.extend(getClient(chainName, datadir, multichainLoc).streamItems(streamName, cohortKeys[0]))
     ids = []
     for match in matches:
         ids.append(int(match['keys'][1])) #CHANGE_LINE#
@@ -104,26 +105,22 @@ def extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys):
 # In[ ]:
 def extractAllPersonIDs(chainName, datadir):
     ''' Parse all ids from chain'''
-    queryCommand =  f"multichain-cli {chainName} -datadir={datadir} liststreamkeyitems mappingData_person ids false 1"
-    items = subprocess.check_output(queryCommand.split(), stderr=subprocess.STDOUT)
-    items = items.decode("utf-8")
-    matches = json.loads(items.split("\n\n")[-1].split('"data" :')[-1].split(',\n        "confirmations" ')[0])
-    ids = matches['json']
+    matches = getClient(chainName, datadir).call('liststreamkeyitems', 'mappingData_person', 'ids', False, 1)
+    ids = matches[-1]['data']['json']
     return ids
 
 
-def extractPersonStreams(chainName, multichainLoc, datadir, cohortKeys, person = False):
+def extractPersonStreams(chainName, multichainLoc, datadir, cohortKeys, person = False, include_descendants = False):
     if not person:
-        person_ids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys)
+        person_ids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys, include_descendants)
     else:
         person_ids = cohortKeys
     
     person_streams = {}
     for person_id in person_ids:
-        queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_person {} false 999'.format(chainName, datadir, person_id)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int) 
-        person_streams[person_id] = matches[0]['data']['json']
+        ##the newest mapping of the person, a person republished by a later insertion may have moved stream
+        match = getClient(chainName, datadir, multichainLoc).latestItem('mappingData_person', person_id)
+        person_streams[person_id] = match['data']['json']
     return person_streams
 
 
@@ -131,10 +128,10 @@ def extractPersonStreams(chainName, multichainLoc, datadir, cohortKeys, person =
 
 # In[ ]:
 
-def queryDemographics(chainName, multichainLoc, datadir, cohortKeys, domain = False):
+def queryDemographics(chainName, multichainLoc, datadir, cohortKeys, domain = False, include_descendants = False):
     ##check if search from running query or person specific query
     if domain:
-        personids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys)
+        personids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys, include_descendants)
     else:
         if isinstance(cohortKeys,str):
             personids = [int(id) for id in cohortKeys.split(',')]
@@ -144,8 +141,7 @@ def queryDemographics(chainName, multichainLoc, datadir, cohortKeys, domain = Fa
     
     for personid in personids:
         queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems person_demographics {}'.format(chainName, datadir, personid)
-        items = subprocess.check_output(queryCommand.split())
-        matches += json.loads(items, parse_int= int)
+        matches += getClient(chainName, datadir, multichainLoc).streamItems('person_demographics', personid)
         publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     #BEGIN_NEW#
     demo = [match_['data']['json'] for match_ in matches]
@@ -153,8 +149,8 @@ def queryDemographics(chainName, multichainLoc, datadir, cohortKeys, domain = Fa
     #END_NEW#
     return matches
 
-def queryPhenos(chainName, multichainLoc, datadir, cohortKeys):
-    personids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys)
+def queryPhenos(chainName, multichainLoc, datadir, cohortKeys, include_descendants = False):
+    personids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys, include_descendants)
     df = pd.DataFrame(personids, columns = ['person_id'])
     return df
 
@@ -168,44 +164,88 @@ def queryGroupDemographics(chainName, multichainLoc, datadir, searchKeys):
 
     for key in keys:
         queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems person_demographics {}'.format(chainName, datadir, key)
-        items = subprocess.check_output(queryCommand.split())
-        matches += json.loads(items, parse_int= int)
+        matches += getClient(chainName, datadir, multichainLoc).streamItems('person_demographics', key)
         #publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
 
     demo_data = {k:{} for k in keys}
     for match in matches:
         match_key = match['keys'][0]
-        if 'txid' in match['data']:
-            items = get_json_payload_from_txid(match['data'].get('txid'), chainName, datadir)
-            matches_txid = json.loads(items, parse_int= int)
-            demo_data[match_key].update(matches_txid['json'])
+        ##off-chain data is fetched with the item's own vout when 'data' is read, it holds the whole record
+        demographics = match['data']['json']
+        if isinstance(demographics, dict):
+            demo_data[match_key].update(demographics)
         else:
-            demo_data[match_key].update([match['data']['json']])
+            demo_data[match_key].update([demographics])
     print(demo_data)
     return demo_data
 
-def queryDomainStream(chainName, multichainLoc, datadir, cohortKeys, searchKeys):
+def planBucketReads(chainName, multichainLoc, datadir, streamNames, cohortSize):
+    '''
+    Choose how each domain bucket is read for a cohort, from the bucket sizes in liststreams
+    Output:
+        dictionary of stream name: 'scan' (one pass over the bucket) or 'lookup' (one keyed read per person)
+    '''
+    counts = streamCounts(chainName, datadir, multichainLoc, streamNames) if streamNames else None
+    if counts is None:
+        return {streamName: 'lookup' for streamName in streamNames}
+    return {streamName: 'scan' if count is not None and count < cohortSize * DOMAIN_SCAN_RATIO else 'lookup'
+            for streamName, count in zip(streamNames, counts)}
+
+
+def scanBucket(chainName, multichainLoc, datadir, streamName, person_ids):
+    '''
+    Stream a whole domain bucket and keep the items of the cohort (person id is the second key), each page is checked
+    against the cohort bitmap and dropped before the next is read, so memory follows the matches and not the bucket
+    Output:
+        the matching items, grouped by person in the order of person_ids as the keyed lookups return them
+    '''
+    queryCommand = multichainLoc+'multichain-cli {} -datadir={} liststreamitems {} false'.format(chainName, datadir, streamName)
+    cohort = PersonBitmap.fromIds(person_ids)
+    items = getClient(chainName, datadir, multichainLoc).streamItems(streamName)
+    matches = []
+    while True:
+        page = list(itertools.islice(items, PAGE_SIZE))
+        if not page:
+            break
+        item_ids = pd.to_numeric(pd.Series([item['keys'][1] if len(item['keys']) > 1 else None for item in page], dtype = object),
+                                 errors = 'coerce').fillna(-1).to_numpy(dtype = 'int64')
+        matches.extend(item for item, keep in zip(page, cohort.contains(item_ids)) if keep)
+    order = {int(person_id): i for i, person_id in enumerate(person_ids)}
+    matches.sort(key = lambda item: order[int(item['keys'][1])])
+    publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
+    return matches
+
+
+def queryDomainStream(chainName, multichainLoc, datadir, cohortKeys, searchKeys, include_descendants = False):
     '''
     Query domain streams (if using domain view) using the cohort keys to build cohort and search keys to extract the relevant information
     Input:
         cohortKeys: OMOP keys used to build cohort
         searchKeys: OMOP keys for data of interest for cohort (i.e. particular medication)
+        include_descendants: cohort and search keys also match the descendants of the concepts
     '''
     matches = []
     ##extract person_ids
-    person_ids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys)
+    person_ids = extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys, include_descendants)
+    if include_descendants:
+        searchKeys = expandConcepts(chainName, datadir, searchKeys)
     ##extract streams for search keys
     searchStreams = queryMappingStream(chainName, multichainLoc, datadir, searchKeys)
+    bucketStreams = ['{}_id_{}_bucket_{}'.format(stream[0], stream[1], bucket+1) for stream in searchStreams for bucket in ast.literal_eval(stream[-1])]
+    plan = planBucketReads(chainName, multichainLoc, datadir, bucketStreams, len(person_ids))
     ##for each stream:bucket of interest extract the relevant information
     for stream in searchStreams:
         buckets = ast.literal_eval(stream[-1])
         for bucket in buckets:
+            streamName = '{}_id_{}_bucket_{}'.format(stream[0], stream[1], bucket+1)
+            if plan[streamName] == 'scan':
+                matches += scanBucket(chainName, multichainLoc, datadir, streamName, person_ids)
+                continue
             ##loop through patients to ensure only querying data of patients of interest
             for person_id in person_ids:
                     queryCommand = multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems {}_id_{}_bucket_{} {} false 999'.format(chainName, datadir,
                                                                                                 stream[0], stream[1], bucket+1, person_id)
-                    items = subprocess.check_output(queryCommand.split())
-                    matches += json.loads(items, parse_int= int)
+                    matches += getClient(chainName, datadir, multichainLoc).streamItems(streamName, person_id)
                     # if matches:
                         # print(matches)
                     publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
@@ -214,14 +254,13 @@ def queryDomainStream(chainName, multichainLoc, datadir, cohortKeys, searchKeys)
 # In[ ]:
 
 
-def queryPersonStreams(chainName, multichainLoc, datadir, cohortKeys, searchKeys, person):
+def queryPersonStreams(chainName, multichainLoc, datadir, cohortKeys, searchKeys, person, include_descendants = False):
     matches = []
-    person_streams = extractPersonStreams(chainName, multichainLoc, datadir, cohortKeys, person)
+    person_streams = extractPersonStreams(chainName, multichainLoc, datadir, cohortKeys, person, include_descendants)
     for person_id in person_streams.keys():
         queryCommand = multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems person_stream_{} {} false 999'.format(chainName, datadir,
                                                                                     person_streams[person_id], person_id)
-        items = subprocess.check_output(queryCommand.split())
-        matches.extend(json.loads(items, parse_int= int))
+        matches.extend(getClient(chainName, datadir, multichainLoc).streamItems('person_stream_{}'.format(person_streams[person_id]), person_id))
         publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     # print(matches)
     return matches
@@ -234,8 +273,8 @@ def queryPersonStreamSpecific(chainName, multichainLoc, datadir, person_ids, sea
         for searchKey in searchKeys:
             queryCommand = multichainLoc+'multichain-cli {} -datadir={}  liststreamqueryitems person_stream_{} {{"keys":["{}","{}"]}}'.format(chainName, datadir,
                                                                                     person_streams[person_id], person_id, searchKey)
-            items = subprocess.check_output(queryCommand.split())
-            matches.extend(json.loads(items, parse_int= int))
+            query = {'keys': [str(person_id), str(searchKey)]}
+            matches.extend(getClient(chainName, datadir, multichainLoc).call('liststreamqueryitems', 'person_stream_{}'.format(person_streams[person_id]), query))
             publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     # print(matches)  
     return matches
@@ -245,17 +284,17 @@ def queryPersonStreamSpecific(chainName, multichainLoc, datadir, person_ids, sea
 # In[ ]:
 
 
-def domainQuery(chainName, multichainLoc, datadir, cohortKeys, searchKeys):
+def domainQuery(chainName, multichainLoc, datadir, cohortKeys, searchKeys, include_descendants = False):
     results = []
     cohortKeys, searchKeys = parseKeys(cohortKeys, searchKeys)
     if searchKeys[0] == 'demographics':
-        results = queryDemographics(chainName, multichainLoc, datadir, cohortKeys, domain = True)
+        results = queryDemographics(chainName, multichainLoc, datadir, cohortKeys, domain = True, include_descendants = include_descendants)
     elif searchKeys[0] == 'pheno':
-        results = queryPhenos(chainName, multichainLoc, datadir, cohortKeys)
+        results = queryPhenos(chainName, multichainLoc, datadir, cohortKeys, include_descendants)
     elif searchKeys[0] == 'all' :
-        results = queryPersonStreams(chainName, multichainLoc, datadir, cohortKeys, searchKeys, person = False)
+        results = queryPersonStreams(chainName, multichainLoc, datadir, cohortKeys, searchKeys, person = False, include_descendants = include_descendants)
     else:
-        results = queryDomainStream(chainName, multichainLoc, datadir, cohortKeys, searchKeys)
+        results = queryDomainStream(chainName, multichainLoc, datadir, cohortKeys, searchKeys, include_descendants)
     return results
 
 
@@ -279,28 +318,8 @@ def personQuery(chainName, multichainLoc, datadir, person_ids, searchKeys):
 
 
 def publishToAuditstream(chainName, multichainLoc, datadir, queryCommand):
-    #load wallet
-    walletCommand=multichainLoc+'multichain-cli {} -datadir={} listaddresses'.format(chainName, datadir)
-    items = subprocess.check_output(walletCommand.split())
-    matches = json.loads(items, parse_int= int)
-    wallets = pd.DataFrame(matches)
-    wallet = wallets['address'][wallets['ismine'] == True][0]
-    
-    #load time and parse query conducted
-    time = str(datetime.utcnow())
-    query = ' '.join(queryCommand.split(' ')[3:])
-    
-    ##publish to auditstream
-    streamKeys = (wallet, time, query)
-    publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('audit_log'), 
-            str('["{}", "{}", "{}"]'.format(streamKeys[0], streamKeys[1], streamKeys[2])),
-            '{'+'"json":{}'+'}']
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    ##entries are queued and published in batches by a background thread, everything queued is published at exit
+    getAuditLog(chainName, datadir, multichainLoc).log(queryCommand)
     return
 
 
@@ -309,7 +328,7 @@ def publishToAuditstream(chainName, multichainLoc, datadir, queryCommand):
 
 def main():
     parser = argparse.ArgumentParser()
-    action_choices = ['domain', 'person']
+    action_choices = ['domain', 'person', 'cohort']
     parser.add_argument('--view', choices=action_choices)
     parser.add_argument("-cn", "--chainName", help = "the name of the chain to store data", default = "chain1")
     parser.add_argument("-ml", "--multichainLoc", help = "path to multichain commands", default = "")
@@ -317,6 +336,8 @@ def main():
     parser.add_argument("-ck", "--cohortKeys", required=(action_choices[0] in sys.argv), help = "concepts to build cohort from e.g. diagnosis code")
     parser.add_argument("-sk", "--searchKeys", type = str, help = "concepts/domain to search for cohort e.g. drugs taken")
     parser.add_argument("-pi", "--person_ids",required=(action_choices[1] in sys.argv), type = str, help = "concepts/domain to search for cohort e.g. drugs taken")
+    parser.add_argument("-id", "--include_descendants", action = "store_true", help = "cohort and search concepts also match their descendants in the vocabulary hierarchy")
+    parser.add_argument("-ce", "--cohortExpression", required=(action_choices[2] in sys.argv), type = str, help = "cohort definition e.g. '(201820 OR 21600744) AND NOT 4024659 AND race_concept_id=8527 AND variant:1:12345'")
     args = parser.parse_args()
 
     start = time.time()
@@ -324,7 +345,11 @@ def main():
         print("--QUERYING--")
         subscribeToStream(args.chainName, args.multichainLoc, args.datadir)
         if args.view == action_choices[0]:
-            domainQuery(args.chainName, args.multichainLoc, args.datadir, args.cohortKeys, args.searchKeys)
+            domainQuery(args.chainName, args.multichainLoc, args.datadir, args.cohortKeys, args.searchKeys, args.include_descendants)
+        elif args.view == action_choices[2]:
+            person_ids = queryCohort(args.chainName, args.multichainLoc, args.datadir, args.cohortExpression, args.include_descendants)
+            print('{} persons in cohort'.format(len(person_ids)))
+            print(','.join(str(person_id) for person_id in person_ids))
         else:
             personQuery(args.chainName, args.multichainLoc, args.datadir, args.person_ids, args.searchKeys)
         
@@ -36,6 +36,11 @@ import pdb
 import itertools
 import traceback
 from json.decoder import JSONDecodeError
+from chainClient import getClient
+from positionIndex import loadPositionIndex
+from auditLog import getAuditLog
+from personIds import decodePersonIds
+from mafIndex import latestManifest, queryMAFRange, decodeMAFPayloads
 warnings.simplefilter(action='ignore')
 
 
@@ -44,10 +49,8 @@ warnings.simplefilter(action='ignore')
 
 #Given a chain name subscribe to audit log stream to ensure query is recorded
 def subscribeToStream(chainName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe audit_log'.format(chainName,datadir)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe('audit_log')
     return
 
 
@@ -66,8 +69,7 @@ def extractVariantGenes(chainName, multichainLoc, datadir, variant, chrom):
     ##Multichain query
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {}'.format(chainName, datadir,
                                                                                                      chrom, variant)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = list(getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), variant))
     publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     ##Extract gene id from the query
     if matches != []:
@@ -86,13 +88,10 @@ def exractGeneData(chainName, multichainLoc, datadir, gene, variant, chrom):
         chrom - which chromosome the variant is on
     '''
     ##Multichain query
-    queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_chrom_{} {} false 9999999999'.format(chainName, datadir,
-                                                                                                     chrom, gene)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('gene_chrom_{}'.format(chrom), gene)
     
     ##wrangle the data json object and the keys object to a DF
-    df = pd.DataFrame(matches)[['keys', 'data']]
+    df = pd.DataFrame([{'keys': match['keys'], 'data': match['data']} for match in matches])[['keys', 'data']]
     keys = pd.DataFrame(df["keys"].to_list(), columns=['gene_id', 'name', 'feature'])
 
     def createrow(row):
@@ -111,18 +110,8 @@ def exractGeneData(chainName, multichainLoc, datadir, gene, variant, chrom):
 # In[543]:
 
 def extractVariantsStored(chainName, datadir, chrom):
-    queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems mappingData_variants chrom_{} false 9999'.format(chainName, datadir, chrom)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    variants = []
-    for match in matches[:-1]:
-        if 'txid' in match['data']:
-            items = get_json_payload_from_txid(match['data'].get('txid'), chainName, datadir)
-            matches_txid = json.loads(items, parse_int= int)
-            variants.extend([s.split(':')[0] for s in matches_txid['json']])
-        else:
-            variants.extend([s.split(':')[0] for s in match['data']['json']])
-    return set(variants)
+    ##shared per-process index of the stored positions, supports `pos in index` (see positionIndex)
+    return loadPositionIndex(chainName, datadir, chrom)
 
 def queryVariantGene(chainName, multichainLoc, datadir, variants, chrom):
     '''
@@ -157,8 +146,7 @@ def extractGeneVariants(chainName, multichainLoc, datadir, gene, chrom):
     ##multichain command
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {} false 999'.format(chainName, datadir,
                                                                                                      chrom, gene)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = list(getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), gene))
     publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     ##parse returned json object to get the matches (will be multiple)
     if matches != []:
@@ -205,48 +193,14 @@ def MAFquery(chainName, multichainLoc, datadir, chrom, streamRange, numericRange
     '''
     ##multichain command to extract positions from MAF stream using streamRange
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems MAF_chrom_{} {} false 99999'.format(chainName, datadir, chrom, streamRange)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    #BEGIN_NEW#
-    try:
-        MAF_variants = []
-        for match in matches:
-            MAF_variants.append(match['data']['json'])
-    except:
-        MAF_variants = []
-        for match in matches:
-            txid = match['txid']
-            items = get_json_payload_from_txid(txid, chainName, datadir)
-            match_txid = json.loads(items, parse_int= int)
-            MAF_variants.append(match_txid['json'])
-    try:
-        MAF_variants = [json.loads(MAF_variant.replace("(",'"(').replace(")",')"')) for MAF_variant in MAF_variants]
-    except:
-        MAF_variants = [MAF_variant.replace("[", '(').replace("]",")").replace('A', '"A"').replace('C', '"C"').replace('G', '"G"').replace('T', '"T"').replace('0|0', '"0|0"').replace('1|0', '"1|0"'
-                                    ).replace('1|1', '"1|1"').replace('2|0', '"2|0"').replace('2|2', '"2|2"').replace('2|1', '"2|1"').replace('3|0', '"3|0"').replace('3|1', '"3|1"').replace(
-                                        '3|2', '"3|2"').replace('3|3', '"3|3"') for MAF_variant in MAF_variants]
-        MAF_variants = [eval(MAF_variant) for MAF_variant in MAF_variants]
-    ##create DF from returned values and filter only for those within actual numeric range
-    MAF_df = pd.DataFrame(MAF_variants).T.iloc[:,:-2:-1]
-    MAF_df.columns = ['MAF']
-    #END_NEW#
-    MAF_df = MAF_df[(MAF_df['MAF'] >= numericRange[0]) & (MAF_df['MAF'] <= numericRange[1])]
-    MAF_df.reset_index(inplace = True)
-    ##function to parse the returned JSON object with variant information
-    def parseVariantInfo(row):
-        try:
-            info = row[0].replace(' ','').replace('(','').replace(')','').split(',')
-            pos, ref, alt, gt = info[0], info[1], info[2:-1], info[-1]
-        except:
-            info = row[0]
-            pos, ref, alt, gt = info[0], info[1], info[2:-1], info[-1]
-        return [pos, ref, alt, gt, row['MAF']]
-    ##loop through the df and parse through every entry to create cleaned df
-    if not MAF_df.empty:
-        MAF_parsed = MAF_df.apply(parseVariantInfo, axis = 1)
-        MAF_parsed_df = pd.DataFrame(np.vstack(MAF_parsed), columns = ['pos','ref','alt','gt','maf'])
-        publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
-        return MAF_parsed_df
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('MAF_chrom_{}'.format(chrom), streamRange, prefetch = True)
+    ##versioned and legacy payloads are decoded straight into a typed dataframe (see mafIndex.decodeMAFPayloads)
+    MAF_df = decodeMAFPayloads([match['data']['json'] for match in matches])
+    ##filter only for those within actual numeric range
+    MAF_df = MAF_df[(MAF_df['maf'] >= numericRange[0]) & (MAF_df['maf'] <= numericRange[1])].reset_index(drop = True)
+    publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
+    return MAF_df
+
 
 
 # In[547]:
@@ -254,15 +208,22 @@ def MAFquery(chainName, multichainLoc, datadir, chrom, streamRange, numericRange
 
 def MAFqueries(chainName, multichainLoc, datadir, chrom, inputRange):
     '''
-    Full MAF query that uses queryRangeParser and MAFquery to extract relevant positions
+    Full MAF query, uses the sorted MAF index (see mafIndex) and falls back to the MAF buckets (queryRangeParser and
+    MAFquery) for chromosomes inserted before the index existed
     Inputs:
         chrom - chromosome of interest
         inputRange - the MAF range user has inputted
     '''
-    streamRanges, numericRanges = queryRangeParser(inputRange)
-    MAFquery_df = pd.DataFrame(columns = ['pos','ref','alt','gt','maf'])
-    for streamRange in streamRanges:
-        MAFquery_df = MAFquery_df.append(MAFquery(chainName, multichainLoc, datadir, chrom, streamRange, numericRanges))
+    lo, hi = map(float, inputRange.split('-'))
+    manifest = latestManifest(chainName, datadir, chrom, multichainLoc)
+    if manifest is not None:
+        MAFquery_df = queryMAFRange(chainName, datadir, chrom, lo, hi, multichainLoc, manifest)
+        queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems MAF_chrom_{} {} false 99999'.format(chainName, datadir, chrom, inputRange)
+        publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
+    else:
+        streamRanges, numericRanges = queryRangeParser(inputRange)
+        MAFquery_dfs = [MAFquery(chainName, multichainLoc, datadir, chrom, streamRange, numericRanges) for streamRange in streamRanges]
+        MAFquery_df = pd.concat(MAFquery_dfs, ignore_index = True) if MAFquery_dfs else decodeMAFPayloads([])
     return MAFquery_df
 
 
@@ -285,14 +246,11 @@ def extractMAFPersonIDs(chainName, multichainLoc, datadir, chrom, inputRange):
         gt = row['gt']
         ##parses gt if heterozygous (unlikely to be needed now)
         gt = str(gt).replace('[','(').replace(']',')') if len(gt) > 1  else gt[0]
-        queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {}'.format(
-                        chainName, datadir, chrom, pos, gt)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
-        if len(matches > 0):
+        matches = list(getClient(chainName, datadir, multichainLoc).streamItems('chrom_{}'.format(chrom), pos))
+        if len(matches) > 0:
             for match_ in matches:
                 gt = match_['keys'][3]
-                variant_dict[(pos, gt)] = match_['data']['json']
+                variant_dict[(pos, gt)] = decodePersonIds(match_['data']['json'])
         else:
             variant_dict[(pos, gt)] = []
 
@@ -340,9 +298,7 @@ def queryMappingStream(chainName, multichainLoc, datadir, keys):
     '''
     concepts = []
     for key in keys: 
-        queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_clinical {}'.format(chainName, datadir, key)
-        items = subprocess.check_output(queryCommand.split())
-        info = tuple(json.loads(items, parse_int= int)[0]['keys'])
+        info = tuple(getClient(chainName, datadir, multichainLoc).latestItem('mappingData_clinical', key)['keys'])
         concepts.append(info)
     return list(set(concepts))
 
@@ -379,11 +335,8 @@ def extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys):
     ##for every stream bucket, query for the concept
     for bucket in concept_bucket:
         ##potentially change to liststreamkeyitems
-        queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems {}_id_{}_bucket_{} {} false 50'.format(chainName, datadir,
-                                                                                                               concept_domain, concept_stream,
-                                                                                                               bucket+1, cohortKeys[0])
-        items = subprocess.check_output(queryCommand.split())
-        matches.extend(json.loads(items, parse_int= int))
+        streamName = '{}_id_{}_bucket_{}'.format(concept_domain, concept_stream, bucket+1)
+        matches.extend(getClient(chainName, datadir, multichainLoc).streamItems(streamName, cohortKeys[0]))
     
     ids = []
     ##parse through the match to get the personIDs
@@ -396,11 +349,8 @@ def extractPersonIDs(chainName, multichainLoc, datadir, cohortKeys):
 
 def extractAllPersonIDs(chainName, datadir):
     ''' Parse all ids from chain'''
-    queryCommand =  f"multichain-cli {chainName} -datadir={datadir} liststreamkeyitems mappingData_person ids false 1"
-    items = subprocess.check_output(queryCommand.split(), stderr=subprocess.STDOUT)
-    items = items.decode("utf-8")
-    matches = json.loads(items.split("\n\n")[-1].split('"data" :')[-1].split(',\n        "confirmations" ')[0])
-    ids = matches['json']
+    matches = getClient(chainName, datadir).call('liststreamkeyitems', 'mappingData_person', 'ids', False, 1)
+    ids = matches[-1]['data']['json']
     return ids
 
 
@@ -416,63 +366,41 @@ def calculateMAF(chainName, multichainLoc, datadir, chrom, variant, gt):
     '''
 
     ##Search mapping stream for all the samples added to the chain
-    queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_variants samples'.format(chainName, datadir)
-
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('mappingData_variants', 'samples')
     ##count the number of samples (not there will be multiple matches from the query as each time a batch of samples is added a new entry is created)
     samples = []
     #BEGIN_NEW#
     for match in matches:
             ##track mapping files for all unique samples added
-                try:
-                    samples.extend(match['data']['json'])
-                except:
-                    items = get_json_payload_from_txid(match['data'].get('txid'), chainName, datadir)
-                    match = json.loads(items, parse_int= int)
-                    samples.extend(match['json'])
+                ##off-chain data is fetched with the item's own vout when 'data' is read
+                samples.extend(match['data']['json'])
     #END_NEW#
     samples = len(set(samples))
 
     ##if not a homozygous gt then carry out search and count number of samples that match
     if gt != '0|0':
         ##Search mapping stream for all the samples added to the chain
-        queryCommand='multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {}'.format(chainName, datadir,
-                                                                                                    chrom, variant)
-
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = getClient(chainName, datadir, multichainLoc).streamItems('chrom_{}'.format(chrom), variant)
         ##count the number of samples (not there will be multiple matches from the query as each time a batch of samples is added a new entry is created)
         alleleMatch = []
         #BEGIN_NEW#
         for match in matches:
             if match['keys'][3] == gt:
             ##track mapping files for all unique samples added
-                try:
-                        alleleMatch.extend(match['data']['json'])
-                except:
-                    items = get_json_payload_from_txid(match['data'].get('txid'), chainName, datadir)
-                    match = json.loads(items, parse_int= int)
-                    alleleMatch.extend(match['json'])
+                persons = match['data']['json']
+                alleleMatch.extend(decodePersonIds(persons))
         #END_NEW#
         alleleMatch = len(set( alleleMatch ))
     ##if a homozygous gt then add up all the matches and take #full samples - result (this is because 0|0 is not stored on chain)
     else:
-        queryCommand='multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {}'.format(chainName, datadir,
-                                                                                                    chrom, variant)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = getClient(chainName, datadir, multichainLoc).streamItems('chrom_{}'.format(chrom), variant)
 
         alleleMatch = []
         #BEGIN_NEW#
         for match in matches:
             ##track mapping files for all unique samples added
-                try:
-                    alleleMatch.extend(match['data']['json'])
-                except:
-                    items = get_json_payload_from_txid(match['data'].get('txid'), chainName, datadir)
-                    match = json.loads(items, parse_int= int)
-                    alleleMatch.extend(match['json'])
+                persons = match['data']['json']
+                alleleMatch.extend(decodePersonIds(persons))
         #END_NEW#
         alleleMatch = len(set( alleleMatch ))
         alleleMatch = samples - alleleMatch
@@ -489,9 +417,8 @@ def getVariantAnnotations(chainName, multichainLoc, datadir, chrom, variants):
     for variant in variants:
         queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {}'.format(chainName, datadir,
                                                                                                                 chrom, variant)
-        items = subprocess.check_output(queryCommand.split())
+        matches = getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), variant)
         publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
-        matches = json.loads(items, parse_int= int)
         annotations[variant] = [match_['data']['json'] for match_ in matches]
     return annotations
 
@@ -511,9 +438,7 @@ def queryClinicalGeneVariant(chainName, multichainLoc, datadir, cohortKeys, gene
     for variant in variants[0:20]:
         queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {} false 999999'.format(chainName, datadir,
                                                                                                         chrom, variant)
-
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = list(getClient(chainName, datadir, multichainLoc).streamItems('chrom_{}'.format(chrom), variant))
         if matches == []:
             #Assume all are 0|0
             gt = '0|0'
@@ -524,7 +449,7 @@ def queryClinicalGeneVariant(chainName, multichainLoc, datadir, cohortKeys, gene
             persons_included = []
             for match_ in matches:
                 gt = match_['keys'][3]
-                ppl_gt = match_['data']['json']
+                ppl_gt = decodePersonIds(match_['data']['json'])
                 person_ids_gt = list(set(ppl_gt).intersection(person_ids))
                 if person_ids_gt != []:
                     MAF = calculateMAF(chainName, multichainLoc, datadir, chrom, variant, gt)
@@ -573,13 +498,12 @@ def extractVariantPersonIDs(chainName, datadir, chrom, variant):
     variants_all = extractVariantsStored(chainName, datadir, chrom)
     if variant in variants_all:
         variant_dict = {}
-        queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {} false 9999999999999999'.format(chainName, datadir, chrom, variant)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = getClient(chainName, datadir).streamItems('chrom_{}'.format(chrom), variant)
         persons_gt = {}
         for match in matches:
             pos, gt = match['keys'][0], match['keys'][3]
-            persons_gt[(pos, gt)] =  match['data']['json']
+            ##person ids are either a JSON array or the compact encoding (see personIds)
+            persons_gt[(pos, gt)] = decodePersonIds(match['data']['json'])
         return persons_gt
     else:
         print(f"Variant {variant} not in chain")
@@ -598,8 +522,7 @@ def queryDemographics(chainName, multichainLoc, datadir, person_ids, cohortKeys)
     
     for personid in personids:
         queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems person_demographics {}'.format(chainName, datadir, personid)
-        items = subprocess.check_output(queryCommand.split())
-        json_item = json.loads(items, parse_int= int)[0]['data']['json']
+        json_item = getClient(chainName, datadir, multichainLoc).latestItem('person_demographics', personid)['data']['json']
         person_df = pd.DataFrame.from_dict(json_item, orient = 'index').T
         persons_df = pd.concat([persons_df,person_df])
     persons_df.set_index('person_id', inplace = True)
@@ -615,10 +538,9 @@ def extractPersonStreams(chainName, multichainLoc, datadir, person_ids):
     '''
     person_streams = {}
     for person_id in person_ids:
-        queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_person {}'.format(chainName, datadir, person_id)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int) 
-        person_streams[person_id] = matches[0]['data']['json']
+        ##the newest mapping of the person, a person republished by a later insertion may have moved stream
+        match = getClient(chainName, datadir, multichainLoc).latestItem('mappingData_person', person_id)
+        person_streams[person_id] = match['data']['json']
     return person_streams
 
 def queryPersonStreams(chainName, multichainLoc, datadir, person_ids, searchKeys):
@@ -628,10 +550,7 @@ def queryPersonStreams(chainName, multichainLoc, datadir, person_ids, searchKeys
     person_streams = extractPersonStreams(chainName, multichainLoc, datadir, person_ids)
     data = {}
     for person_id in person_streams.keys():
-        queryCommand = multichainLoc+'multichain-cli {} -datadir={}  liststreamkeyitems person_stream_{} {} false 150'.format(chainName, datadir,
-                                                                                person_streams[person_id], person_id)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = getClient(chainName, datadir, multichainLoc).streamItems('person_stream_{}'.format(person_streams[person_id]), person_id)
         for match in matches:
             key = match['keys'][0]
             if ('all' in searchKeys) | (key in searchKeys): 
@@ -674,36 +593,10 @@ def queryVariantClinical(chainName, multichainLoc, datadir, searchKeys, cohortKe
 # ## log queries
 
 # In[ ]:
-#BEGIN_NEW#
-def get_json_payload_from_txid(txid, chainName, datadir):
-    queryCommand = 'multichain-cli {} -datadir={} gettxoutdata {} 0'.format(chainName, datadir, txid)
-    items = subprocess.check_output(queryCommand.split())
-    return items
-#END_NEW#
 
 def publishToAuditstream(chainName, multichainLoc, datadir, queryCommand):
-    #load wallet
-    walletCommand=multichainLoc+'multichain-cli {} -datadir={} listaddresses'.format(chainName, datadir)
-    items = subprocess.check_output(walletCommand.split())
-    matches = json.loads(items, parse_int= int)
-    wallets = pd.DataFrame(matches)
-    wallet = wallets['address'][wallets['ismine'] == True][0]
-    
-    #load time and parse query conducted
-    time = str(datetime.utcnow())
-    query = ' '.join(queryCommand.split(' ')[3:])
-    
-    ##publish to auditstream
-    streamKeys = (wallet, time, query)
-    publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('audit_log'), 
-            str('["{}", "{}", "{}"]'.format(streamKeys[0], streamKeys[1], streamKeys[2])),
-            '{'+'"json":{}'+'}']
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    ##entries are queued and published in batches by a background thread, everything queued is published at exit
+    getAuditLog(chainName, datadir, multichainLoc).log(queryCommand)
     return
 
 
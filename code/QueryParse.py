@@ -37,6 +37,8 @@ from QueryClinical import (
                             parseKeys
                           )
 
+from cohortAlgebra import queryCohort
+
 from QueryVariant import ( 
                             queryVariants,
                             queryPersonsChroms,
@@ -127,10 +129,10 @@ def getAgeGenderRace(chainName, multichainLoc, datadir, ids):
     return demo_processed.loc[ids]
 
 
-def getPhenotype(pheno_id, demos):
-    """ Get phenotype of interest """
+def getPhenotype(pheno_id, demos, include_descendants = False):
+    """ Get phenotype of interest, include_descendants also matches the descendants of the concept in the vocabulary hierarchy """
     searchKeys = 'demographics' # returns basic information for patients with disease. can be changed if more complex info needed
-    response = domainQuery(chainName, multichainLoc, datadir, pheno_id, searchKeys)
+    response = domainQuery(chainName, multichainLoc, datadir, pheno_id, searchKeys, include_descendants)
     data = [r['data']['json'] for r in response]
     df = pd.DataFrame(data)
     disease_ids = list(df['person_id'].unique())
@@ -139,6 +141,16 @@ def getPhenotype(pheno_id, demos):
     phenos.loc[phenos.index.isin(disease_ids), 'phenotype']  = 1
     return phenos
 
+def getCohort(expression, demos = None, include_descendants = False):
+    """ Get the persons matching a cohort expression e.g. '(201820 OR 21600744) AND NOT 4024659', see cohortAlgebra """
+    cohort_ids = queryCohort(chainName, multichainLoc, datadir, expression, include_descendants)
+    if demos is None:
+        return cohort_ids
+    phenos = demos.copy()
+    phenos['phenotype'] = 0
+    phenos.loc[phenos.index.isin(cohort_ids), 'phenotype']  = 1
+    return phenos
+
 def getVariantDF(chrom, variants, genotype = 'all', metadata = None):
     """ Get variant in DF format """
     response = queryVariants(chainName, multichainLoc, datadir, chrom, variants, genotype, metadata)
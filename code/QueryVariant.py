@@ -29,7 +29,15 @@ import multiprocessing
 import traceback
 import numpy as np
 from itertools import compress
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
+from chainClient import getClient
+from resultCache import cachedQuery, streamSnapshot
+from positionIndex import loadPositionIndex
+from genotypeMatrix import buildGenotypeMatrix
+from auditLog import getAuditLog
+from personIds import decodePersonIds
+from mafIndex import latestManifest, queryMAFRange, decodeMAFPayloads
 warnings.simplefilter(action='ignore')
 
 
@@ -39,10 +47,8 @@ warnings.simplefilter(action='ignore')
 
 #Given a chain name subscribe to audit log stream to ensure query is recorded
 def subscribeToStream(chainName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe audit_log'.format(chainName,datadir)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe('audit_log')
     return
 
 
@@ -76,18 +82,18 @@ def extractVariantsGenotypes(position, genotype):
 
 
 def extractVariantsStored(chainName, datadir, chrom):
-    queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems mappingData_variants chrom_{} false 999'.format(chainName, datadir, chrom)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    variants = []
-    for match in matches:
-        if 'txid' in match['data']:
-            items = get_json_payload_from_txid(match['data'].get('txid'), chainName, datadir)
-            matches_txid = json.loads(items, parse_int= int)
-            variants.extend([s.split(':')[0] for s in matches_txid['json']])
-        else:
-            variants.extend([s.split(':')[0] for s in match['data']['json']])
-    return set(variants)
+    ##shared per-process index of the stored positions, supports `pos in index` (see positionIndex)
+    return loadPositionIndex(chainName, datadir, chrom)
+
+
+@cachedQuery('mappingData_variants')
+def storedSamples(chainName, datadir, multichainLoc = ''):
+    '''
+    Samples that 0|0 genotypes are completed against (the newest 'samples' item of mappingData_variants), read once and
+    reused until mappingData_variants gets new items
+    '''
+    match = getClient(chainName, datadir, multichainLoc).latestItem('mappingData_variants', 'samples')
+    return frozenset(match['data']['json'])
 
 
 def homozgyousPersons(chainName, multichainLoc, datadir, chrom, variant):
@@ -98,23 +104,13 @@ def homozgyousPersons(chainName, multichainLoc, datadir, chrom, variant):
         chrom - chromosome the variant is in
         variant - dictionary with person_ids for samples with non-reference homozygous alles
     '''
-    ##command to extract all the samples added
-    queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems mappingData_variants samples'.format(chainName, datadir)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    #BEGIN_NEW#
-    try:
-        all_persons = matches[0]['data']['json']
-    except:
-        items = get_json_payload_from_txid(matches[0]['data'].get('txid'), chainName, datadir)
-        all_persons = json.loads(items)['json']
-    #END_NEW#
+    all_persons = storedSamples(chainName, datadir, multichainLoc)
     ##extract the non-reference personIDs
     non_ref = []
     for persons in variant.values():
         non_ref.extend(persons)
 
-    homozygous = list(set(all_persons) - set([str(id) for id in non_ref]))
+    homozygous = list(all_persons - set([str(id) for id in non_ref]))
     return homozygous
 
 
@@ -128,8 +124,7 @@ def extractVariantGenes(chainName, multichainLoc, datadir, variant, chrom):
     ##Multichain query
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {}'.format(chainName, datadir,
                                                                                                      chrom, variant)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = list(getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), variant))
     publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     ##Extract gene id from the query
     if matches != []:
@@ -147,12 +142,9 @@ def extractGeneData(chainName, multichainLoc, datadir, gene, variant, chrom):
         chrom - which chromosome the variant is on
     '''
     ##Multichain query
-    queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_chrom_{} {} false 9999999999'.format(chainName, datadir,
-                                                                                                     chrom, gene)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('gene_chrom_{}'.format(chrom), gene)
     ##wrangle the data json object and the keys object to a DF
-    df = pd.DataFrame(matches)[['keys', 'data']]
+    df = pd.DataFrame([{'keys': match['keys'], 'data': match['data']} for match in matches])[['keys', 'data']]
     keys = pd.DataFrame(df["keys"].to_list(), columns=['gene_id', 'name', 'feature'])
     def createrow(row):
         return pd.Series(row['data']['json'])
@@ -196,21 +188,24 @@ def queryVariant(chainName, multichainLoc, datadir, chrom, variant, genotype):
         variant - position of the variant of interest
         genotype - allele of interest i.e. 0|0 1|1 
     '''
-    variant_dict = {}
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('chrom_{}'.format(chrom), variant, prefetch = True)
+    return variantPersons(chainName, multichainLoc, datadir, chrom, variant, genotype, matches)
+
+
+def variantPersons(chainName, multichainLoc, datadir, chrom, variant, genotype, matches):
+    '''
+    Build the genotype: person ids dictionary of a variant from its chrom_N items and record the query
+    Input:
+        matches - the chrom_N items with the variant's key
+    '''
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {} false 9999999999999999'.format(chainName, datadir, chrom, variant)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
     ##parse the matches normally if not homo-ref, if homo-ref then use specific function
     variant_dict = {gt:[] for gt in genotype}
     for match in matches:
         gt = match['keys'][3]
         if gt in genotype:
-            try:
-                variant_dict[gt].extend(match['data']['json'])
-            except:
-                txid = match['data']['txid']
-                matches_txid = get_json_payload_from_txid(txid, chainName, datadir)
-                variant_dict[gt].extend(json.loads(matches_txid)['json'])
+            ##person ids are either a JSON array or the compact encoding (see personIds), off-chain lists are fetched on read
+            variant_dict[gt].extend(decodePersonIds(match['data']['json']))
     if '0|0' in genotype:
         variant_dict['0|0'] = homozgyousPersons(chainName, multichainLoc, datadir, chrom, variant_dict)
     for gt in variant_dict:
@@ -219,6 +214,27 @@ def queryVariant(chainName, multichainLoc, datadir, chrom, variant, genotype):
     return variant_dict
 
 
+def queryVariantsBatch(chainName, multichainLoc, datadir, chrom, variants, genotype):
+    '''
+    queryVariant for many variants: the chrom_N items of every variant are fetched concurrently over the client's
+    connection pool instead of one round-trip after another
+    Input:
+        variants - positions of the variants of interest
+    Output:
+        dictionary of variant: {genotype: person_ids}, in the order of variants
+    '''
+    client = getClient(chainName, datadir, multichainLoc)
+    variants = list(dict.fromkeys(variants))
+    if not variants:
+        return {}
+    def fetch(variant):
+        return list(client.streamItems('chrom_{}'.format(chrom), variant, prefetch = True))
+    with ThreadPoolExecutor(max_workers = min(client.poolSize, len(variants))) as executor:
+        all_matches = list(executor.map(fetch, variants))
+    return {variant: variantPersons(chainName, multichainLoc, datadir, chrom, variant, genotype, matches)
+            for variant, matches in zip(variants, all_matches)}
+
+
 # In[6]:
 
 
@@ -238,9 +254,7 @@ def queryVariants(chainName, multichainLoc, datadir, chrom, variants, genotype,
     filtered_variants, genotype = extractVariantsGenotypes(filtered_variants, genotype)
     
     #POSITIONS
-    variants_dict = {}
-    for variant in filtered_variants:
-        variants_dict[variant] = queryVariant(chainName, multichainLoc, datadir, chrom, variant, genotype)
+    variants_dict = queryVariantsBatch(chainName, multichainLoc, datadir, chrom, filtered_variants, genotype)
     #get gene info
     #gene_df = queryVariantGene(chainName, multichainLoc, datadir, variants, chrom)
     ##merge gene info and person variant info
@@ -289,43 +303,39 @@ def extractPersonIDsChromsPos(person_ids, chroms, pos):
 # In[18]:
 
 
-def queryPersonChrom(chainName, multichainLoc, datadir, chrom, person_id):
+def personChromVariants(chainName, multichainLoc, datadir, chrom, person_id):
     '''
     For a given personID, extract the variants the person has
     Input:
         person_id - the id of sample to search
         chrom - chromosome the variant is in
+    Output:
+        dictionary of pos: [ref, alt, gt], later chunks overwrite earlier ones
     '''
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems person_chrom_{} {} false 9999999999999999'.format(chainName, datadir, chrom, person_id)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    ##BEGIN_NEW#
-    for i, match in enumerate(matches):
-        try:
-            matches[i] = match['data']['json']
-        except:
-                txid = match['data']['txid']
-                queryCommand = f'multichain-cli {chainName} -datadir={datadir} gettxoutdata "{txid}" 0'
-                items = subprocess.Popen(queryCommand, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                returned, _ = items.communicate()
-                matches[i] = json.loads(returned.decode('utf-8'))['json']
-                
-    person_variants_df = pd.DataFrame()
-    for i, match in enumerate(matches):
-        try:
-            person_variants_df_ = pd.DataFrame.from_dict(match, orient = 'index', columns = [
-            'ref_allele_{}'.format(person_id),
-            'alt_allele_{}'.format(person_id),
-            'gt_{}'.format(person_id)])
-            person_variants_df = pd.concat([person_variants_df, person_variants_df_], axis = 0)
-
-        except:
-            pass
-    ##END_NEW#
-    deduped_persons = person_variants_df[~person_variants_df.index.duplicated(keep='last')]    
+    ##every chunk is read so the off-chain ones are fetched together as each page arrives
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('person_chrom_{}'.format(chrom), person_id, prefetch = True)
+    person_variants = {}
+    for match in matches:
+        chunk = match['data']['json']
+        if isinstance(chunk, dict):
+            person_variants.update(chunk)
     publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
-    
-    return deduped_persons
+    return person_variants
+
+
+def queryPersonChrom(chainName, multichainLoc, datadir, chrom, person_id):
+    '''
+    Dataframe of the variants a person has, one ref, alt and gt column for the person
+    Input:
+        person_id - the id of sample to search
+        chrom - chromosome the variant is in
+    '''
+    person_variants = personChromVariants(chainName, multichainLoc, datadir, chrom, person_id)
+    return pd.DataFrame.from_dict(person_variants, orient = 'index', columns = [
+        'ref_allele_{}'.format(person_id),
+        'alt_allele_{}'.format(person_id),
+        'gt_{}'.format(person_id)])
 
 
 # In[9]:
@@ -337,29 +347,13 @@ def extractAllPosition(chainName, multichainLoc, datadir, chrom):
     Input:
         chrom - chromosome the variants are in
     '''
-    queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems mappingData_variants chrom_{}'.format(chainName, datadir, chrom)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    #BEGIN_NEW#
-    try:
-        positions = matches[0]['data']['json']
-    except:
-        items = get_json_payload_from_txid(matches[0]['data'].get('txid'), chainName, datadir)
-        matches = json.loads(items, parse_int= int)
-        positions = matches['json']
-    return [p.split(':') for p in positions]
-    #END_NEW#
+    return loadPositionIndex(chainName, datadir, chrom, multichainLoc).records()
 
 
 
 # In[61]:
 
 
-def get_json_payload_from_txid(txid, chainName, datadir):
-    queryCommand = 'multichain-cli {} -datadir={} gettxoutdata {} 0'.format(chainName, datadir, txid)
-    items = subprocess.check_output(queryCommand.split())
-    return items
-
 def queryPersonsChrom(chainName, multichainLoc, datadir, chrom, person_ids, pos):
     '''
     create dataframe of all variants (of interest) for inputted person_ids
@@ -368,27 +362,15 @@ def queryPersonsChrom(chainName, multichainLoc, datadir, chrom, person_ids, pos)
         chrom - chromosome the variant is in
         pos - the position of the variants
     '''
-    ##create empty dataframe
-    person_df = pd.DataFrame(columns = ['ref_allele','alt_allele'])
-    ##for every sample, extract their relevant positions and merge to the dataframe
-    for person_id in person_ids:
-        query_df = queryPersonChrom(chainName, multichainLoc, datadir, chrom, person_id)
-        # Following line perhaps isn't necessary since the positions are strings
-        # query_df.index = pd.to_numeric(query_df.index)
-        person_df = person_df.merge(query_df, right_index = True, left_index = True, how = 'outer')
-        person_df['ref_allele'].update(person_df.pop('ref_allele_{}'.format(person_id)))
-        person_df['alt_allele'].update(person_df.pop('alt_allele_{}'.format(person_id)))
-        ##where variant data for person doesnt exist, must be 0|0 genotype - this only fills in the 0|0 if at least
-        ##one sample has non-ref allele
-        person_df.iloc[:,1:] = person_df.iloc[:,1:].fillna('0|0')
-        ##this extract all positions and identifies which ones are missing from dataframe and so must be 0|0 for all patients
-        allPositions = extractAllPosition(chainName, multichainLoc, datadir, chrom)
-        homo_pos = list(set([p[0] for p in allPositions]) - set(person_df.index)) #NEW_LINE#
-        homo = pd.DataFrame(index = homo_pos, columns = person_df.columns)
-        homo.iloc[:,2:] = homo.iloc[:,2:].fillna('0|0')
-        homo_details = pd.DataFrame(allPositions, columns = ['pos', 'ref_allele', 'alt_allele']).set_index('pos') #NEW_LINE#
-        homo = homo.combine_first(homo_details)[homo.columns] #NEW_LINE#
-        person_full_df  = pd.concat([person_df, homo])
+    client = getClient(chainName, datadir, multichainLoc)
+    person_ids = list(dict.fromkeys(person_ids))
+    ##the persons' records are fetched concurrently over the connection pool
+    with ThreadPoolExecutor(max_workers = max(1, min(client.poolSize, len(person_ids)))) as executor:
+        records = executor.map(lambda person_id: personChromVariants(chainName, multichainLoc, datadir, chrom, person_id), person_ids)
+        person_variants = dict(zip(person_ids, records))
+    ##rows are the stored positions (index built once per chromosome), positions without a record for a person are 0|0
+    allPositions = loadPositionIndex(chainName, datadir, chrom, multichainLoc)
+    person_full_df = buildGenotypeMatrix(allPositions, person_variants)
     ##filter out positions not of interest
     if pos != 'all':
         # Bek: we first find the good keys to avoid index error
@@ -453,60 +435,33 @@ def MAFquery(chainName, multichainLoc, datadir, chrom, streamRange, numericRange
     '''
     ##multichain command to extract positions from MAF stream using streamRange
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems MAF_chrom_{} {} false 99999'.format(chainName, datadir, chrom, streamRange)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    #BEGIN_NEW#
-    try:
-        MAF_variants = []
-        for match in matches:
-            MAF_variants.append(match['data']['json'])
-    except:
-        MAF_variants = []
-        for match in matches:
-            txid = match['txid']
-            items = get_json_payload_from_txid(txid, chainName, datadir)
-            match_txid = json.loads(items, parse_int= int)
-            MAF_variants.append(match_txid['json'])
-    try:
-        MAF_variants = [json.loads(MAF_variant.replace("(",'"(').replace(")",')"')) for MAF_variant in MAF_variants]
-    except:
-        MAF_variants = [MAF_variant.replace("[", '(').replace("]",")").replace('A', '"A"').replace('C', '"C"').replace('G', '"G"').replace('T', '"T"').replace('0|0', '"0|0"').replace('1|0', '"1|0"'
-                                    ).replace('1|1', '"1|1"').replace('2|0', '"2|0"').replace('2|2', '"2|2"').replace('2|1', '"2|1"').replace('3|0', '"3|0"').replace('3|1', '"3|1"').replace(
-                                        '3|2', '"3|2"').replace('3|3', '"3|3"') for MAF_variant in MAF_variants]
-        MAF_variants = [eval(MAF_variant) for MAF_variant in MAF_variants]
-    ##create DF from returned values and filter only for those within actual numeric range
-    MAF_df = pd.DataFrame(MAF_variants).T.iloc[:,:-2:-1]
-    MAF_df.columns = ['MAF']
-    #END_NEW#
-    MAF_df = MAF_df[(MAF_df['MAF'] >= numericRange[0]) & (MAF_df['MAF'] <= numericRange[1])]
-    MAF_df.reset_index(inplace = True)
-    ##function to parse the returned JSON object with variant information
-    def parseVariantInfo(row):
-        try:
-            info = row[0].replace(' ','').replace('(','').replace(')','').split(',')
-            pos, ref, alt, gt = info[0], info[1], info[2:-1], info[-1]
-        except:
-            info = row[0]
-            pos, ref, alt, gt = info[0], info[1], info[2:-1], info[-1]
-        return [pos, ref, alt, gt, row['MAF']]
-    ##loop through the df and parse through every entry to create cleaned df
-    if not MAF_df.empty:
-        MAF_parsed = MAF_df.apply(parseVariantInfo, axis = 1)
-        MAF_parsed_df = pd.DataFrame(np.vstack(MAF_parsed), columns = ['pos','ref','alt','gt','maf'])
-        publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
-        return MAF_parsed_df
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('MAF_chrom_{}'.format(chrom), streamRange, prefetch = True)
+    ##versioned and legacy payloads are decoded straight into a typed dataframe (see mafIndex.decodeMAFPayloads)
+    MAF_df = decodeMAFPayloads([match['data']['json'] for match in matches])
+    ##filter only for those within actual numeric range
+    MAF_df = MAF_df[(MAF_df['maf'] >= numericRange[0]) & (MAF_df['maf'] <= numericRange[1])].reset_index(drop = True)
+    publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
+    return MAF_df
+
 
 def MAFqueries(chainName, multichainLoc, datadir, chrom, inputRange):
     '''
-    Full MAF query that uses queryRangeParser and MAFquery to extract relevant positions
+    Full MAF query, uses the sorted MAF index (see mafIndex) and falls back to the MAF buckets (queryRangeParser and
+    MAFquery) for chromosomes inserted before the index existed
     Inputs:
         chrom - chromosome of interest
         inputRange - the MAF range user has inputted
     '''
-    streamRanges, numericRanges = queryRangeParser(inputRange)
-    MAFquery_df = pd.DataFrame(columns = ['pos','ref','alt','gt','maf'])
-    for streamRange in streamRanges:
-        MAFquery_df = MAFquery_df.append(MAFquery(chainName, multichainLoc, datadir, chrom, streamRange, numericRanges))
+    lo, hi = map(float, inputRange.split('-'))
+    manifest = latestManifest(chainName, datadir, chrom, multichainLoc)
+    if manifest is not None:
+        MAFquery_df = queryMAFRange(chainName, datadir, chrom, lo, hi, multichainLoc, manifest)
+        queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems MAF_chrom_{} {} false 99999'.format(chainName, datadir, chrom, inputRange)
+        publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
+    else:
+        streamRanges, numericRanges = queryRangeParser(inputRange)
+        MAFquery_dfs = [MAFquery(chainName, multichainLoc, datadir, chrom, streamRange, numericRanges) for streamRange in streamRanges]
+        MAFquery_df = pd.concat(MAFquery_dfs, ignore_index = True) if MAFquery_dfs else decodeMAFPayloads([])
     print(MAFquery_df)
     return MAFquery_df
 
@@ -523,8 +478,7 @@ def extractGeneVariants(chainName, multichainLoc, datadir, gene, chrom):
     ##multichain command
     queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {} false 999'.format(chainName, datadir,
                                                                                                      chrom, gene)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    matches = list(getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), gene))
     publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     ##parse returned json object to get the matches (will be multiple)
     if matches != []:
@@ -544,8 +498,8 @@ def queryMetadata(chainName, multichainLoc, datadir, search_values):
     '''
     #Metadata query
     queryCommand = 'multichain-cli {} -datadir={} liststreamitems mappingData_metadata'.format(chainName, datadir)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
+    ##cached until mappingData_metadata gets new items
+    matches = streamSnapshot(chainName, datadir, 'mappingData_metadata', multichainLoc = multichainLoc)
     #Parse the search values specified
     publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
     all_patient_ids = {}
@@ -590,8 +544,7 @@ def queryAnnotationVariant(chainName, multichainLoc, datadir, chrom, annots):
     for annot in annots:
         queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {}'.format(chainName, datadir,
                                                                                                             chrom, annot)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), annot)
         publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
         all_data = []
         for match_ in matches:
@@ -619,9 +572,8 @@ def getVariantAnnotations(chainName, multichainLoc, datadir, chrom, variants):
     for variant in variants:
         queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {}'.format(chainName, datadir,
                                                                                                                 chrom, variant)
-        items = subprocess.check_output(queryCommand.split())
+        matches = getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), variant)
         publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
-        matches = json.loads(items, parse_int= int)
         annotations[variant] = [match_['data']['json'] for match_ in matches]
     return annotations
     
@@ -642,8 +594,7 @@ def queryVariantAnnotations(chainName, multichainLoc, datadir, chrom, gene):
     for variant in variants:
         queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems gene_variant_chrom_{} {}'.format(chainName, datadir,
                                                                                                             chrom, variant)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = getClient(chainName, datadir, multichainLoc).streamItems('gene_variant_chrom_{}'.format(chrom), variant)
         publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
         for match_ in matches:
             keys = match_['keys']
@@ -680,12 +631,11 @@ def getPatientVariantAnnotation(chainName, multichainLoc, datadir, chrom, annots
         variant_dict = {variant: {gt: [] for gt in ['1|0', '1|1']} for variant in variants}
         for variant in variants:
             queryCommand = 'multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {} false 999'.format(chainName, datadir, chrom, variant)
-            items = subprocess.check_output(queryCommand.split())
-            matches = json.loads(items, parse_int= int)
+            matches = getClient(chainName, datadir, multichainLoc).streamItems('chrom_{}'.format(chrom), variant)
             publishToAuditstream(chainName, multichainLoc, datadir, queryCommand)
             for match in matches:
                 gt = match['keys'][3]
-                patients = match['data']['json']
+                patients = decodePersonIds(match['data']['json'])
                 variant_dict[variant][gt] = patients
 
         patient_variants = pd.DataFrame.from_dict(variant_dict, orient = 'index')
@@ -700,28 +650,8 @@ def getPatientVariantAnnotation(chainName, multichainLoc, datadir, chrom, annots
 
 
 def publishToAuditstream(chainName, multichainLoc, datadir, queryCommand):
-    #load wallet
-    walletCommand=multichainLoc+'multichain-cli {} -datadir={} listaddresses'.format(chainName, datadir)
-    items = subprocess.check_output(walletCommand.split())
-    matches = json.loads(items, parse_int= int)
-    wallets = pd.DataFrame(matches)
-    wallet = wallets['address'][wallets['ismine'] == True][0]
-    
-    #load time and parse query conducted
-    time = str(datetime.utcnow())
-    query = ' '.join(queryCommand.split(' ')[3:])
-    
-    ##publish to auditstream
-    streamKeys = (wallet, time, query)
-    publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('audit_log'), 
-            str('["{}", "{}", "{}"]'.format(streamKeys[0], streamKeys[1], streamKeys[2])),
-            '{'+'"json":{}'+'}']
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    ##entries are queued and published in batches by a background thread, everything queued is published at exit
+    getAuditLog(chainName, datadir, multichainLoc).log(queryCommand)
     return
 
 
@@ -20,6 +20,7 @@ import pandas as pd
 import json
 import warnings
 import multiprocessing
+from chainClient import getClient
 warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
@@ -27,10 +28,8 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 
 def queryMappingStream(chainName, multichainLoc, datadir, cohortDomain, key ):
-    queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_{} {}'.format(chainName, datadir, cohortDomain, key)
-    items = subprocess.check_output(queryCommand.split())
-    matches = json.loads(items, parse_int= int)
-    return matches[0]
+    ##the newest mapping of the key, a key republished by a later insertion may have moved stream
+    return getClient(chainName, datadir, multichainLoc).latestItem('mappingData_{}'.format(cohortDomain), key)
 
 
 # In[ ]:
@@ -51,11 +50,8 @@ def extractPersonIDs(chainName, multichainLoc, datadir, cohortDomain, key):
     concept_stream, concept_bucket = extractDataStream(chainName, multichainLoc, datadir, cohortDomain, key)
     matches = []
     for bucket in concept_bucket:
-        queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamqueryitems {}_id_{}_bucket_{} {{"keys":["{}"]}}'.format(chainName, datadir,
-                                                                                                               cohortDomain, concept_stream[0],
-                                                                                                               bucket+1, key)
-        items = subprocess.check_output(queryCommand.split())
-        matches.extend(json.loads(items, parse_int= int))
+        streamName = '{}_id_{}_bucket_{}'.format(cohortDomain, concept_stream[0], bucket+1)
+        matches.extend(getClient(chainName, datadir, multichainLoc).call('liststreamqueryitems', streamName, {'keys': [str(key)]}))
     
     ids = []
     for match in matches:
@@ -75,10 +71,7 @@ def queryDomainStream(chainName, multichainLoc, datadir, cohortDomain, key, sear
     for stream in streams[searchDomain]:
         for person_id in person_ids:
             try:
-                queryCommand = multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems condition_id_{}_bucket_1 {}'.format(chainName, datadir,
-                                                                                            stream, person_id)
-                items = subprocess.check_output(queryCommand.split())
-                matches = json.loads(items, parse_int= int)
+                matches = getClient(chainName, datadir, multichainLoc).call('liststreamkeyitems', 'condition_id_{}_bucket_1'.format(stream), str(person_id))
             except:
                 pass
 
@@ -90,10 +83,8 @@ def extractPersonStreams(chainName, multichainLoc, datadir, cohortDomain, key):
     person_ids = extractPersonIDs(chainName, multichainLoc, datadir, cohortDomain, key)
     person_streams = {}
     for person_id in person_ids:
-        queryCommand=multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_person {}'.format(chainName, datadir, person_id)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int) 
-        person_streams[person_id] = matches[0]['data']['json']
+        match = getClient(chainName, datadir, multichainLoc).latestItem('mappingData_person', person_id)
+        person_streams[person_id] = match['data']['json']
     return person_streams
 
 
@@ -103,10 +94,7 @@ def extractPersonStreams(chainName, multichainLoc, datadir, cohortDomain, key):
 def queryPersonStreams(chainName, multichainLoc, datadir, cohortDomain, key, searchDomain):
     person_streams = extractPersonStreams(chainName, multichainLoc, datadir, cohortDomain, key)
     for person_id in person_streams.keys():
-        queryCommand = multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems patient_stream_{} {}'.format(chainName, datadir,
-                                                                                    person_streams[person_id], person_id)
-        items = subprocess.check_output(queryCommand.split())
-        matches = json.loads(items, parse_int= int)
+        matches = getClient(chainName, datadir, multichainLoc).call('liststreamkeyitems', 'patient_stream_{}'.format(person_streams[person_id]), str(person_id))
         print(matches)
     return matches
 
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+alleleCounts.py
+Local store of the latest (count, total) published for every position-genotype of a chrom_N stream, so that new
+inserts can compute frequencies without downloading the whole stream. One sqlite file per chromosome, updated after
+every insert and rebuilt from the chain when it is missing, out of date or a rebuild is requested.
+Usage: from alleleCounts import openStore
+       store = openStore(chainName, datadir, chrom, multichainLoc)
+       prev = store.lookup(keys)  -> {(pos, ref, alt, gt): (count, total)}
+       store.update(MAF); store.markSynced()
+'''
+
+import os
+import sqlite3
+from chainClient import getClient
+
+
+# items read per liststreamitems call when rebuilding from the chain
+PAGE_SIZE = 10000
+
+
+class AlleleCountStore:
+    '''
+    Allele counts for one chromosome
+    Input:
+        chainName - name of the chain
+        datadir - directory where multichain stores the chain
+        chrom - chromosome (the N of chrom_N)
+        multichainLoc - path to multichain commands
+        storeDir - directory holding the sqlite files, defaults to <datadir>/<chainName>/allele_counts
+    '''
+    def __init__(self, chainName, datadir, chrom, multichainLoc = '', storeDir = None):
+        self.chainName = chainName
+        self.datadir = datadir
+        self.chrom = chrom
+        self.multichainLoc = multichainLoc
+        if storeDir is None:
+            storeDir = os.path.join(datadir if datadir else os.path.expanduser('~/.multichain'), chainName, 'allele_counts')
+        os.makedirs(storeDir, exist_ok = True)
+        self.path = os.path.join(storeDir, 'chrom_{}.sqlite'.format(chrom))
+        self.connection = sqlite3.connect(self.path, timeout = 60)
+        self.connection.execute('CREATE TABLE IF NOT EXISTS counts (pos TEXT, ref TEXT, alt TEXT, gt TEXT, count INTEGER, '
+                                'total INTEGER, PRIMARY KEY (pos, ref, alt, gt)) WITHOUT ROWID')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+        self.connection.commit()
+
+    def lookup(self, keys):
+        '''
+        Get the stored counts for the position-genotypes being inserted
+        Input:
+            keys - iterable of (pos, ref, alt, gt)
+        Output:
+            dictionary of (pos, ref, alt, gt): (count, total) for the keys already on the chain
+        '''
+        found = {}
+        cursor = self.connection.cursor()
+        for key in keys:
+            row = cursor.execute('SELECT count, total FROM counts WHERE pos = ? AND ref = ? AND alt = ? AND gt = ?',
+                                 tuple(str(k) for k in key)).fetchone()
+            if row is not None:
+                found[key] = row
+        return found
+
+    def allCounts(self):
+        '''
+        Output:
+            list of (pos, ref, alt, gt, count, total) for every position-genotype in the store
+        '''
+        return self.connection.execute('SELECT pos, ref, alt, gt, count, total FROM counts').fetchall()
+
+    def update(self, MAF):
+        '''
+        Store the counts that were just published
+        Input:
+            MAF - dictionary of (pos, ref, alt, gt): [count, total, freq]
+        '''
+        self.connection.executemany('INSERT OR REPLACE INTO counts VALUES (?, ?, ?, ?, ?, ?)',
+                                    ([str(k) for k in key] + [int(value[0]), int(value[1])] for key, value in MAF.items()))
+        self.connection.commit()
+        return
+
+    def chainItems(self):
+        '''
+        Number of items currently in the chrom_N stream
+        '''
+        streams = getClient(self.chainName, self.datadir, self.multichainLoc).call('liststreams', 'chrom_{}'.format(self.chrom))
+        return int(streams[0]['items']) if streams else 0
+
+    def markSynced(self):
+        '''
+        Record the stream size the store matches, a different size on the next insert triggers a rebuild
+        '''
+        self.connection.execute('INSERT OR REPLACE INTO meta VALUES (?, ?)', ('items', str(self.chainItems())))
+        self.connection.commit()
+        return
+
+    def isStale(self):
+        '''
+        True if items were added to (or the store was built for a different) chrom_N stream since the last sync
+        '''
+        row = self.connection.execute('SELECT value FROM meta WHERE key = ?', ('items',)).fetchone()
+        return row is None or int(row[0]) != self.chainItems()
+
+    def isBuilt(self):
+        return self.connection.execute('SELECT value FROM meta WHERE key = ?', ('items',)).fetchone() is not None
+
+    def rebuild(self):
+        '''
+        Rebuild the store from the keys of every item in chrom_N, the latest item for each position-genotype wins
+        '''
+        client = getClient(self.chainName, self.datadir, self.multichainLoc)
+        latest, start = {}, 0
+        while True:
+            ##items are returned oldest first (unconfirmed last) so later items overwrite earlier ones
+            items = client.call('liststreamitems', 'chrom_{}'.format(self.chrom), False, PAGE_SIZE, start)
+            for item in items:
+                pos, ref, alt, gt, count, total = item['keys'][:6]
+                latest[(pos, ref, alt, gt)] = [count, total, None]
+            if len(items) < PAGE_SIZE:
+                break
+            start += PAGE_SIZE
+        self.connection.execute('DELETE FROM counts')
+        self.update(latest)
+        self.markSynced()
+        return
+
+    def close(self):
+        self.connection.close()
+
+
+def openStore(chainName, datadir, chrom, multichainLoc = '', storeDir = None, rebuild = False, checkStale = True):
+    '''
+    Open the allele count store of a chromosome, rebuilding it from the chain if asked or if it is out of date
+    checkStale = False keeps the store as is unless it has never been built (used when resuming an insertion)
+    '''
+    store = AlleleCountStore(chainName, datadir, chrom, multichainLoc, storeDir)
+    if rebuild or (store.isStale() if checkStale else not store.isBuilt()):
+        store.rebuild()
+    return store
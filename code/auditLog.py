@@ -0,0 +1,140 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+auditLog.py
+Buffered writer for the audit_log stream used by the query scripts. The wallet address is looked up once per process,
+entries are queued by the query code and published in publishmulti batches by a background thread. Anything still
+queued is published when the process exits so that every query is recorded.
+Usage: from auditLog import getAuditLog
+       getAuditLog(chainName, datadir, multichainLoc).log(queryCommand)
+'''
+
+import os
+import atexit
+import threading
+from datetime import datetime
+from chainClient import getClient
+
+
+# seconds between background flushes and number of queued entries that triggers an early flush
+FLUSH_INTERVAL = float(os.environ.get('AUDIT_FLUSH_INTERVAL', 2))
+FLUSH_ENTRIES = int(os.environ.get('AUDIT_FLUSH_ENTRIES', 200))
+
+
+class AuditLog:
+    '''
+    Queue of audit entries for one chain
+    Input:
+        chainName - name of the chain
+        datadir - directory where multichain stores the chain
+        multichainLoc - path to multichain commands
+    '''
+    def __init__(self, chainName, datadir, multichainLoc = ''):
+        self.chainName = chainName
+        self.datadir = datadir
+        self.multichainLoc = multichainLoc
+        self.wallet = None
+        self.entries = []
+        self.lock = threading.Lock()
+        self.flushLock = threading.Lock()
+        self.wake = threading.Event()
+        self.closed = False
+        self.thread = threading.Thread(target = self._run, daemon = True)
+        self.thread.start()
+
+    def getWallet(self):
+        '''
+        Address of this node's wallet, looked up on first use
+        '''
+        if self.wallet is None:
+            matches = getClient(self.chainName, self.datadir, self.multichainLoc).call('listaddresses')
+            self.wallet = [match['address'] for match in matches if match['ismine']][0]
+        return self.wallet
+
+    def log(self, queryCommand):
+        '''
+        Queue an audit entry for a query
+        Input:
+            queryCommand - the multichain-cli command of the query, recorded without the chain and datadir arguments
+        '''
+        ##load time and parse query conducted
+        time = str(datetime.utcnow())
+        query = ' '.join(queryCommand.split(' ')[3:])
+        with self.lock:
+            self.entries.append([time, query])
+            full = len(self.entries) >= FLUSH_ENTRIES
+        if full:
+            self.wake.set()
+        return
+
+    def flush(self):
+        '''
+        Publish the queued entries, one publishmulti transaction per batch
+        '''
+        ##one flush at a time so entries keep their order on the stream
+        with self.flushLock:
+            with self.lock:
+                entries, self.entries = self.entries, []
+            if not entries:
+                return
+            sent = 0
+            try:
+                wallet = self.getWallet()
+                publisher = getClient(self.chainName, self.datadir, self.multichainLoc).batchPublisher()
+                added = 0
+                for time, query in entries:
+                    publisher.add('audit_log', [wallet, time, query], {'json': {}})
+                    added += 1
+                    ##items still queued in the publisher have not been sent, everything added before them has
+                    sent = added - len(publisher.items)
+                publisher.flush()
+                sent = len(entries)
+            except Exception:
+                ##put back only the entries that were not published so the next flush (or the one at exit) retries them
+                with self.lock:
+                    self.entries = entries[sent:] + self.entries
+                raise
+        return
+
+    def _run(self):
+        while not self.closed:
+            self.wake.wait(FLUSH_INTERVAL)
+            self.wake.clear()
+            try:
+                self.flush()
+            except Exception:
+                pass
+
+    def close(self):
+        '''
+        Stop the background thread and publish what is left
+        '''
+        self.closed = True
+        self.wake.set()
+        self.thread.join()
+        self.flush()
+        return
+
+
+_logs = {}
+
+def getAuditLog(chainName, datadir, multichainLoc = ''):
+    '''
+    Return the shared audit log of a chain for this process, creating it on first use
+    '''
+    key = (os.getpid(), chainName, datadir, multichainLoc)
+    if key not in _logs:
+        _logs[key] = AuditLog(chainName, datadir, multichainLoc)
+    return _logs[key]
+
+
+@atexit.register
+def flushAll():
+    '''
+    Publish every queued entry before the process exits
+    '''
+    for key, auditLog in list(_logs.items()):
+        if key[0] == os.getpid():
+            auditLog.close()
+    return
@@ -0,0 +1,67 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+benchmarkClient.py
+Compare the cost of chain calls made by spawning multichain-cli against calls made over the persistent JSON-RPC client
+Usage: python benchmarkClient.py -cn=[CHAIN NAME] -dr=[MULTICHAIN DIR] -n=[NUMBER OF CALLS]
+'''
+
+import time
+import argparse
+import multiprocessing
+from concurrent.futures import ThreadPoolExecutor
+from chainClient import MultichainClient
+
+
+def timeCalls(client, method, params, numCalls, threads):
+    '''
+    Time numCalls identical calls
+    Input:
+        client - MultichainClient in the mode being tested
+        method, params - the call to repeat
+        threads - number of concurrent callers
+    Output:
+        calls per second
+    '''
+    start = time.time()
+    if threads == 1:
+        for _ in range(numCalls):
+            client.call(method, *params)
+    else:
+        with ThreadPoolExecutor(max_workers = threads) as executor:
+            list(executor.map(lambda _: client.call(method, *params), range(numCalls)))
+    return numCalls / (time.time() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-cn", "--chainName", help = "the name of the chain to store data", default = "chain1")
+    parser.add_argument("-ml", "--multichainLoc", help = "path to multichain commands", default = "")
+    parser.add_argument("-dr", "--datadir", help = "path to store the chain")
+    parser.add_argument("-n", "--numCalls", type = int, help = "number of calls per test", default = 200)
+    parser.add_argument("-st", "--stream", help = "stream used for the lookup test", default = "mappingData_variants")
+    parser.add_argument("-ky", "--key", help = "key used for the lookup test", default = "samples")
+    args = parser.parse_args()
+
+    tests = [('getinfo', []),
+             ('liststreamkeyitems', [args.stream, args.key, False, 1])]
+    cli = MultichainClient(args.chainName, args.datadir, args.multichainLoc, mode = 'cli')
+    rpc = MultichainClient(args.chainName, args.datadir, args.multichainLoc, mode = 'rpc')
+    if rpc.mode != 'rpc':
+        print('RPC credentials not found in {}/{}, only the cli fallback is available'.format(args.datadir, args.chainName))
+        return
+
+    threads = multiprocessing.cpu_count()
+    for method, params in tests:
+        cliRate = timeCalls(cli, method, params, args.numCalls, 1)
+        rpcRate = timeCalls(rpc, method, params, args.numCalls, 1)
+        rpcThreaded = timeCalls(rpc, method, params, args.numCalls, threads)
+        print('{}: cli {:.1f} calls/s, rpc {:.1f} calls/s ({:.1f}x), rpc x{} threads {:.1f} calls/s ({:.1f}x)'.format(
+            method, cliRate, rpcRate, rpcRate / cliRate, threads, rpcThreaded, rpcThreaded / cliRate))
+    rpc.close()
+    return
+
+
+if __name__ == "__main__":
+    main()
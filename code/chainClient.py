@@ -0,0 +1,517 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+chainClient.py
+Shared client used by the query and insertion scripts to talk to the multichain node.
+Calls go over MultiChain's JSON-RPC interface using a pool of keep-alive HTTP connections (credentials are read
+from <datadir>/<chainName>/multichain.conf and params.dat). If the credentials cannot be found, or if
+MULTICHAIN_CLIENT=cli is set, every call falls back to running multichain-cli as before.
+Usage: from chainClient import getClient
+       client = getClient(chainName, datadir, multichainLoc)
+       matches = client.call('liststreamkeyitems', 'chrom_1', '12345', False, 999)
+       with client.batchPublisher() as publisher: publisher.add('chrom_1', keys, {'json': ids})
+       for item in client.streamItems('chrom_1', '12345'): item['data']['json']
+'''
+
+import os
+import json
+import base64
+import queue
+import sqlite3
+import itertools
+import threading
+import subprocess
+import http.client
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+
+# 'rpc' (default) or 'cli'; rpc silently drops back to cli when the chain config can't be read
+CLIENT_MODE = os.environ.get('MULTICHAIN_CLIENT', 'rpc')
+# number of idle keep-alive connections kept per client
+POOL_SIZE = int(os.environ.get('MULTICHAIN_POOL_SIZE', 8))
+RPC_TIMEOUT = 600
+# items per publishmulti transaction and approximate payload budget (kept under the default max-std-tx-size of 4MB),
+# both are further capped by the chain's params.dat: a transaction may not carry more items than
+# max-std-op-returns-count (10 unless the chain raised it) or it is non-standard and rejected
+BATCH_SIZE = int(os.environ.get('MULTICHAIN_BATCH_SIZE', 200))
+BATCH_BYTES = int(os.environ.get('MULTICHAIN_BATCH_BYTES', 2000000))
+DEFAULT_OP_RETURNS = 10
+DEFAULT_STD_TX_SIZE = 4194304
+# multichain-cli gets the items as one argument, which Linux limits to 128KB (MAX_ARG_STRLEN)
+CLI_BATCH_BYTES = 120000
+# items requested per liststreamitems/liststreamkeyitems call when paging through a stream
+PAGE_SIZE = int(os.environ.get('MULTICHAIN_PAGE_SIZE', 5000))
+# off-chain payloads kept in memory per client, and optional directory where they are also kept between runs
+PAYLOAD_CACHE_SIZE = int(os.environ.get('MULTICHAIN_PAYLOAD_CACHE_SIZE', 2048))
+PAYLOAD_CACHE_DIR = os.environ.get('MULTICHAIN_PAYLOAD_CACHE_DIR', '')
+
+
+class StaleConnection(Exception):
+    '''
+    A pooled keep-alive connection was closed by the node before it read the request
+    '''
+
+
+class MultichainError(Exception):
+    '''
+    Error returned by the node for a JSON-RPC call (same information multichain-cli prints on failure)
+    '''
+    def __init__(self, method, error):
+        self.method = method
+        self.code = error.get('code') if isinstance(error, dict) else None
+        self.message = error.get('message') if isinstance(error, dict) else str(error)
+        super().__init__('{} failed ({}): {}'.format(method, self.code, self.message))
+
+
+def readChainFiles(chainName, datadir, fileNames):
+    '''
+    Parse the key = value settings of chain files (params.dat, multichain.conf), later files override earlier ones
+    '''
+    datadir = datadir if datadir else os.path.expanduser('~/.multichain')
+    config = {}
+    for fileName in fileNames:
+        path = os.path.join(datadir, chainName, fileName)
+        if not os.path.exists(path):
+            continue
+        with open(path) as f:
+            for line in f:
+                line = line.split('#')[0].strip()
+                if '=' not in line:
+                    continue
+                key, value = [x.strip() for x in line.split('=', 1)]
+                config[key] = value
+    return config
+
+
+def readBatchLimits(chainName, datadir):
+    '''
+    Standard transaction limits of a chain from params.dat
+    Output:
+        (max-std-op-returns-count, max-std-tx-size), the MultiChain defaults when params.dat cannot be read
+    '''
+    params = readChainFiles(chainName, datadir, ['params.dat'])
+    try:
+        opReturns = int(params.get('max-std-op-returns-count', DEFAULT_OP_RETURNS))
+        txSize = int(params.get('max-std-tx-size', DEFAULT_STD_TX_SIZE))
+    except ValueError:
+        opReturns, txSize = DEFAULT_OP_RETURNS, DEFAULT_STD_TX_SIZE
+    return max(1, opReturns), txSize
+
+
+def readChainConfig(chainName, datadir):
+    '''
+    Read the RPC connection details for a chain
+    default-rpc-port comes from params.dat, rpcuser/rpcpassword (and optionally rpcport) from multichain.conf
+    Input:
+        chainName - name of the chain
+        datadir - directory where multichain stores the chain (the -datadir passed to multichain-cli)
+    Output:
+        dictionary with host, port, user, password or None if the credentials are not available
+    '''
+    ##multichain.conf is read last so that rpcport overrides the chain default
+    config = readChainFiles(chainName, datadir, ['params.dat', 'multichain.conf'])
+    port = config.get('rpcport', config.get('default-rpc-port'))
+    if ('rpcuser' not in config) or ('rpcpassword' not in config) or (port is None):
+        return None
+    return {'host': config.get('rpcconnect', '127.0.0.1'),
+            'port': int(port),
+            'user': config['rpcuser'],
+            'password': config['rpcpassword']}
+
+
+class MultichainClient:
+    '''
+    Client for a single chain. Thread safe: connections are taken from and returned to a shared pool
+    Input:
+        chainName - name of the chain
+        datadir - directory where multichain stores the chain
+        multichainLoc - path to multichain commands (only used in cli mode)
+        mode - 'rpc' or 'cli', defaults to MULTICHAIN_CLIENT
+    '''
+    def __init__(self, chainName, datadir, multichainLoc = '', mode = None, poolSize = POOL_SIZE):
+        self.chainName = chainName
+        self.datadir = datadir
+        self.multichainLoc = multichainLoc if multichainLoc else ''
+        self.mode = mode if mode else CLIENT_MODE
+        self.poolSize = poolSize
+        self.config = readChainConfig(chainName, datadir) if self.mode == 'rpc' else None
+        if self.config is None:
+            self.mode = 'cli'
+        else:
+            auth = '{}:{}'.format(self.config['user'], self.config['password']).encode('utf-8')
+            self.headers = {'Content-Type': 'application/json',
+                            'Connection': 'keep-alive',
+                            'Authorization': 'Basic ' + base64.b64encode(auth).decode('ascii')}
+        self._pool = queue.LifoQueue()
+        self._ids = itertools.count()
+        self.payloads = PayloadResolver(self)
+        self.maxBatchItems, maxTxSize = readBatchLimits(chainName, datadir)
+        ##half the transaction size limit leaves room for the keys, stream references and transaction overhead
+        self.maxBatchBytes = min(maxTxSize // 2, CLI_BATCH_BYTES) if self.mode == 'cli' else maxTxSize // 2
+
+    def call(self, method, *params):
+        '''
+        Run a multichain API call and return the decoded result
+        Input:
+            method - API method e.g. liststreamkeyitems, publish
+            params - the method parameters as python objects (lists/dicts are sent as JSON)
+        '''
+        if self.mode == 'rpc':
+            return self._callRPC(method, params)
+        return self._callCLI(method, params)
+
+    def publish(self, streamName, streamKeys, streamValues):
+        '''
+        Publish a single item and return the txid
+        Input:
+            streamName - stream to publish to
+            streamKeys - key or list of keys
+            streamValues - data object e.g. {'json': ...}
+        '''
+        return self.call('publish', streamName, streamKeys, streamValues)
+
+    def batchPublisher(self, batchSize = None, batchBytes = None, journal = None):
+        '''
+        Return a BatchPublisher that groups publishes from this client into publishmulti transactions
+        '''
+        return BatchPublisher(self, batchSize, batchBytes, journal)
+
+    def latestItem(self, streamName, key):
+        '''
+        Newest item published with a key, for keys that are republished when their data changes (e.g. the samples list
+        after a second insertion)
+        Output:
+            StreamItem, or None if the key has no items
+        '''
+        ##start -1 returns only the last item with the key
+        items = self.call('liststreamkeyitems', streamName, str(key), False, 1, -1)
+        return StreamItem(items[-1], self) if items else None
+
+    def streamItems(self, streamName, key = None, pageSize = None, prefetch = False):
+        '''
+        Iterate over all the items of a stream (or of one key in a stream), oldest first, fetching pageSize items per call
+        so that no count limit is needed and only one page is held at a time. Items whose data was not returned inline
+        (larger than the node's maxshowndata) fetch it with gettxoutdata when 'data' is first read
+        Input:
+            streamName - stream to read
+            key - only return the items with this key, defaults to every item
+            pageSize - items per call, defaults to MULTICHAIN_PAGE_SIZE
+            prefetch - fetch the off-chain data of every item of a page concurrently when the page arrives
+        Output:
+            generator of StreamItem (dictionaries with keys, data, txid ...)
+        '''
+        pageSize = pageSize if pageSize else PAGE_SIZE
+        start = 0
+        while True:
+            if key is None:
+                page = self.call('liststreamitems', streamName, False, pageSize, start)
+            else:
+                page = self.call('liststreamkeyitems', streamName, str(key), False, pageSize, start)
+            page = [StreamItem(item, self) for item in page]
+            if prefetch:
+                ##the fetched data is attached to the items of the page, not left to the cache which may be smaller than a page
+                offChain = [item for item in page if isOffChain(dict.__getitem__(item, 'data'))]
+                pairs = [(dict.__getitem__(item, 'data')['txid'], int(dict.__getitem__(item, 'data')['vout'])) for item in offChain]
+                fetched = self.payloads.getMany(pairs)
+                for item, pair in zip(offChain, pairs):
+                    dict.__setitem__(item, 'data', fetched[pair])
+            for item in page:
+                yield item
+            if len(page) < pageSize:
+                return
+            start += pageSize
+
+    def subscribe(self, streamName):
+        '''
+        Subscribe to a stream. Errors (e.g. stream does not exist) are ignored, same as the previous fire-and-forget subscribe
+        '''
+        try:
+            self.call('subscribe', streamName)
+        except (MultichainError, subprocess.CalledProcessError):
+            pass
+        return
+
+    def close(self):
+        while not self._pool.empty():
+            self._pool.get_nowait().close()
+        self.payloads.close()
+
+    ##RPC path
+    def _newConnection(self):
+        return http.client.HTTPConnection(self.config['host'], self.config['port'], timeout = RPC_TIMEOUT)
+
+    def _connect(self):
+        '''
+        Output:
+            (connection, True if it was reused from the pool)
+        '''
+        try:
+            return self._pool.get_nowait(), True
+        except queue.Empty:
+            return self._newConnection(), False
+
+    def _release(self, connection):
+        if self._pool.qsize() < self.poolSize:
+            self._pool.put(connection)
+        else:
+            connection.close()
+
+    def _callRPC(self, method, params):
+        body = json.dumps({'method': method, 'params': list(params), 'id': next(self._ids), 'chain_name': self.chainName})
+        connection, reused = self._connect()
+        try:
+            response, payload = self._send(connection, body, reused)
+        except StaleConnection:
+            ##the node had closed this idle keep-alive connection before reading the request, so it is safe to send again
+            connection = self._newConnection()
+            response, payload = self._send(connection, body, False)
+        if response.getheader('Connection', '').lower() == 'close':
+            connection.close()
+        else:
+            self._release(connection)
+        if response.status == 401:
+            raise MultichainError(method, {'code': 401, 'message': 'RPC authorization failed, check multichain.conf'})
+        reply = json.loads(payload, parse_int = int)
+        if reply.get('error'):
+            raise MultichainError(method, reply['error'])
+        return reply['result']
+
+    def _send(self, connection, body, reused):
+        '''
+        Send a request and read the reply. Only the failures of a reused connection that mean the node never read the
+        request raise StaleConnection; anything else (a timeout, a reset while waiting for the reply) may come after the
+        node ran the call, e.g. a publish, so it is raised as is and never retried
+        '''
+        try:
+            try:
+                connection.request('POST', '/', body, self.headers)
+            except (BrokenPipeError, ConnectionResetError):
+                if reused:
+                    raise StaleConnection()
+                raise
+            try:
+                response = connection.getresponse()
+            except http.client.RemoteDisconnected:
+                ##closed without a byte of reply: a keep-alive connection the node dropped while it was idle in the pool
+                if reused:
+                    raise StaleConnection()
+                raise
+            return response, response.read()
+        except BaseException:
+            connection.close()
+            raise
+
+    ##CLI fallback
+    def _callCLI(self, method, params):
+        command = [self.multichainLoc + 'multichain-cli', self.chainName, '-datadir={}'.format(self.datadir), method]
+        command.extend([p if isinstance(p, str) else json.dumps(p) for p in params])
+        output = subprocess.check_output(command, stderr = subprocess.PIPE).decode('utf-8').strip()
+        try:
+            return json.loads(output, parse_int = int)
+        except ValueError:
+            ##plain text results e.g. the txid returned by publish
+            return output
+
+
+def isOffChain(data):
+    '''
+    True if the data of a stream item was not returned inline ({'txid', 'vout', 'size'} instead of the payload)
+    '''
+    return isinstance(data, dict) and 'vout' in data and 'txid' in data and 'json' not in data
+
+
+class PayloadResolver:
+    '''
+    Fetch the off-chain data of stream items with gettxoutdata. Payloads are cached by (txid, vout) in a bounded LRU,
+    transactions never change so entries are never invalidated. If cacheDir is set payloads are also written to a
+    sqlite file there and read back by later runs
+    Input:
+        client - MultichainClient used for the gettxoutdata calls
+        cacheSize - payloads kept in memory, defaults to MULTICHAIN_PAYLOAD_CACHE_SIZE
+        cacheDir - directory of the on-disk cache, defaults to MULTICHAIN_PAYLOAD_CACHE_DIR (off when empty)
+    '''
+    def __init__(self, client, cacheSize = None, cacheDir = None):
+        self.client = client
+        self.cacheSize = cacheSize if cacheSize else PAYLOAD_CACHE_SIZE
+        self.cache = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses = 0, 0
+        cacheDir = cacheDir if cacheDir is not None else PAYLOAD_CACHE_DIR
+        self.disk = None
+        if cacheDir:
+            os.makedirs(cacheDir, exist_ok = True)
+            self.disk = sqlite3.connect(os.path.join(cacheDir, '{}_payloads.sqlite'.format(client.chainName)), timeout = 60, check_same_thread = False)
+            self.disk.execute('CREATE TABLE IF NOT EXISTS payloads (txid TEXT, vout INTEGER, data TEXT, PRIMARY KEY (txid, vout))')
+            self.disk.commit()
+
+    def _cached(self, key):
+        with self.lock:
+            if key in self.cache:
+                self.cache.move_to_end(key)
+                self.hits += 1
+                return True, self.cache[key]
+            if self.disk is not None:
+                row = self.disk.execute('SELECT data FROM payloads WHERE txid = ? AND vout = ?', key).fetchone()
+                if row is not None:
+                    self.hits += 1
+                    self._store(key, json.loads(row[0]))
+                    return True, self.cache[key]
+            self.misses += 1
+        return False, None
+
+    def _store(self, key, data):
+        self.cache[key] = data
+        self.cache.move_to_end(key)
+        while len(self.cache) > self.cacheSize:
+            self.cache.popitem(last = False)
+
+    def _fetch(self, key):
+        data = self.client.call('gettxoutdata', key[0], key[1])
+        with self.lock:
+            self._store(key, data)
+            if self.disk is not None:
+                self.disk.execute('INSERT OR REPLACE INTO payloads VALUES (?, ?, ?)', (key[0], key[1], json.dumps(data)))
+                self.disk.commit()
+        return data
+
+    def get(self, txid, vout = 0):
+        '''
+        Off-chain data of one stream item
+        '''
+        found, data = self._cached((txid, int(vout)))
+        return data if found else self._fetch((txid, int(vout)))
+
+    def getMany(self, pairs):
+        '''
+        Off-chain data of many stream items, the ones not cached are fetched concurrently over the connection pool
+        Input:
+            pairs - list of (txid, vout)
+        Output:
+            dictionary of (txid, vout): data
+        '''
+        results, missing = {}, []
+        for txid, vout in pairs:
+            found, data = self._cached((txid, int(vout)))
+            if found:
+                results[(txid, int(vout))] = data
+            else:
+                missing.append((txid, int(vout)))
+        missing = list(dict.fromkeys(missing))
+        if len(missing) == 1:
+            results[missing[0]] = self._fetch(missing[0])
+        elif missing:
+            with ThreadPoolExecutor(max_workers = self.client.poolSize) as executor:
+                results.update(zip(missing, executor.map(self._fetch, missing)))
+        return results
+
+    def close(self):
+        if self.disk is not None:
+            self.disk.close()
+            self.disk = None
+
+
+class StreamItem(dict):
+    '''
+    Stream item returned by MultichainClient.streamItems. Data stored off-chain (returned by the node as
+    {'txid', 'vout', 'size'}) is fetched with gettxoutdata the first time item['data'] is read
+    '''
+    def __init__(self, item, client):
+        super().__init__(item)
+        self.client = client
+
+    def __getitem__(self, key):
+        value = dict.__getitem__(self, key)
+        if key == 'data' and isOffChain(value):
+            value = self.client.payloads.get(value['txid'], value['vout'])
+            dict.__setitem__(self, 'data', value)
+        return value
+
+    def get(self, key, default = None):
+        return self[key] if key in self else default
+
+
+class BatchPublisher:
+    '''
+    Collect stream items and publish them with publishmulti, one transaction per batch
+    A batch is sent once it holds batchSize items or adding the next item would exceed batchBytes.
+    Items are sent in the order they were added. Use as a context manager (or call flush) so the last batch is sent
+    Input:
+        client - MultichainClient used to send the transactions
+        batchSize - maximum number of items per transaction, defaults to MULTICHAIN_BATCH_SIZE, never more than the chain's
+                    max-std-op-returns-count
+        batchBytes - approximate maximum JSON size of the items per transaction, defaults to MULTICHAIN_BATCH_BYTES, never
+                     more than half the chain's max-std-tx-size (or the argument size limit of multichain-cli)
+        journal - optional InsertJournal, items with an itemId are skipped if already published and recorded otherwise
+    '''
+    def __init__(self, client, batchSize = None, batchBytes = None, journal = None):
+        self.client = client
+        self.batchSize = min(batchSize if batchSize else BATCH_SIZE, client.maxBatchItems)
+        self.batchBytes = min(batchBytes if batchBytes else BATCH_BYTES, client.maxBatchBytes)
+        self.journal = journal
+        self.items = []
+        self.itemIds = []
+        self.size = 0
+        self.txids = []
+
+    def add(self, streamName, streamKeys, streamValues, itemId = None):
+        '''
+        Queue a single item, sending the current batch first if it is full
+        Input:
+            streamName - stream to publish to
+            streamKeys - key or list of keys
+            streamValues - data object e.g. {'json': ...}
+            itemId - identifier of the item in the journal
+        '''
+        if self.journal is not None and itemId is not None and self.journal.isDone(itemId):
+            return
+        item = {'for': streamName, 'keys' if isinstance(streamKeys, list) else 'key': streamKeys, 'data': streamValues}
+        itemSize = len(json.dumps(item))
+        if self.items and (len(self.items) >= self.batchSize or self.size + itemSize > self.batchBytes):
+            self.flush()
+        self.items.append(item)
+        self.itemIds.append(itemId)
+        self.size += itemSize
+        return
+
+    def flush(self):
+        '''
+        Send any queued items and return the txids of all transactions sent so far
+        '''
+        if self.items:
+            journaled = [(itemId, item) for itemId, item in zip(self.itemIds, self.items) if itemId is not None] if self.journal is not None else []
+            ##write-ahead: the items are recorded as pending before they are sent
+            if journaled:
+                self.journal.begin([(itemId, item['for'], item.get('keys', item.get('key')), item['data']) for itemId, item in journaled])
+            ##the stream argument is only the default, every item names its own stream with 'for'
+            txid = self.client.call('publishmulti', self.items[0]['for'], self.items)
+            if journaled:
+                self.journal.commit([itemId for itemId, _ in journaled], txid)
+            self.txids.append(txid)
+            self.items = []
+            self.itemIds = []
+            self.size = 0
+        return self.txids
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, excType, excValue, traceback):
+        ##only send the remaining items if the block finished cleanly
+        if excType is None:
+            self.flush()
+        return False
+
+
+_clients = {}
+
+def getClient(chainName, datadir, multichainLoc = ''):
+    '''
+    Return the shared client for a chain, creating it on first use
+    Clients are cached per process so that connections are not shared across multiprocessing forks
+    '''
+    key = (os.getpid(), chainName, datadir, multichainLoc)
+    if key not in _clients:
+        _clients[key] = MultichainClient(chainName, datadir, multichainLoc)
+    return _clients[key]
@@ -0,0 +1,467 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+cohortAlgebra.py
+Inclusion/exclusion cohort definitions over the clinical and variant streams. A cohort is an expression of leaves
+(OMOP concept keys, demographics predicates and variant carriers) combined with AND, OR and NOT. Every distinct leaf
+source is read once, all of them concurrently over the client's connection pool, and turned into a compressed person
+id bitmap (chunks keyed by the high bits of the ids, each a sorted array or packed bits) so the expression is evaluated
+chunk by chunk with set and bitwise operations, in memory that follows the cohort size rather than the id range.
+NOT is taken against all the person ids on the chain (mappingData_person 'ids').
+Usage: from cohortAlgebra import Concept, Demographic, Carrier, parseCohort, queryCohort
+       cohort = (Concept(201820) | Concept(21600744)) & ~Concept(4024659) & Demographic('race_concept_id', '=', 8527)
+       cohort = parseCohort('(201820 OR 21600744) AND NOT 4024659 AND race_concept_id=8527 AND variant:1:12345:1|0')
+       cohort = parseCohort('201820+ AND NOT 4024659+')          concept keys ending in + include their descendants
+       person_ids = queryCohort(chainName, multichainLoc, datadir, cohort)  -> sorted list of person ids
+'''
+
+import re
+import ast
+import operator
+import numpy as np
+from concurrent.futures import ThreadPoolExecutor
+from chainClient import getClient
+from auditLog import getAuditLog
+from personIds import decodePersonIds
+from conceptHierarchy import loadClosure
+
+
+# comparison operators of demographics predicates, longest first so '<=' is not read as '<'
+OPERATORS = {'<=': operator.le, '>=': operator.ge, '!=': operator.ne, '=': operator.eq, '<': operator.lt, '>': operator.gt}
+TOKEN = r'\(|\)|[^\s()]+'
+# ids per bitmap chunk, and the ids a chunk holds as a sorted array before it switches to packed bits (same size)
+CHUNK_BITS = 16
+CHUNK_MASK = (1 << CHUNK_BITS) - 1
+CHUNK_BYTES = (1 << CHUNK_BITS) // 8
+SPARSE_LIMIT = CHUNK_BYTES // 2
+
+
+class PersonBitmap:
+    '''
+    Compressed set of person ids in chunks of 2**CHUNK_BITS ids keyed by the high bits of the id, so memory follows the
+    number of persons and not the range of their ids. A chunk is a sorted uint16 array of the low bits while it holds at
+    most SPARSE_LIMIT ids and packed bits (uint8, little-endian) once it holds more
+    Input:
+        chunks - dictionary of chunk number: container, no empty containers
+    '''
+    def __init__(self, chunks = None):
+        self.chunks = chunks if chunks is not None else {}
+
+    @classmethod
+    def fromIds(cls, ids):
+        ids = np.unique(np.asarray([int(id_) for id_ in ids], dtype = np.int64))
+        if len(ids) and ids[0] < 0:
+            raise ValueError('person ids must not be negative')
+        high = ids >> CHUNK_BITS
+        keys, starts = np.unique(high, return_index = True)
+        chunks = {}
+        for key, lows in zip(keys.tolist(), np.split((ids & CHUNK_MASK).astype(np.uint16), starts[1:])):
+            chunks[key] = _compact(lows)
+        return cls(chunks)
+
+    def __and__(self, other):
+        chunks = {}
+        for key in self.chunks.keys() & other.chunks.keys():
+            a, b = self.chunks[key], other.chunks[key]
+            if a.dtype == np.uint8 and b.dtype == np.uint8:
+                chunk = _compact(a & b)
+            elif a.dtype == np.uint8:
+                chunk = b[_test(a, b)]
+            else:
+                chunk = a[_test(b, a)] if b.dtype == np.uint8 else np.intersect1d(a, b, assume_unique = True)
+            if len(chunk):
+                chunks[key] = chunk
+        return PersonBitmap(chunks)
+
+    def __or__(self, other):
+        chunks = dict(self.chunks)
+        for key, b in other.chunks.items():
+            a = chunks.get(key)
+            if a is None:
+                chunks[key] = b
+            elif a.dtype == np.uint16 and b.dtype == np.uint16:
+                chunks[key] = _compact(np.union1d(a, b))
+            else:
+                chunks[key] = _bits(a) | _bits(b)
+        return PersonBitmap(chunks)
+
+    def __sub__(self, other):
+        chunks = {}
+        for key, a in self.chunks.items():
+            b = other.chunks.get(key)
+            if b is None:
+                chunks[key] = a
+                continue
+            if a.dtype == np.uint8:
+                chunk = _compact(a & ~_bits(b))
+            else:
+                chunk = a[~_test(b, a)] if b.dtype == np.uint8 else np.setdiff1d(a, b, assume_unique = True)
+            if len(chunk):
+                chunks[key] = chunk
+        return PersonBitmap(chunks)
+
+    def __len__(self):
+        return sum(_count(chunk) for chunk in self.chunks.values())
+
+    def ids(self):
+        ids = []
+        for key in sorted(self.chunks):
+            chunk = self.chunks[key]
+            lows = chunk if chunk.dtype == np.uint16 else np.flatnonzero(np.unpackbits(chunk, bitorder = 'little'))
+            ids.extend((lows.astype(np.int64) + (key << CHUNK_BITS)).tolist())
+        return ids
+
+    def contains(self, ids):
+        '''
+        Output:
+            boolean array, True for the ids (int array) that are in the bitmap
+        '''
+        ids = np.asarray(ids, dtype = np.int64)
+        found = np.zeros(len(ids), dtype = bool)
+        high = ids >> CHUNK_BITS
+        for key in np.unique(high[ids >= 0]).tolist():
+            chunk = self.chunks.get(key)
+            if chunk is None:
+                continue
+            inside = np.flatnonzero(high == key)
+            lows = (ids[inside] & CHUNK_MASK).astype(np.uint16)
+            if chunk.dtype == np.uint8:
+                found[inside] = _test(chunk, lows)
+            else:
+                found[inside] = np.isin(lows, chunk, assume_unique = False)
+        return found
+
+
+def _bits(chunk):
+    ##packed bits of a chunk, set byte by byte with no unpacked array
+    if chunk.dtype == np.uint8:
+        return chunk
+    bits = np.zeros(CHUNK_BYTES, dtype = np.uint8)
+    np.bitwise_or.at(bits, chunk >> 3, (1 << (chunk & 7)).astype(np.uint8))
+    return bits
+
+
+def _test(bits, lows):
+    ##True for the low bits (uint16 array) set in a packed chunk
+    return ((bits[lows >> 3] >> (lows & 7).astype(np.uint8)) & 1).astype(bool)
+
+
+def _count(chunk):
+    return len(chunk) if chunk.dtype == np.uint16 else int(np.unpackbits(chunk).sum())
+
+
+def _compact(chunk):
+    ##sorted array for sparse chunks, packed bits for dense ones
+    if chunk.dtype == np.uint8:
+        if _count(chunk) > SPARSE_LIMIT:
+            return chunk
+        return np.flatnonzero(np.unpackbits(chunk, bitorder = 'little')).astype(np.uint16)
+    return _bits(chunk) if len(chunk) > SPARSE_LIMIT else chunk
+
+
+class CohortExpression:
+    '''
+    Node of a cohort expression, combined with & (AND), | (OR) and ~ (NOT)
+    '''
+    def __and__(self, other):
+        return And(self, other)
+
+    def __or__(self, other):
+        return Or(self, other)
+
+    def __invert__(self):
+        return Not(self)
+
+    def leaves(self):
+        for child in self.children:
+            yield from child.leaves()
+
+
+class And(CohortExpression):
+    def __init__(self, *children):
+        self.children = children
+
+    def evaluate(self, bitmaps, universe):
+        result = self.children[0].evaluate(bitmaps, universe)
+        for child in self.children[1:]:
+            result = result & child.evaluate(bitmaps, universe)
+        return result
+
+    def __repr__(self):
+        return '(' + ' AND '.join(repr(child) for child in self.children) + ')'
+
+
+class Or(CohortExpression):
+    def __init__(self, *children):
+        self.children = children
+
+    def evaluate(self, bitmaps, universe):
+        result = self.children[0].evaluate(bitmaps, universe)
+        for child in self.children[1:]:
+            result = result | child.evaluate(bitmaps, universe)
+        return result
+
+    def __repr__(self):
+        return '(' + ' OR '.join(repr(child) for child in self.children) + ')'
+
+
+class Not(CohortExpression):
+    def __init__(self, child):
+        self.children = (child,)
+
+    def evaluate(self, bitmaps, universe):
+        return universe - self.children[0].evaluate(bitmaps, universe)
+
+    def __repr__(self):
+        return 'NOT {!r}'.format(self.children[0])
+
+
+class Leaf(CohortExpression):
+    '''
+    Leaf of a cohort expression. source is what has to be read from the chain (leaves sharing a source share the read)
+    and select turns what was read into the person ids of the leaf
+    '''
+    def leaves(self):
+        yield self
+
+    def evaluate(self, bitmaps, universe):
+        return bitmaps[repr(self)]
+
+
+class Concept(Leaf):
+    '''
+    Persons with an OMOP concept in any domain stream e.g. Concept(201820)
+    include_descendants = True also selects persons with any descendant of the concept (see conceptHierarchy)
+    '''
+    def __init__(self, key, include_descendants = False):
+        self.key = str(key)
+        self.include_descendants = include_descendants
+        self.source = ('concept', self.key)
+
+    def select(self, ids):
+        return ids
+
+    def __repr__(self):
+        return self.key + ('+' if self.include_descendants else '')
+
+
+class Demographic(Leaf):
+    '''
+    Persons whose demographics field compares to a value e.g. Demographic('year_of_birth', '<', 1960)
+    Values are compared as numbers when both sides are numbers and as strings otherwise
+    '''
+    def __init__(self, field, op, value):
+        if op not in OPERATORS:
+            raise ValueError('unknown comparison {}, use one of {}'.format(op, ', '.join(OPERATORS)))
+        self.field, self.op, self.value = field, op, str(value)
+        self.source = ('demographics', field)
+
+    def select(self, values):
+        compare = OPERATORS[self.op]
+        value = _number(self.value)
+        ids = []
+        for person_id, person_value in values.items():
+            person_value = _number(person_value) if isinstance(value, float) else str(person_value)
+            if isinstance(person_value, type(value)) and compare(person_value, value):
+                ids.append(person_id)
+        return ids
+
+    def __repr__(self):
+        return '{}{}{}'.format(self.field, self.op, self.value)
+
+
+class Carrier(Leaf):
+    '''
+    Persons carrying a variant, with any non homozygous reference genotype or the given one e.g. Carrier(1, 12345, '1|0')
+    '''
+    def __init__(self, chrom, pos, genotype = None):
+        self.chrom, self.pos, self.genotype = str(chrom), str(pos), genotype
+        self.source = ('variant', self.chrom, self.pos)
+
+    def select(self, genotypes):
+        if self.genotype is not None:
+            return genotypes.get(self.genotype, [])
+        return [id_ for gt, ids in genotypes.items() if gt != '0|0' for id_ in ids]
+
+    def __repr__(self):
+        return 'variant:{}:{}'.format(self.chrom, self.pos) + (':{}'.format(self.genotype) if self.genotype else '')
+
+
+def _number(value):
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return str(value)
+
+
+def parseLeaf(token):
+    '''
+    Parse one leaf: 'variant:chrom:pos[:gt]', 'field<op>value' or an OMOP concept key ('key+' with its descendants)
+    '''
+    if token.lower().startswith('variant:'):
+        parts = token.split(':')
+        if len(parts) not in (3, 4):
+            raise ValueError('variant leaves are variant:chrom:pos or variant:chrom:pos:gt, got {}'.format(token))
+        return Carrier(*parts[1:])
+    match = re.match(r'^(\w+)(<=|>=|!=|=|<|>)(.+)$', token)
+    if match:
+        return Demographic(*match.groups())
+    if token.isdigit():
+        return Concept(token)
+    if token.endswith('+') and token[:-1].isdigit():
+        return Concept(token[:-1], include_descendants = True)
+    raise ValueError('cannot parse cohort leaf {}'.format(token))
+
+
+def parseCohort(text):
+    '''
+    Parse a cohort expression
+    Input:
+        text - leaves combined with AND, OR, NOT and parentheses, NOT binds tightest then AND then OR
+               e.g. '(201820 OR 21600744) AND NOT (4024659 OR 21600745) AND year_of_birth<1960 AND variant:1:12345'
+    Output:
+        CohortExpression
+    '''
+    tokens = re.findall(TOKEN, text)
+    position = [0]
+    def peek():
+        return tokens[position[0]].upper() if position[0] < len(tokens) else None
+    def take():
+        position[0] += 1
+        return tokens[position[0] - 1]
+    def parseOr():
+        children = [parseAnd()]
+        while peek() == 'OR':
+            take()
+            children.append(parseAnd())
+        return children[0] if len(children) == 1 else Or(*children)
+    def parseAnd():
+        children = [parseNot()]
+        while peek() == 'AND':
+            take()
+            children.append(parseNot())
+        return children[0] if len(children) == 1 else And(*children)
+    def parseNot():
+        if peek() == 'NOT':
+            take()
+            return Not(parseNot())
+        if peek() == '(':
+            take()
+            expression = parseOr()
+            if peek() != ')':
+                raise ValueError('missing ) in cohort expression {}'.format(text))
+            take()
+            return expression
+        if peek() in (None, ')', 'AND', 'OR'):
+            raise ValueError('expected a leaf in cohort expression {}'.format(text))
+        return parseLeaf(take())
+    expression = parseOr()
+    if peek() is not None:
+        raise ValueError('unexpected {} in cohort expression {}'.format(tokens[position[0]], text))
+    return expression
+
+
+def withDescendants(expression, closure, include_descendants = False):
+    '''
+    Replace the concept leaves that include descendants (all of them if include_descendants) by the OR of the concept
+    and its descendants
+    '''
+    if isinstance(expression, Concept):
+        if not (include_descendants or expression.include_descendants):
+            return expression
+        concepts = [Concept(key) for key in closure.expand([expression.key])]
+        return concepts[0] if len(concepts) == 1 else Or(*concepts)
+    if isinstance(expression, Leaf):
+        return expression
+    return type(expression)(*[withDescendants(child, closure, include_descendants) for child in expression.children])
+
+
+def _containsNot(expression):
+    if isinstance(expression, Not):
+        return True
+    return not isinstance(expression, Leaf) and any(_containsNot(child) for child in expression.children)
+
+
+def fetchSource(chainName, multichainLoc, datadir, source):
+    '''
+    Read the stream items a leaf source needs and record the query
+    Output:
+        'concept' and 'universe': list of person ids, 'demographics': dictionary of person_id: value,
+        'variant': dictionary of genotype: person ids
+    '''
+    client = getClient(chainName, datadir, multichainLoc)
+    audit = getAuditLog(chainName, datadir, multichainLoc)
+    if source[0] == 'universe':
+        audit.log(multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems mappingData_person ids'.format(chainName, datadir))
+        ids = []
+        ##the ids are published in groups of 3000, one item per group
+        for match in client.streamItems('mappingData_person', 'ids'):
+            ids.extend(match['data']['json'])
+        return ids
+    if source[0] == 'concept':
+        key = source[1]
+        ##same lookup as QueryClinical.extractPersonIDs, over every domain stream the concept was inserted into
+        mappings = set()
+        for match in client.streamItems('mappingData_clinical', key):
+            if match['keys'][0] != 'StreamsUsed':
+                mappings.add((match['keys'][1], match['keys'][2], match['keys'][3]))
+        ids = []
+        for domain, stream, buckets in mappings:
+            for bucket in ast.literal_eval(buckets):
+                streamName = '{}_id_{}_bucket_{}'.format(domain, stream, bucket+1)
+                audit.log(multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems {} {}'.format(chainName, datadir, streamName, key))
+                ids.extend(int(match['keys'][1]) for match in client.streamItems(streamName, key))
+        return ids
+    if source[0] == 'demographics':
+        field = source[1]
+        audit.log(multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems person_demographics {}'.format(chainName, datadir, field))
+        values = {}
+        for match in client.streamItems('person_demographics', field, prefetch = True):
+            ##only the grouped items (keyed by field, person_id: value) and not the per-person items that share a key value
+            payload = match['data']['json']
+            if match['keys'][0] == field and isinstance(payload, dict):
+                values.update(payload)
+        return values
+    if source[0] == 'variant':
+        chrom, pos = source[1], source[2]
+        audit.log(multichainLoc+'multichain-cli {} -datadir={} liststreamkeyitems chrom_{} {}'.format(chainName, datadir, chrom, pos))
+        genotypes = {}
+        for match in client.streamItems('chrom_{}'.format(chrom), pos, prefetch = True):
+            genotypes.setdefault(match['keys'][3], []).extend(decodePersonIds(match['data']['json']))
+        return genotypes
+    raise ValueError('unknown cohort source {}'.format(source[0]))
+
+
+def cohortBitmap(chainName, multichainLoc, datadir, expression, include_descendants = False):
+    '''
+    Evaluate a cohort expression
+    Input:
+        expression - CohortExpression or a string for parseCohort
+        include_descendants - every concept leaf also selects the descendants of its concept
+    Output:
+        PersonBitmap of the persons in the cohort
+    '''
+    if isinstance(expression, str):
+        expression = parseCohort(expression)
+    if include_descendants or any(isinstance(leaf, Concept) and leaf.include_descendants for leaf in expression.leaves()):
+        expression = withDescendants(expression, loadClosure(chainName, datadir), include_descendants)
+    ##identical leaves are evaluated once and leaves reading the same items (e.g. two predicates on one field) share the read
+    leaves = {repr(leaf): leaf for leaf in expression.leaves()}
+    sources = list(dict.fromkeys(leaf.source for leaf in leaves.values()))
+    if _containsNot(expression):
+        sources.append(('universe',))
+    client = getClient(chainName, datadir, multichainLoc)
+    with ThreadPoolExecutor(max_workers = max(1, min(client.poolSize, len(sources)))) as executor:
+        data = dict(zip(sources, executor.map(lambda source: fetchSource(chainName, multichainLoc, datadir, source), sources)))
+    bitmaps = {name: PersonBitmap.fromIds(leaf.select(data[leaf.source])) for name, leaf in leaves.items()}
+    universe = PersonBitmap.fromIds(data[('universe',)]) if ('universe',) in data else PersonBitmap()
+    return expression.evaluate(bitmaps, universe)
+
+
+def queryCohort(chainName, multichainLoc, datadir, expression, include_descendants = False):
+    '''
+    Output:
+        sorted list of the person ids in the cohort
+    '''
+    return cohortBitmap(chainName, multichainLoc, datadir, expression, include_descendants).ids()
@@ -0,0 +1,182 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+conceptHierarchy.py
+Ancestor -> descendant closure of the OMOP vocabulary hierarchy (CONCEPT_ANCESTOR, already transitive) stored as CSR
+arrays: the sorted ancestor ids, their offsets and the sorted descendant ids of each ancestor. The arrays are built once
+from the hierarchy file by createStream-OMOP-Domain and saved as .npy files next to the chain, and queries open them
+memory-mapped so expanding a concept is two binary searches and a slice.
+Usage: $ python conceptHierarchy.py -cn=<chain name> -dr=<Chain path> -hp=<Vocabulary path>
+       from conceptHierarchy import loadClosure
+       closure = loadClosure(chainName, datadir)
+       closure.descendants(201820) -> array of descendant ids; closure.expand(['201820']) -> ['201820', ...]
+'''
+
+import os
+import sys
+import json
+import argparse
+import numpy as np
+from tableCache import readTable
+
+
+# files of the closure, meta records the hierarchy file it was built from
+ARRAYS = ['ancestors', 'offsets', 'descendants']
+META_FILE = 'meta.json'
+
+
+def closureDir(chainName, datadir):
+    '''
+    Directory of the closure arrays, <datadir>/<chainName>/concept_closure unless CONCEPT_CLOSURE_DIR is set
+    '''
+    if os.environ.get('CONCEPT_CLOSURE_DIR'):
+        return os.environ['CONCEPT_CLOSURE_DIR']
+    return os.path.join(datadir if datadir else os.path.expanduser('~/.multichain'), chainName, 'concept_closure')
+
+
+class ConceptClosure:
+    '''
+    Read-only ancestor -> descendant closure
+    Input:
+        ancestors - sorted unique ancestor concept ids
+        offsets - descendants of ancestors[i] are descendants[offsets[i]:offsets[i+1]]
+        descendants - descendant concept ids, sorted within each ancestor
+    '''
+    def __init__(self, ancestors, offsets, descendants):
+        self.ancestors = ancestors
+        self.offsets = offsets
+        self.descendantIds = descendants
+
+    def __len__(self):
+        return len(self.ancestors)
+
+    def descendants(self, concept):
+        '''
+        Output:
+            array of the descendants of a concept (without the concept itself), empty if it has none
+        '''
+        concept = int(concept)
+        i = np.searchsorted(self.ancestors, concept)
+        if i == len(self.ancestors) or self.ancestors[i] != concept:
+            return self.descendantIds[0:0]
+        return self.descendantIds[self.offsets[i]:self.offsets[i + 1]]
+
+    def expand(self, concepts):
+        '''
+        Concepts and all their descendants
+        Input:
+            concepts - OMOP concept keys
+        Output:
+            list of concept keys as strings, the given concepts first then the descendants in id order
+        '''
+        concepts = [str(concept) for concept in concepts]
+        descendants = [self.descendants(concept) for concept in concepts]
+        descendants = np.unique(np.concatenate(descendants)) if descendants else []
+        return list(dict.fromkeys(concepts + [str(concept) for concept in descendants]))
+
+
+def buildClosure(hierarchyPath, outputDir, sep = '|'):
+    '''
+    Build the CSR closure from the hierarchy file and save it
+    Input:
+        hierarchyPath - path for the vocabulary hierarchy (ancestor_concept_id, descendant_concept_id columns)
+        outputDir - directory for the .npy arrays
+    Output:
+        ConceptClosure of the saved arrays
+    '''
+    df = readTable(hierarchyPath, sep = sep)
+    ancestor = df['ancestor_concept_id'].to_numpy(dtype = np.int64)
+    descendant = df['descendant_concept_id'].to_numpy(dtype = np.int64)
+    ##the hierarchy lists every concept as its own ancestor (0 levels of separation), those rows are dropped
+    keep = ancestor != descendant
+    ancestor, descendant = ancestor[keep], descendant[keep]
+    order = np.lexsort((descendant, ancestor))
+    ancestor, descendant = ancestor[order], descendant[order]
+    unique = np.ones(len(ancestor), dtype = bool)
+    unique[1:] = (ancestor[1:] != ancestor[:-1]) | (descendant[1:] != descendant[:-1])
+    ancestor, descendant = ancestor[unique], descendant[unique]
+    ancestors, counts = np.unique(ancestor, return_counts = True)
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+
+    os.makedirs(outputDir, exist_ok = True)
+    for name, array in zip(ARRAYS, (ancestors, offsets, descendant)):
+        ##written under a temporary name so a reader never maps a partly written file
+        path = os.path.join(outputDir, name + '.npy')
+        with open(path + '.tmp', 'wb') as f:
+            np.save(f, array)
+        os.replace(path + '.tmp', path)
+    stat = os.stat(hierarchyPath)
+    meta = {'source': os.path.abspath(hierarchyPath), 'mtime': stat.st_mtime, 'size': stat.st_size,
+            'ancestors': len(ancestors), 'pairs': len(descendant)}
+    with open(os.path.join(outputDir, META_FILE + '.tmp'), 'w') as f:
+        json.dump(meta, f)
+    os.replace(os.path.join(outputDir, META_FILE + '.tmp'), os.path.join(outputDir, META_FILE))
+    _closures.pop(outputDir, None)
+    return ConceptClosure(ancestors, offsets, descendant)
+
+
+def isCurrent(hierarchyPath, outputDir):
+    '''
+    True if the closure in outputDir was built from the hierarchy file as it is now
+    '''
+    try:
+        with open(os.path.join(outputDir, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return False
+    stat = os.stat(hierarchyPath)
+    return meta.get('source') == os.path.abspath(hierarchyPath) and meta.get('mtime') == stat.st_mtime and meta.get('size') == stat.st_size
+
+
+def ensureClosure(chainName, datadir, hierarchyPath, sep = '|'):
+    '''
+    Build the closure of a chain unless it is already built from the same hierarchy file
+    '''
+    outputDir = closureDir(chainName, datadir)
+    if not isCurrent(hierarchyPath, outputDir):
+        buildClosure(hierarchyPath, outputDir, sep)
+    return outputDir
+
+
+_closures = {}
+
+def loadClosure(chainName, datadir):
+    '''
+    Open the closure of a chain memory-mapped, once per process (reopened if it is rebuilt)
+    '''
+    outputDir = closureDir(chainName, datadir)
+    metaPath = os.path.join(outputDir, META_FILE)
+    if not os.path.exists(metaPath):
+        raise FileNotFoundError('no concept hierarchy closure in {}, build it with createStream-OMOP-Domain.py or conceptHierarchy.py'.format(outputDir))
+    version = os.stat(metaPath).st_mtime_ns
+    if outputDir not in _closures or _closures[outputDir][0] != version:
+        arrays = [np.load(os.path.join(outputDir, name + '.npy'), mmap_mode = 'r') for name in ARRAYS]
+        _closures[outputDir] = (version, ConceptClosure(*arrays))
+    return _closures[outputDir][1]
+
+
+def expandConcepts(chainName, datadir, concepts):
+    '''
+    Concept keys with all their descendants, see ConceptClosure.expand
+    '''
+    return loadClosure(chainName, datadir).expand(concepts)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-cn", "--chainName", help = "the name of the chain to store data", default = "chain1")
+    parser.add_argument("-dr", "--datadir", help = "path to store the chain")
+    parser.add_argument("-hp", "--hierarchyPath", help = "path to vocabulary file")
+    args = parser.parse_args()
+    try:
+        outputDir = closureDir(args.chainName, args.datadir)
+        closure = buildClosure(args.hierarchyPath, outputDir)
+        print('Built concept closure of {} ancestors in {}'.format(len(closure), outputDir))
+    except:
+        sys.stderr.write("\nERROR: Failed building the concept closure. Please try again.\n")
+        quit()
+
+
+if __name__ == "__main__":
+    main()
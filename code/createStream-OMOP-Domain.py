@@ -26,6 +26,9 @@ import pandas as pd
 import warnings
 import multiprocessing
 import random
+import functools
+from conceptHierarchy import ensureClosure
+from tableCache import readTable
 warnings.simplefilter("ignore")
 
 
@@ -63,7 +66,7 @@ def loadConcepts(dataPath, table):
     '''
 
     dataPath = '{}{}.csv'.format(dataPath, table) 
-    df = pd.read_csv(dataPath)
+    df = readTable(dataPath)
     unique_codes = list(df.iloc[:,2].unique())
     concept_type = df.columns[2]
     concept_type = concept_type.split('_')[0]
@@ -73,6 +76,8 @@ def loadConcepts(dataPath, table):
 # In[8]:
 
 
+##the filtered hierarchy is computed once per table and shared by conceptStreamMapping calls (callers only read it)
+@functools.lru_cache(maxsize = None)
 def loadSuperConcepts(hierarchyPath, dataPath, table):
     '''
     Load the super concepts in the vocabulary hierarchy that will make up the streams
@@ -95,7 +100,7 @@ def loadSuperConcepts(hierarchyPath, dataPath, table):
     super_concept = [int(x) for x in super_concept]
     
     #load the hierarchy tables and clean
-    df = pd.read_csv(hierarchyPath, sep = '|')
+    df = readTable(hierarchyPath, sep = '|')
     df.drop_duplicates(inplace = True)
     df_clean = df[df['min_levels_of_separation'] != 0]
     
@@ -126,9 +131,12 @@ def conceptStreamMapping(hierarchyPath, dataPath, table):
     df_stream_ancestor = loadSuperConcepts(hierarchyPath, dataPath, table)
     
     #for every concept in the dataset assign the potential super concepts that it could go to
+    ##one groupby over the hierarchy instead of a scan per concept, each list keeps the hierarchy row order so the
+    ##seeded random.choice in assignConceptStream picks the same stream
+    ancestors = df_stream_ancestor['ancestor_concept_id'].values
+    groups = df_stream_ancestor.groupby('descendant_concept_id', sort = False).indices
     for concept in unique_concepts:
-            super_concepts = list(df_stream_ancestor['ancestor_concept_id'][df_stream_ancestor['descendant_concept_id'] == concept].values)
-            stream_mapping[concept] = super_concepts
+            stream_mapping[concept] = list(ancestors[groups[concept]]) if concept in groups else []
     return stream_mapping    
 
 
@@ -234,6 +242,12 @@ def main():
     processes = []
     try:
         print("--STREAM CONSTRUCTION--")
+        ##descendant lookups at query time read the closure of the same hierarchy file
+        ensureClosure(args.chainName, args.datadir, args.hierarchyPath)
+        ##tables are parsed (or loaded from the column cache) once here and shared with the table processes
+        readTable(args.hierarchyPath, sep = '|')
+        for table in tables:
+            readTable('{}{}.csv'.format(args.dataPath, table))
         for table in tables:
             p = multiprocessing.Process(target=createStreams, args = (args.chainName, args.multichainLoc,
                                                                       args.datadir, args.hierarchyPath, args.dataPath,  table))
@@ -0,0 +1,65 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+genotypeMatrix.py
+Columnar builder for the person x variant genotypes returned by queryPersonsChrom. Every person's person_chrom_N
+records are written straight into one preallocated int8 matrix whose rows are the stored positions of the chromosome
+(see positionIndex), code 0 being 0|0 so homozygous reference needs no filling. The matrix only becomes a DataFrame
+at the end, with one categorical genotype column per person.
+Usage: from genotypeMatrix import buildGenotypeMatrix
+       df = buildGenotypeMatrix(index, {person_id: {pos: [ref, alt, gt]}})
+'''
+
+import numpy as np
+import pandas as pd
+
+
+# code 0 of every genotype column
+HOMOZYGOUS_REF = '0|0'
+
+
+def buildGenotypeMatrix(index, person_variants):
+    '''
+    Build the genotype table of a chromosome
+    Input:
+        index - PositionIndex of the chromosome
+        person_variants - dictionary of person_id: {pos: [ref, alt, gt]}, persons in column order
+    Output:
+        DataFrame indexed by position (stored positions in position order, then any position only found in the person
+        records) with ref_allele, alt_allele and one gt_<person_id> column per person
+    '''
+    ##one row per stored position, with the first ref/alt stored for it
+    first = np.flatnonzero(np.concatenate([[True], index.positions[1:] != index.positions[:-1]])) if len(index) else np.array([], dtype = np.int64)
+    rows = pd.Index(index.keys[first], dtype = object)
+    person_positions = {person_id: pd.Index(list(variants.keys()), dtype = object) for person_id, variants in person_variants.items()}
+    ##positions a person has that are not in the mapping stream get rows of their own
+    extra = [positions[rows.get_indexer(positions) < 0] for positions in person_positions.values()]
+    extra = pd.unique(np.concatenate(extra)) if extra else []
+    rows = rows.append(pd.Index(extra, dtype = object))
+    refs = np.concatenate([index.refs[first], np.full(len(extra), None, dtype = object)])
+    alts = np.concatenate([index.alts[first], np.full(len(extra), None, dtype = object)])
+
+    matrix = np.zeros((len(rows), len(person_variants)), dtype = np.int8)
+    codebook, codes = [HOMOZYGOUS_REF], {HOMOZYGOUS_REF: 0}
+    def code(gt):
+        if gt not in codes:
+            if len(codebook) > np.iinfo(np.int8).max:
+                raise ValueError('too many distinct genotypes for an int8 matrix')
+            codes[gt] = len(codebook)
+            codebook.append(gt)
+        return codes[gt]
+
+    for column, (person_id, variants) in enumerate(person_variants.items()):
+        if not variants:
+            continue
+        person_rows = rows.get_indexer(person_positions[person_id])
+        values = np.array(list(variants.values()), dtype = object).reshape(len(variants), -1)
+        ##each distinct genotype string of the person is coded once
+        gt_codes, uniques = pd.factorize(values[:, 2])
+        matrix[person_rows, column] = np.array([code(gt) for gt in uniques], dtype = np.int8)[gt_codes]
+        refs[person_rows], alts[person_rows] = values[:, 0], values[:, 1]
+
+    genotypes = {'gt_{}'.format(person_id): pd.Categorical.from_codes(matrix[:, column], codebook)
+                 for column, person_id in enumerate(person_variants)}
+    return pd.DataFrame({'ref_allele': refs, 'alt_allele': alts, **genotypes}, index = rows)
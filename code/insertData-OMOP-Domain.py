@@ -30,6 +30,9 @@ import warnings
 import random
 warnings.simplefilter("ignore")
 import traceback
+import functools
+from chainClient import getClient
+from tableCache import readTable
 
 # Read environmental variables
 NTASKS = int(os.environ.get('NTASKS', 1))
@@ -75,7 +78,7 @@ def loadConcepts(dataPath, table, person):
         table - the specific table being added
     '''
     dataPath = '{}{}.csv'.format(dataPath, table) 
-    df = pd.read_csv(dataPath)
+    df = readTable(dataPath)
     df = df[df['person_id'].isin(person)]
     df['person_id'] = df['person_id'].astype(str)
     unique_codes = list(df.iloc[:,2].unique())
@@ -87,6 +90,8 @@ def loadConcepts(dataPath, table, person):
 # In[5]:
 
 
+##the filtered hierarchy is computed once per table and shared by conceptStreamMapping calls (callers only read it)
+@functools.lru_cache(maxsize = None)
 def loadSuperConcepts(hierarchyPath, dataPath, table):
     '''
     Load the super concepts in the vocabulary hierarchy that will make up the streams
@@ -109,7 +114,7 @@ def loadSuperConcepts(hierarchyPath, dataPath, table):
     super_concept = [int(x) for x in super_concept]
     
     #load the hierarchy tables and clean
-    df = pd.read_csv(hierarchyPath, sep = '|')
+    df = readTable(hierarchyPath, sep = '|')
     df.drop_duplicates(inplace = True)
     df_clean = df[df['min_levels_of_separation'] != 0]
     
@@ -140,9 +145,12 @@ def conceptStreamMapping(hierarchyPath, dataPath, table, person):
     df_stream_ancestor = loadSuperConcepts(hierarchyPath, dataPath, table)
     
     #for every concept in the dataset assign the potential super concepts that it could go to
+    ##one groupby over the hierarchy instead of a scan per concept, each list keeps the hierarchy row order so the
+    ##seeded random.choice in assignConceptStream picks the same stream
+    ancestors = df_stream_ancestor['ancestor_concept_id'].values
+    groups = df_stream_ancestor.groupby('descendant_concept_id', sort = False).indices
     for concept in unique_concepts:
-            super_concepts = list(df_stream_ancestor['ancestor_concept_id'][df_stream_ancestor['descendant_concept_id'] == concept].values)
-            stream_mapping[concept] = super_concepts
+            stream_mapping[concept] = list(ancestors[groups[concept]]) if concept in groups else []
     return stream_mapping    
 
 
@@ -241,7 +249,7 @@ def loadData(dataPath, table, keys, people):
     '''
     #load data and extract relevant data
     dataPath = '{}{}.csv'.format(dataPath, table) 
-    df = pd.read_csv(dataPath)
+    df = readTable(dataPath)
     df = df[df['person_id'].isin(people)]
     df['person_id'] = df['person_id'].astype(str)
     #get concept
@@ -261,11 +269,8 @@ def loadData(dataPath, table, keys, people):
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
-
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -360,19 +365,9 @@ def publishToMappingStream(chainName, multichainLoc, datadir, concept, concept_t
         return
     streamName = "mappingData_clinical"
     streamKeys = concept, concept_type, list(stream.keys())[0], list(stream.values())[0]
-    streamValues ='{"json":'+json.dumps(stream)+'}' #create JSON 
-
-    publishCommand = [multichainLoc+'multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('{}'.format(streamName)), 
-        str('["{}","{}","{}","{}"]'.format(streamKeys[0],streamKeys[1],streamKeys[2],streamKeys[3])),
-        str('{}'.format(streamValues))
-            ]
-
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    streamValues = {'json': json.loads(json.dumps(stream))} #create JSON (round trip stores the int keys as strings, as before)
+
+    getClient(chainName, datadir, multichainLoc).publish(streamName, [str(key) for key in streamKeys], streamValues)
     return
 
 
@@ -390,17 +385,10 @@ def publishToDataStream(row, chainName, multichainLoc, datadir, concept_type, ke
     streamName = row['concept_stream']
     streamBucket = row['bucket']
     streamKeys = keys_df.loc[row.name]
-    streamValues ='{"json":'+row.to_json().strip('[').strip(']')+'}' #create JSON and remove brackets
+    streamValues = json.loads('{"json":'+row.to_json().strip('[').strip(']')+'}') #create JSON and remove brackets
     
-    publishCommand = [multichainLoc+'multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('{}_id_{}_bucket_{}'.format(concept_type,streamName, streamBucket+1)), 
-        str('["{}", "{}", "{}", "{}", "{}"]'.format(concept_type, streamKeys[0], streamKeys[1], streamKeys[2], streamKeys[3], streamKeys[4])),
-        str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    streamKeys = [str(key) for key in [concept_type, streamKeys[0], streamKeys[1], streamKeys[2], streamKeys[3]]]
+    getClient(chainName, datadir, multichainLoc).publish('{}_id_{}_bucket_{}'.format(concept_type,streamName, streamBucket+1), streamKeys, streamValues)
     return
 
 
@@ -439,6 +427,10 @@ def main():
     print('CPUs available: {}'.format(cpu))
     tables = parseTables(args.tables)
     person = loadPeople(args.metafile, num) #NEW_LINE#
+    ##the tables and the hierarchy are parsed (or loaded from the column cache) once here and shared with the subscribe processes
+    readTable(args.hierarchyPath, sep = '|')
+    for table in tables:
+        readTable('{}{}.csv'.format(args.dataPath, table))
 
     processes_sub = []
     processes_map = []
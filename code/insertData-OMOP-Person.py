@@ -28,6 +28,7 @@ import numpy as np
 import json
 import warnings
 from functools import partial
+from chainClient import getClient
 warnings.simplefilter(action='ignore')
 
 # Read environmental variables
@@ -149,10 +150,8 @@ def loadDataStream(stream, data_df, person_df):
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -180,16 +179,8 @@ def publishAllIDs(chainName, multichainLoc, datadir, person_df):
     for people in people_split:
         streamName = "mappingData_person"
         streamKeys = 'ids'
-        streamValues =json.dumps({"json":people})#create JSON 
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('{}'.format(streamName)), 
-            str('["{}"]'.format(streamKeys)),
-            str('{}'.format(streamValues))]
-        procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        procPublish.wait()
+        streamValues = {"json": [int(person) for person in people]}
+        getClient(chainName, datadir, multichainLoc).publish(streamName, [str(streamKeys)], streamValues)
 
 def publishGroupedDemographics(chainName, multichainLoc, datadir, person_df):
     """ Push the demographics table as a table """
@@ -199,16 +190,8 @@ def publishGroupedDemographics(chainName, multichainLoc, datadir, person_df):
         for column in person_df.columns[1:-1]:
             streamName = "person_demographics"
             streamKeys = column
-            streamValues =json.dumps({"json": person_df.set_index('person_id')[column].to_dict()})#create JSON 
-            publishCommand = [multichainLoc+'multichain-cli', 
-                str('{}'.format(chainName)), 
-                str('-datadir={}'.format(datadir)),
-                'publish',
-                str('{}'.format(streamName)), 
-                str('["{}"]'.format(streamKeys)),
-                str('{}'.format(streamValues))]
-            procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            procPublish.wait()
+            streamValues = {"json": person_df.set_index('person_id')[column].to_dict()}
+            getClient(chainName, datadir, multichainLoc).publish(streamName, [str(streamKeys)], streamValues)
 
 def publishToMappingStreams(chainName, multichainLoc, datadir, person_df): 
     '''
@@ -224,16 +207,8 @@ def publishToMappingStreams(chainName, multichainLoc, datadir, person_df):
             #mappingstream
             streamName = "mappingData_person"
             streamKeys = person_id
-            streamValues ='{"json":'+json.dumps(int(person_df['stream'][person_df['person_id'] == person_id].iloc[0]))+'}' #create JSON 
-            publishCommand = [multichainLoc+'multichain-cli', 
-                str('{}'.format(chainName)), 
-                str('-datadir={}'.format(datadir)),
-                'publish',
-                str('{}'.format(streamName)), 
-                str('["{}"]'.format(streamKeys)),
-                str('{}'.format(streamValues))]
-            procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            procPublish.wait()
+            streamValues = {"json": int(person_df['stream'][person_df['person_id'] == person_id].iloc[0])}
+            getClient(chainName, datadir, multichainLoc).publish(streamName, [str(streamKeys)], streamValues)
 
             #demographics stream
             streamName = "person_demographics"
@@ -245,16 +220,7 @@ def publishToMappingStreams(chainName, multichainLoc, datadir, person_df):
             streamKeys = row['person_id'].iloc[0], row['gender_concept_id'].iloc[0], race
 
             streamValues ='{"json":'+row.iloc[0].to_json()+'}' #NEW_LINE#
-            publishCommand = [multichainLoc+'multichain-cli', 
-                str('{}'.format(chainName)), 
-                str('-datadir={}'.format(datadir)),
-                'publish',
-                str('{}'.format(streamName)), 
-                str('["{}","{}","{}"]'.format(streamKeys[0],streamKeys[1],streamKeys[2])),
-                str('{}'.format(streamValues))
-                    ]
-            procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            procPublish.wait()
+            getClient(chainName, datadir, multichainLoc).publish(streamName, [str(key) for key in [streamKeys[0],streamKeys[1],streamKeys[2]]], json.loads(streamValues))
     return
 
 
@@ -273,15 +239,7 @@ def publishToDataStream(row, chainName, multichainLoc, datadir, concept_type, ke
     streamKeys = keys_df.loc[row.name]
     streamValues ='{"json":'+row.to_json().strip('[').strip(']')+'}' #create JSON and remove brackets
     
-    publishCommand = [multichainLoc+'multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('person_stream_{}'.format(streamName)), 
-        str('["{}","{}", "{}", "{}", "{}", "{}"]'.format(concept_type, streamKeys[0], streamKeys[1], streamKeys[2], streamKeys[3], streamKeys[4])),
-        str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    getClient(chainName, datadir, multichainLoc).publish('person_stream_{}'.format(streamName), [str(key) for key in [concept_type, streamKeys[0], streamKeys[1], streamKeys[2], streamKeys[3], streamKeys[4]]], json.loads(streamValues))
     return
 
 
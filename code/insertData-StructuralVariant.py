@@ -30,6 +30,8 @@ import warnings
 import random
 import itertools
 from io import BytesIO, StringIO
+from chainClient import getClient
+from regionPlanner import planRegions
 warnings.simplefilter("ignore")
 
 
@@ -40,10 +42,8 @@ warnings.simplefilter("ignore")
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -103,37 +103,18 @@ def extractSamples(variantFile):
 
 def extractPositions(variantFile):
     '''
-    Extract the positions in the VCF file -> this is needed to efficiently extract data using
+    Split the VCF file into position regions -> this is needed to efficiently extract data using
     bcftools query while specifying the start:end positions, without this bcftools would load 
     all positions at once which would be too large to fit in memory
+    The regions cover the whole chromosome and are planned from the tabix/csi index (see regionPlanner)
     Input:
         variantFiles - files to be added (one per chromosome)
+    Output:
+        chromosome number, contig name as written in the VCF, regions
     '''
-    #get chrom
-    request = 'bcftools query -f \'%CHROM\n\' {} | head -n 1'.format(variantFile)
-    output = subprocess.check_output(request, shell = True) 
-    chrom = output.decode('utf-8').split('\n')[0].split('chr')[1]
-    
-    #get first position
-    request = 'bcftools query -f \'%POS\n\' {} | head -n 1'.format(variantFile)
-    output = subprocess.check_output(request, shell = True)
-    positions = [output.decode('utf-8').split('\n')[0]]
-    
-    #get every 3rd position (MUST CHANGE IN FULL IMPLEMENTATION, CURRENTLY USING HEAD TO SPEED UP TESTING)
-    request = 'bcftools query -f \'%POS\n\' {} | head -n 1000'.format(variantFile)
-    output = subprocess.check_output(request, shell = True)
-    positions.extend(output.decode('utf-8').split('\n'))
-    
-    #chunk the data to be uploaded
-    positions_split = np.array_split(positions, 10)
-    pos_regions = {}
-    
-    #create file that links together the chunked regions
-    last = positions[0]
-    for i, split in enumerate(positions_split):
-        pos_regions[i] = [last, split[-1]]
-        last = split[-1]
-    return (chrom, pos_regions)
+    contig, pos_regions = planRegions(variantFile)
+    chrom = contig.split('chr')[-1]
+    return (chrom, contig, pos_regions)
 
 
 # In[7]:
@@ -205,13 +186,16 @@ def extractVariant(variantFile, positions, pos_region, colnames, chrom):
         positions - stores all the positions included in the VCF to be added to mapping chain
         pos_region - range of positions for bcftools to query (done to avoid overloading ram)
         colnames - person_ids included (and ref, alt columns)
+        chrom - contig name as written in the VCF
         
     '''
-    #get variant data ADD IN POSITIONS
-    request = 'bcftools query -i \'FILTER="PASS"\' -f \'%POS %REF %ALT [ %GT]\n\' {}'.format(variantFile)
+    #get variant data
+    request = 'bcftools query -r {}:{}-{} -i \'FILTER="PASS"\' -f \'%POS %REF %ALT [ %GT]\n\' {}'.format(chrom, pos_region[0], pos_region[1], variantFile)
     output = subprocess.check_output(request, shell = True) 
     ##CHANGE THE NUMBER OF COLS USED WHEN HAVE FULL FILES
     df = pd.read_csv(BytesIO(output), delim_whitespace=True, usecols=[x for x in range(4)], names = colnames, index_col = 'pos')
+    ##bcftools also returns structural variants that start in the previous region and overlap this one
+    df = df[df.index >= int(pos_region[0])]
     #keep track of positions added (for mapping)
     positions.extend(df.index)
     #get dictionary of samples associated with each genotype
@@ -239,28 +223,15 @@ def publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKey
     '''
     ##if publishing variant data
     if publishVariant == True:
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('structural_chrom_{}'.format(streamName)), 
-            str('["{}", "{}", "{}", "{}", "{}", "{}", "{}"]'.format(streamKeys[0], streamKeys[1], streamKeys[2],
-                                                                    streamKeys[3], streamKeys[4], streamKeys[5],
-                                                                   streamKeys[6])),
-            str('{}'.format(streamValues))]
+        stream = 'structural_chrom_{}'.format(streamName)
+        keys = [str(key) for key in streamKeys[:7]]
     
     ##if publishing MAF data
     else:
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('MAF_structural_chrom_{}'.format(streamName)), 
-            str('["{}"]'.format(streamKeys)),
-            str('{}'.format(streamValues))]
-
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+        stream = 'MAF_structural_chrom_{}'.format(streamName)
+        keys = [str(streamKeys)]
+
+    getClient(chainName, datadir, multichainLoc).publish(stream, keys, streamValues)
     return
 
 
@@ -303,8 +274,7 @@ def publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom
             streamName = chrom
             streamKeys = [pos, ref, alt, allele, MAF[(pos,ref,alt, allele)][0], MAF[(pos,ref,alt, allele)][1], MAF[(pos,ref,alt, allele)][2]]
             streamKeys[1] = streamKeys[1].replace("'",'')
-            streamValues ='{'+'"json":{}'.format(row[gt]) +'}'#create JSON data object
-            streamValues = streamValues.replace("'",'"')
+            streamValues = {'json': row[gt]} #create JSON data object
             publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant)
     return 
 
@@ -319,25 +289,14 @@ def extractPreviousMAF(chainName, multichainLoc, datadir, chrom):
         chrom: The chromosome VCF file belongs to
     '''
     ##get the data for each position stored in the stream keys
-    request = 'multichain-cli {} -datadir={} liststreamitems structural_chrom_{} false 9999999999999999'.format(chainName, datadir, chrom)
-    output = subprocess.check_output(request, shell = True)
-    ##parse the output (FIND A BETTER WAY HERE)
-    output = output.decode(
-        'utf-8').replace('\n', '').replace(
-        '[','').replace(']','').replace('},    {','},, {').replace(
-        ' ','').replace('        ','').replace(
-        '    ','').replace('     ','').replace(
-        '"keys":','"keys":[').replace(
-        ',"offchain"','],"offchain"').replace(
-        '"json":','"json":[').replace('},"confirmations"',']},"confirmations"').split(
-        ',,')
+    ##read page by page, only the keys and blocktime of each item are kept
+    items = getClient(chainName, datadir, multichainLoc).streamItems('structural_chrom_{}'.format(chrom))
+    output = [{'keys': item['keys'], 'blocktime': item.get('blocktime')} for item in items]
     
     ##if there is no output then means no samples added for this position
-    if output != ['']:
-        output = [json.loads(x) for x in output]
-
+    if output:
         #extract old counts and get the latest one using blocktime
-        df = pd.DataFrame(output).loc[:,['keys', 'blocktime']]
+        df = pd.DataFrame(output, columns = ['keys', 'blocktime'])
         #create dataframe of positions and MAF information  
         df[['position', 'ref', 'alt', 'allele', 'count', 'total', 'freq']] = pd.DataFrame(df['keys'].tolist())
         df = df.iloc[df.groupby(['position', 'allele'])['blocktime'].idxmax(),2:].set_index(['position', 'ref','alt','allele'])
@@ -366,8 +325,7 @@ def publishMAF(chainName, multichainLoc, datadir, MAF, chrom):
         MAF_group = MAF_df[(MAF_df['freq'] > range[0]) &  (MAF_df['freq'] <= range[1])]
         streamName = chrom
         streamKeys = "{}-{}".format(range[0], range[1])
-        streamValues ='{'+'"json":"{}"'.format(MAF_group['freq'].to_json().replace('"','').replace("'","")) +'}'#create JSON data object
-        streamValues = streamValues.replace("'",'"')
+        streamValues = {'json': MAF_group['freq'].to_json().replace('"','').replace("'","")} #create JSON data object
         publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant = False)
     
     return
@@ -385,16 +343,8 @@ def publishPositions(chainName, multichainLoc, datadir, positions, chrom):
     '''
     streamName = 'mappingData_variants_structural'
     streamKeys = 'chrom_{}'.format(chrom)
-    streamValues = '{'+'"json":{}'.format(positions) + '}'
-    publishCommand = [multichainLoc+'multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('{}'.format(streamName)), 
-        str('{}'.format(streamKeys)),
-        str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    streamValues = {'json': [int(position) for position in positions]}
+    getClient(chainName, datadir, multichainLoc).publish(streamName, streamKeys, streamValues)
 
 
 # In[29]:
@@ -413,15 +363,15 @@ def publishVariants(chainName, multichainLoc, datadir, variantFiles):
         colnames.extend(samples)
         sample_size = len(colnames) - 3
         #split into groups and extract relevant variants
-        chrom, pos_regions = extractPositions(variantFile)
+        chrom, contig, pos_regions = extractPositions(variantFile)
         #store the MAF for all variants and extract old MAFs
         MAF = {}
         prevMAF_df = extractPreviousMAF(chainName, multichainLoc, datadir, chrom)
         ##store all positions
         positions = []
-        for pos_region in list(pos_regions.values())[:len(pos_regions.values())-1]:
+        for pos_region in pos_regions.values():
             ##insert variant data
-            alt_genotypes, positions = extractVariant(variantFile, positions, pos_region, colnames, chrom)
+            alt_genotypes, positions = extractVariant(variantFile, positions, pos_region, colnames, contig)
             publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom, MAF, sample_size, prevMAF_df, publishVariant = True )
         ##publish MAF data
         publishMAF(chainName, multichainLoc, datadir, MAF, chrom)
@@ -31,6 +31,7 @@ import random
 import itertools
 import ast
 from io import BytesIO
+from chainClient import getClient
 warnings.simplefilter("ignore")
 
 
@@ -39,10 +40,8 @@ warnings.simplefilter("ignore")
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -108,16 +107,8 @@ def publishMappingPerson(chainName, multichainLoc, datadir, samples):
     '''
     streamName = 'mappingData_variants_structural'
     streamKeys = 'samples'
-    streamValues = '{'+'"json":{}'.format(json.dumps(samples)) + '}'
-    publishCommand = [multichainLoc+'multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('{}'.format(streamName)), 
-        str('{}'.format(streamKeys)),
-        str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    streamValues = {'json': samples}
+    getClient(chainName, datadir, multichainLoc).publish(streamName, streamKeys, streamValues)
     return
     
 
@@ -160,15 +151,7 @@ def publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKey
         streamKeys: person_id
         streamValues: all the variants:genotype for that person 
     '''
-    publishCommand = [multichainLoc+'multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('person_structural_chrom_{}'.format(streamName)), 
-        str('{}'.format(streamKeys)),
-        str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    getClient(chainName, datadir, multichainLoc).publish('person_structural_chrom_{}'.format(streamName), str(streamKeys), streamValues)
     return
 
 
@@ -190,7 +173,7 @@ def publishToDataStreams(chainName, multichainLoc, datadir, paths):
         for sample_id in samples:
             streamName, streamValues = extractPersonVariants(path, sample_id)
             streamKeys = sample_id
-            streamValues ='{'+'"json":{}'.format(json.dumps(streamValues)) +'}'#create JSON data object
+            streamValues = {'json': streamValues} #create JSON data object
             publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues)
     return
 
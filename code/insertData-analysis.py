@@ -29,6 +29,7 @@ import random
 import itertools
 import psutil
 from io import BytesIO, StringIO
+from chainClient import getClient
 warnings.simplefilter("ignore")
 
 # Read environmental variables
@@ -40,10 +41,8 @@ JOB_ID = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0))
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -106,35 +105,19 @@ def publishMetadata(chainName, multichainLoc, datadir, meta):
     for _, row in meta.iterrows():
         streamName = 'mappingData_metadata'
         streamKeys = '{}'.format(row['id'])
-        streamValues = '{'+'"json":{}'.format(json.dumps(list(row.values[1:]))) + '}'
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('{}'.format(streamName)), 
-            str('{}'.format(streamKeys)),
-            str('{}'.format(streamValues))]
-        procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        procPublish.wait()
+        streamValues = {'json': row.iloc[1:].tolist()}
+        getClient(chainName, datadir, multichainLoc).publish(streamName, streamKeys, streamValues)
 
     num_groups = 1 + meta.shape[0] // 3000 #Max size of each entry
     meta_split = np.array_split(meta,num_groups)
     for col in meta.columns[1:]:
         for meta in meta_split:
             for values in meta[col].unique():
-                ids = list(meta.loc[:,'id'][meta[col] ==values].values)
+                ids = meta.loc[:,'id'][meta[col] ==values].tolist()
                 streamName = 'mappingData_metadata'
-                streamKeys = '["{}", "{}"]'.format(col, values)
-                streamValues = '{'+'"json":{}'.format(json.dumps(ids)) + '}'
-                publishCommand = [multichainLoc+'multichain-cli', 
-                    str('{}'.format(chainName)), 
-                    str('-datadir={}'.format(datadir)),
-                    'publish',
-                    str('{}'.format(streamName)), 
-                    str('{}'.format(streamKeys)),
-                    str('{}'.format(streamValues))]
-                procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-                procPublish.wait()
+                streamKeys = [str(col), str(values)]
+                streamValues = {'json': ids}
+                getClient(chainName, datadir, multichainLoc).publish(streamName, streamKeys, streamValues)
 
 
 ### PCA
@@ -166,15 +149,7 @@ def publishSamplePC(chainName, multichainLoc, datadir, pcaFile, samples, num):
         streamKeys = ['PCA', i]
         streamValues ='{"json":'+row.to_json()+'}' #create JSON and remove brackets
 
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('{}'.format(streamName)), 
-            str('["{}", "{}"]'.format(streamKeys[0], streamKeys[1])),
-            str('{}'.format(streamValues))]
-        procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        procPublish.wait()
+        getClient(chainName, datadir, multichainLoc).publish(streamName, [str(key) for key in streamKeys], json.loads(streamValues))
 
 ### Kinship
 def getRelatednessSNP(sampleids, relatedFile):
@@ -236,29 +211,14 @@ def publishRelatednessSNP(chainName, datadir, sampleids, relatedFile):
     for sample in gt_final:
         streamName = 'analysis'
         streamKeys = ['Relatedness', sample]
-        streamValues ='{"json":'+json.dumps(gt_final[sample])+'}' #create JSON and remove brackets
-        publishCommand = ['multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('{}'.format(streamName)), 
-            str('["{}","{}"]'.format(streamKeys[0], streamKeys[1])),
-            str('{}'.format(streamValues))]
-        procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        procPublish.wait()
+        streamValues = {'json': gt_final[sample]}
+        getClient(chainName, datadir).publish(streamName, [str(key) for key in streamKeys], streamValues)
 
     #AF
     streamName = 'analysis'
     streamKeys = ['Relatedness', 'AF']
-    streamValues ='{"json":'+json.dumps(af)+'}' #create JSON and remove brackets
-    publishCommand = ['multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('{}'.format(streamName)), 
-        str('["{}","{}"]'.format(streamKeys[0], streamKeys[1])),
-        str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+    streamValues = {'json': af}
+    getClient(chainName, datadir).publish(streamName, [str(key) for key in streamKeys], streamValues)
 
 
 
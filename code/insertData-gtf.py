@@ -28,6 +28,8 @@ import warnings
 import multiprocessing
 from gtfparse import read_gtf
 from io import BytesIO, StringIO
+from chainClient import getClient
+from regionPlanner import streamPositions
 import numpy as np
 import random
 warnings.simplefilter(action='ignore', category=FutureWarning)
@@ -38,10 +40,8 @@ warnings.simplefilter(action='ignore', category=FutureWarning)
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -96,16 +96,8 @@ def publishToVariantStream(chainName, multichainLoc, datadir, streamName, stream
         streamName - chromosome that the variant is in
         streamKeys - keys of the entry (position, gene)
     '''
-    publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('gene_variant_chrom_{}'.format(streamName)), 
-            '["{}"]'.format('", "'.join(streamKeys)),
-            streamValues
-            ]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    getClient(chainName, datadir, multichainLoc).publish('gene_variant_chrom_{}'.format(streamName),
+                                                         [str(key) for key in streamKeys], streamValues)
     return
 
 
@@ -120,27 +112,20 @@ def publishToGeneStream(chainName, multichainLoc, datadir, streamName, streamKey
         streamValues - gene information (start, end, type, strand)
     '''
     
-    publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('gene_chrom_{}'.format(streamName)), 
-            str('["{}", "{}", "{}"]'.format(streamKeys[0], streamKeys[1], streamKeys[2])),
-            str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    getClient(chainName, datadir, multichainLoc).publish('gene_chrom_{}'.format(streamName),
+                                                         [str(key) for key in streamKeys[:3]], streamValues)
     return
 
 
 # In[42]:
 
 
-def publishToStreams(gene, chainName, multichainLoc, datadir, chrom, variantFile):
+def publishToStreams(gene, chainName, multichainLoc, datadir, chrom, variantPositions):
     '''
     Extract relevant data for the gene including position, feature, type etc
     Input:
         chrom - chromosome
-        variantfile - the VCF file associated with the same chromosome as the GTF file
+        variantPositions - sorted positions of the VCF file associated with the same chromosome as the GTF file
     '''
     ##extract relevant gene info
     gene_id = gene['gene_id']
@@ -151,15 +136,13 @@ def publishToStreams(gene, chainName, multichainLoc, datadir, chrom, variantFile
     streamName = chrom
     streamKeys = gene_id, gene_name, gene_feature
     values = gene[['start', 'end', 'gene_type','strand']].to_dict()
-    values = str(values).replace("\'", '"')
-    streamValues = '{'+'"json":{}'.format(values) +'}'
+    streamValues = {'json': values}
     #publishToGeneStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues)
     
     ##extract variant info from VCF file related to that gene (i.e. all positions within start and end of gene)
-    request = 'bcftools query -r {}:{}-{} -f \'%POS \' {}'.format(chrom, position[0], position[1], variantFile)
-    output = subprocess.check_output(request, shell = True)  
-    variants = output.decode('utf-8').split(' ')[:-1]
-    variants = [int(v) for v in variants]
+    first = np.searchsorted(variantPositions, int(position[0]), side = 'left')
+    last = np.searchsorted(variantPositions, int(position[1]), side = 'right')
+    variants = variantPositions[first:last].tolist()
     #BEGIN_NEW#
     ##get annotations
     clinvar =pd.read_csv(f'{annotation_path}/clinvar_annot.txt')
@@ -184,7 +167,7 @@ def publishToStreams(gene, chainName, multichainLoc, datadir, chrom, variantFile
             cadd_annot = list(cadd[cadd['Pos'] == variant].iloc[:,2:].values[0])
             streamValues['cadd'] = cadd_annot
 
-        streamValues = json.dumps({'json': streamValues})
+        streamValues = {'json': streamValues}
 
         publishToVariantStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues)
     #END_NEW#
@@ -198,10 +181,12 @@ def publishGTF(arguments):
     chainName, multichainLoc, datadir, paths = arguments
     for path in paths:
         geneFile, variantFile, chrom = path
+        #positions of the VCF file read once (see regionPlanner) instead of one bcftools query per gene
+        _, variantPositions = streamPositions(variantFile)
         #read in gtf file
         df = pd.read_csv(geneFile, usecols=['seqname','gene_id','feature','start','end', 'gene_type', 'gene_name','strand'])
         df = df.head(5)
-        df.apply(publishToStreams, axis =1, args= (chainName, multichainLoc, datadir, chrom, variantFile))
+        df.apply(publishToStreams, axis =1, args= (chainName, multichainLoc, datadir, chrom, variantPositions))
     return
 
 
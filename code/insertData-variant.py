@@ -30,8 +30,17 @@ import random
 import itertools
 import psutil
 from io import BytesIO, StringIO
+from chainClient import getClient
+from regionPlanner import planRegions, readRegion
+from alleleCounts import AlleleCountStore, openStore
+from insertJournal import InsertJournal
+from personView import transposeGenotypes, chunkDictionary, publishMappingPerson
+from personIds import packPersonIds
+from mafIndex import publishMAFIndex, encodeMAFPayload
 warnings.simplefilter("ignore")
 
+JOURNAL_NAME = 'insertData-variant'
+
 
 # # Variant view
 
@@ -40,10 +49,8 @@ warnings.simplefilter("ignore")
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -51,10 +58,12 @@ def subscribeToStream(chainName, streamName, multichainLoc, datadir):
 
 
 #subscribe to person-variant streams
-def subscribeToStreams(chainName, multichainLoc, datadir):
+def subscribeToStreams(chainName, multichainLoc, datadir, personView = False):
     for i in range(1, 23):
         subscribeToStream(chainName, "chrom_{}".format(i), multichainLoc, datadir)
         subscribeToStream(chainName, "MAF_chrom_{}".format(i), multichainLoc, datadir)
+        if personView:
+            subscribeToStream(chainName, "person_chrom_{}".format(i), multichainLoc, datadir)
     subscribeToStream(chainName, "mappingData_variants", multichainLoc, datadir)
     return
 
@@ -98,51 +107,29 @@ def samplePersons(metaFile, person, sequencing):
     return samples
 
 
+def sampleMetadata(metaFile, person, sequencing):
+    '''
+    Full metadata of the samples returned by samplePersons, needed for the person mapping of the person view
+    '''
+    meta = pd.read_csv(metaFile)
+    meta = meta[meta['sequence'] == sequencing].iloc[:person]
+    meta['id'] = meta['id'].astype(str)
+    return meta
+
+
 # In[6]:
 
 
 def extractPositions(variantFile):
     '''
-    Extract the positions in the VCF file -> this is needed to efficiently extract data using
+    Split the VCF file into position regions -> this is needed to efficiently extract data using
     bcftools query while specifying the start:end positions, without this bcftools would load 
     all positions at once which would be too large to fit in memory
+    The regions cover the whole chromosome and are planned from the tabix/csi index (see regionPlanner)
     Input:
         variantFiles - files to be added (one per chromosome)
     '''
-    #get chrom
-    request = 'bcftools query -f \'%CHROM\n\' {} | head -n 1'.format(variantFile)
-    output = subprocess.check_output(request, shell = True) 
-    chrom = output.decode('utf-8').split('\n')[0]
-    
-    #get first position
-    request = 'bcftools query -f \'%POS\n\' {} | head -n 1'.format(variantFile)
-    output = subprocess.check_output(request, shell = True)
-    positions = [output.decode('utf-8').split('\n')[0]]
-    
-    #get every 100th positions
-    request = "bcftools query -f \'%POS\n\' {} | head -100000 |  awk \'NR % 100 == 0\'".format(variantFile)
-    output = subprocess.check_output(request, shell = True)
-    positions.extend(output.decode('utf-8').split('\n'))
-
-    
-    #chunk the data to be uploaded
-    s = 5
-    positions_split = np.array_split(positions, s)
-    pos_regions = {}
-    
-    #create file that links together the chunked regions
-    last = positions[0]
-    for i, split in enumerate(positions_split):
-        pos_regions[i] = [last, split[-1]]
-        last = split[-1]
-    
-    
-    #get last position
-    request = 'bcftools query -f \'%POS\n\' {} | head -100000 | tail -n 1'.format(variantFile)
-    output = subprocess.check_output(request, shell = True)
-    last = output.decode('utf-8').split('\n')[0]
-    pos_regions[s-1][-1] = last
-   
+    chrom, pos_regions = planRegions(variantFile)
     return (chrom, pos_regions)
 
 
@@ -200,52 +187,78 @@ def extractRelevantGenotypes(row):
     return relevantGenotypes
 
 
+# In[54]:
+
+
+def bucketGenotypes(df):
+    '''
+    Vectorised extractRelevantGenotypes for a whole region. The GT matrix is parsed once into small int allele arrays and the
+    samples are grouped per position-genotype with a single sort instead of scanning every sample for every genotype.
+    Same matching as extractRelevantGenotypes: a sample is added when its GT string is exactly the larger|smaller allele
+    form of a genotype for that position, 0|0 is skipped
+    Input:
+        df - VCF region indexed by position with ref, alt and one GT column per sample
+    Output:
+        series of {(ref, alt, gt): [sample_ids]} per position, positions with no samples are removed
+    '''
+    samples = df.columns.drop(['ref', 'alt'])
+    refs, alts = df['ref'].tolist(), df['alt'].tolist()
+    num_alts = np.array([str(alt).count(',') + 1 for alt in alts])
+    ##parse every distinct GT string once then map back onto the matrix (code -1 is missing data -> last slot)
+    codes, uniques = pd.factorize(df[samples].to_numpy().ravel())
+    first = np.full(len(uniques) + 1, -1, dtype = np.int16)
+    second = np.full(len(uniques) + 1, -1, dtype = np.int16)
+    for i, gt in enumerate(uniques):
+        alleles = gt.split('|') if isinstance(gt, str) else []
+        if len(alleles) == 2 and all(a.isdigit() for a in alleles) and gt == '{}|{}'.format(int(alleles[0]), int(alleles[1])):
+            first[i], second[i] = int(alleles[0]), int(alleles[1])
+    first = first[codes].reshape(len(df), len(samples))
+    second = second[codes].reshape(len(df), len(samples))
+    ##keep larger|smaller genotypes (not 0|0) whose alleles exist at that position
+    valid = (first >= second) & (first > 0) & (first <= num_alts[:, None])
+    rows, cols = np.nonzero(valid)
+    ##sorting on (row, smaller allele, larger allele) gives the same genotype order as getAllelesPosition
+    key = (rows.astype(np.int64) << 32) + (second[rows, cols].astype(np.int64) << 16) + first[rows, cols]
+    order = np.argsort(key, kind = 'stable')
+    group_keys, starts = np.unique(key[order], return_index = True)
+    results = [{} for _ in range(len(df))]
+    for group_key, sample_idx in zip(group_keys, np.split(cols[order], starts[1:])):
+        row, gt = divmod(int(group_key), 1 << 32)
+        results[row][(refs[row], alts[row], '{}|{}'.format(gt & 0xFFFF, gt >> 16))] = samples[sample_idx].tolist()
+    alt_genotypes = pd.Series(results, index = df.index, dtype = object)
+    return alt_genotypes[[len(gt) > 0 for gt in results]]
+
+
 # In[61]:
 
 
-def extractVariant(variantFile, positions, pos_region, sample_person, colnames, chrom):
+def extractVariant(variantFile, positions, pos_region, sample_person, colnames, chrom, personView = False):
     '''
     Within a position range in the VCF file, extract data on the genotypes and samples
     Input:
         positions - stores all the positions included in the VCF to be added to mapping chain
         pos_region - range of positions for bcftools to query (done to avoid overloading ram)
         colnames - person_ids included (and ref, alt columns)
-        
+        personView - also build the person-view records from the same genotype matrix
+    Output:
+        genotype buckets per position, positions, person-view records ({sample_id: {pos: [ref, alt, gt]}}) or None
     '''
-    samples = list(sample_person)
-    #get variant data
-    #BEGIN_NEW#
-    samples_chunked = [samples[i:i + 1000] for i in range(0, len(samples), 1000)]
-    df = None
-    for sample_chunk in samples_chunked:
-        colnames= ['pos', 'ref', 'alt'] + sample_chunk
-        samples = ','.join(map(str, sample_chunk))
-        request = f'bcftools query -r {chrom}:{pos_region[0]}-{pos_region[1]} -f \'%POS %REF %ALT [ %GT]\n\' -s "{samples}" {variantFile}'
-        output = subprocess.check_output(request, shell = True) 
-        df_partial = pd.read_csv(BytesIO(output), delim_whitespace=True, names=colnames, index_col='pos')
-        
-        if df is None:  
-            df = df_partial
-        else:
-            df = pd.concat([df, df_partial.drop(['ref', 'alt'], axis=1)], axis=1)
-    #END_NEW#
+    #get variant data (samples are read in chunks of 1000)
+    df = readRegion(variantFile, chrom, pos_region, sample_person)
     #keep track of positions added (for mapping)
     pos_ref_alt = [f'{pos}:{ref}:{alt}' for pos, ref, alt in zip(df.index, df['ref'],df['alt'])] #NEW_LINE#
     positions.extend(pos_ref_alt) #NEW_LINE#
-    #get dictionary of samples associated with each genotype
-    alt_genotypes = pd.DataFrame(df.apply(extractRelevantGenotypes, axis = 1))
-    #wrangle the dataset to be genotype:sample_ids
-    def filterows(row):
-        return {k:v for k,v in row[0].items() if v}
-    alt_genotypes = alt_genotypes.apply(filterows, axis = 1)
-    ##filter out any genotypes that have no samples
-    return alt_genotypes[alt_genotypes != {}], positions
+    #get dictionary of samples associated with each genotype (genotypes and positions with no samples are dropped)
+    alt_genotypes = bucketGenotypes(df)
+    #the same matrix read the other way gives the variants of each sample
+    person_variants = transposeGenotypes(df) if personView else None
+    return alt_genotypes, positions, person_variants
 
 
 # In[63]:
 
 
-def publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant):
+def publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant, publisher = None, itemId = None):
     '''
     Request to add data to multichain
     Input:
@@ -253,39 +266,31 @@ def publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKey
         streamKeys: position, ref, alt, genotype, # of samples with this gt, # of samples, # MAF
         streamValues: the person_ids that have this genotype
         publishVariant: Boolean on whether publishing variant data or MAF data
+        publisher: BatchPublisher to queue the item on, if None the item is published in its own transaction
+        itemId: identifier of the item in the insertion journal
         
     '''
     ##if publishing variant data
     if publishVariant == True:
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('chrom_{}'.format(streamName)), 
-            str('["{}", "{}", "{}", "{}", "{}", "{}", "{}"]'.format(streamKeys[0], streamKeys[1], streamKeys[2],
-                                                                    streamKeys[3], streamKeys[4], streamKeys[5],
-                                                                   streamKeys[6])),
-            str('{}'.format(streamValues))]
+        stream = 'chrom_{}'.format(streamName)
+        keys = [str(key) for key in streamKeys[:7]]
     
     ##if publishing MAF data
     else:
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('MAF_chrom_{}'.format(streamName)), 
-            str('["{}"]'.format(streamKeys)),
-            str('{}'.format(streamValues))]
-
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+        stream = 'MAF_chrom_{}'.format(streamName)
+        keys = [str(streamKeys)]
+
+    if publisher is not None:
+        publisher.add(stream, keys, streamValues, itemId)
+    else:
+        getClient(chainName, datadir, multichainLoc).publish(stream, keys, streamValues)
     return
 
 
 # In[13]:
 
 
-def publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom, MAF, sample_size,  prevMAF, publishVariant):
+def publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom, MAF, sample_size,  prevMAF, publishVariant, publisher = None, compact = False):
     '''
     For a given position, get the genotypes associated and samples for each genotype and process data for insertion
     Every genotype is a separate insertion
@@ -294,8 +299,10 @@ def publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom
         chrom: The chromosome VCF file belongs to
         MAF: the current MAF for that position and genotype
         sample_size: the # of samples being added
-        prevMAF: the MAF prior to the new samples being added
+        prevMAF: dictionary of (pos, ref, alt, gt): (count, total) prior to the new samples being added (see alleleCounts)
         publishVariant: Boolean on whether publishing variant data or MAF data  
+        publisher: BatchPublisher that groups the items into publishmulti transactions
+        compact: publish the person ids in the compact encoding of personIds when it is shorter than the JSON array
     '''
     ##for every position loop through data insertion
     for i, row in enumerate(alt_genotypes):
@@ -304,16 +311,13 @@ def publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom
             pos = str(alt_genotypes.index[i])
             ref,alt = gt[0], gt[1]
             allele = str(gt[2])
-            ##if there is no previous MAF (as first data inserstion then just use current sample information)
-            if isinstance(prevMAF, type(False)):
-                count, total = len(row[gt]), sample_size
-            ##else add in current and previous sample information together
+            ##if the position-genotype is already on the chain add in current and previous sample information together
+            if (pos,ref,alt,allele) in prevMAF:
+                prevgt_count, prev_sample_size = prevMAF[(pos,ref,alt,allele)]
+                count, total = len(row[gt])+ prevgt_count, sample_size + prev_sample_size
+            ##else just use current sample information
             else:
-                if (pos,ref,alt,allele) in prevMAF.index:
-                    prevgt_count, prev_sample_size = int(prevMAF.loc[(pos,ref,alt,allele)]['count']), int(prevMAF.loc[(pos,ref,alt,allele)]['total'])
-                    count, total = len(row[gt])+ prevgt_count, sample_size + prev_sample_size
-                else:
-                    count, total = len(row[gt]), sample_size
+                count, total = len(row[gt]), sample_size
 
             ##keep track of the MAF for adding to the MAF streams later
             MAF[(pos,ref,alt,allele)]= [count, total, round(count/total,2)]
@@ -327,63 +331,26 @@ def publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom
                 end = start + chunk_size
                 chunk = genotype_data[start:end]
                 chunk = [int(c) for c in chunk]
-                streamValues = '{"json":' + json.dumps(chunk) + '}' # Create JSON data object
-                streamValues = streamValues.replace("'", '"')
-                publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant)
+                streamValues = {'json': packPersonIds(chunk) if compact else chunk} # Create JSON data object
+                itemId = 'chrom_{}|{}:{}:{}:{}|{}'.format(chrom, pos, ref, alt, allele, start)
+                publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant, publisher, itemId)
     return 
 
 
-# In[ ]:
-
-
-def extractPreviousMAF(chainName, multichainLoc, datadir, chrom):
-    '''
-    Get the existing MAF for all positions being added
-    Input:
-        chrom: The chromosome VCF file belongs to
-    '''
-    ##get the data for each position stored in the stream keys
-    request = 'multichain-cli {} -datadir={} liststreamitems chrom_{} false 9999999999999999'.format(chainName, datadir, chrom)
-    output = subprocess.check_output(request, shell = True)
-    ##parse the output (FIND A BETTER WAY HERE)
-    output = output.decode(
-        'utf-8').replace('\n', '').replace(
-        '[','').replace(']','').replace('},    {','},, {').replace(
-        ' ','').replace('        ','').replace(
-        '    ','').replace('     ','').replace(
-        '"keys":','"keys":[').replace(
-        ',"offchain"','],"offchain"').replace(
-        '"json":','"json":[').replace('},"confirmations"',']},"confirmations"').split(
-        ',,')
-    
-    ##if there is no output then means no samples added for this position
-    if output != ['']:
-        output = [json.loads(x) for x in output]
-
-        #extract old counts and get the latest one using blocktime
-        df = pd.DataFrame(output).loc[:,['keys', 'blocktime']]
-        #create dataframe of positions and MAF information  
-        df[['position', 'ref', 'alt', 'allele', 'count', 'total', 'freq']] = pd.DataFrame(df['keys'].tolist())
-        df['blocktime'] = df['blocktime'].fillna(method='bfill') #NEW_LINE#
-        df = df.iloc[df.groupby(['position', 'allele'])['blocktime'].idxmax(),2:].set_index(['position', 'ref','alt','allele'])
-        return df
-    else:
-        return False
-
-
 # In[22]:
 
 
-def publishMAF(chainName, multichainLoc, datadir, MAF, chrom):
+def publishMAF(chainName, multichainLoc, datadir, MAF, chrom, publisher = None):
     '''
     Publish the MAF taking into account all previous samples and newly added samples
     Input:
         MAF: dictionary that contains the MAF for every position-genotype
+        publisher: BatchPublisher that groups the items into publishmulti transactions
     '''
     ##convert dictionary to dataframe and create multi-index using position-genotype
     if MAF:
         MAF_df = pd.DataFrame.from_dict(MAF, orient='index', columns = ['count', 'total', 'freq'])
-        MAF_df.index = pd.MultiIndex.from_tuples(MAF_df.index)
+        MAF_df.index = pd.MultiIndex.from_tuples(MAF_df.index, names = ['pos', 'ref', 'alt', 'gt'])
         ##calculate the new MAF
         MAF_df['freq'] = MAF_df['count'].div(MAF_df['total'])
         ##bucket the MAFs into ranges and insert into stream
@@ -393,10 +360,11 @@ def publishMAF(chainName, multichainLoc, datadir, MAF, chrom):
             streamName = chrom
             streamKeys = "{}-{}".format(range[0], range[1])
             #BEGIN_NEW#
-            for _, chunk in MAF_group.groupby(np.arange(len(MAF_group)) // 1000):
-                streamValues ='{'+'"json":"{}"'.format(chunk['freq'].to_json().replace('"','').replace("'","")) +'}'
-                streamValues = streamValues.replace("'",'"')
-                publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant = False)
+            for n, chunk in MAF_group.groupby(np.arange(len(MAF_group)) // 1000):
+                ##versioned columnar JSON, see mafIndex.encodeMAFPayload
+                streamValues = {'json': encodeMAFPayload(chunk.reset_index())}
+                itemId = 'MAF_chrom_{}|{}|{}'.format(chrom, streamKeys, n)
+                publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, publishVariant = False, publisher = publisher, itemId = itemId)
             #END_NEW#
     return
 
@@ -405,68 +373,149 @@ def publishMAF(chainName, multichainLoc, datadir, MAF, chrom):
 # In[ ]:
 
 
-def publishPositions(chainName, multichainLoc, datadir, positions, chrom):
+def publishPositions(chainName, multichainLoc, datadir, positions, chrom, publisher = None):
     '''
     Publish the positions added into mapping stream
     Input:
         positions: list of positions added from vcf file
         chrom: chromosome positions come from
+        publisher: BatchPublisher that groups the items into publishmulti transactions
     '''
     #BEGIN_NEW#
     chunk_size = 2000 if len(positions) > 2000 else len(positions)
     position_chunks = [positions[i:i + chunk_size] for i in range(0, len(positions), chunk_size)]
-    for position_chunk in position_chunks:
-        position_chunk = str(position_chunk) #NEW_LINE#
-        position_chunk = position_chunk.replace("'", '"') #NEW_LINE#
+    for n, position_chunk in enumerate(position_chunks):
         streamName = 'mappingData_variants'
         streamKeys = 'chrom_{}'.format(chrom)
-        streamValues = '{'+'"json":{}'.format(position_chunk) + '}'
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('{}'.format(streamName)), 
-            str('{}'.format(streamKeys)),
-            str('{}'.format(streamValues))]
-        procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        procPublish.wait()
+        streamValues = {'json': position_chunk}
+        if publisher is not None:
+            publisher.add(streamName, streamKeys, streamValues, '{}|{}|{}'.format(streamName, streamKeys, n))
+        else:
+            getClient(chainName, datadir, multichainLoc).publish(streamName, streamKeys, streamValues)
     #END_NEW#
 
 
+def publishPersons(chainName, multichainLoc, datadir, person_variants, chrom, pos_region, publisher):
+    '''
+    Publish the person-view records of a region to person_chrom_N, one entry per chunk of a sample's variants
+    Input:
+        person_variants: dictionary of sample_id: {pos: [ref, alt, gt]} from extractVariant
+        pos_region: region the records come from (part of the journal item ids)
+        publisher: BatchPublisher that groups the items into publishmulti transactions
+    '''
+    for sample_id, variants in person_variants.items():
+        ##chunk the dictionary as too large for one entry
+        for n, v in chunkDictionary(variants, SIZE=200).items():
+            itemId = 'person_chrom_{}|{}|{}|{}'.format(chrom, sample_id, pos_region[0], n)
+            publisher.add('person_chrom_{}'.format(chrom), str(sample_id), {'json': v}, itemId)
+    return
+
+
 # In[249]:
 
 
-def publishVariants(fields):
-    chainName, multichainLoc, datadir, variantFiles, person, metaFile, sequencing = fields #NEW_LINE#
+def planTasks(chainName, multichainLoc, datadir, variantFiles, person, metaFile, sequencing, batchSize, batchBytes, countsDir, rebuildCounts, resume, personView = False, compact = False):
     '''
-    Publish the variant data
+    Build the queue of (chromosome, region) insertion tasks for every VCF file
     Input:
         variantFiles - files to be added (one per chromosome)
+        countsDir - directory of the allele count stores
+        rebuildCounts - rebuild the allele count stores from the chain even if they look up to date
+        resume - continuing an interrupted insertion, chromosomes the journal shows as finished are skipped
+        personView - also insert the person view (person_chrom_N) from the same region matrices
+        compact - publish the chrom_N person ids in the compact encoding
+    Output:
+        list of tasks for publishRegion, dictionary of chrom: allele count store
     '''
+    tasks, stores = [], {}
+    #extract samples
+    sample_person = samplePersons(metaFile, person, sequencing) # NEW_LINE#
+    colnames= ['pos', 'ref', 'alt']
+    colnames.extend(list(sample_person))
+    sample_size = len(colnames) - 3
+    journal = InsertJournal(chainName, datadir, JOURNAL_NAME)
     for variantFile in variantFiles:
-        #extract samples
-        sample_person = samplePersons(metaFile, person, sequencing) # NEW_LINE#
-        colnames= ['pos', 'ref', 'alt']
-        colnames.extend(list(sample_person))
-        sample_size = len(colnames) - 3
+        if journal.unitResult('{}|chromosome'.format(variantFile)) is not None:
+            print('Already inserted {}'.format(variantFile))
+            continue
         #split into groups and extract relevant variants
         chrom, pos_regions = extractPositions(variantFile)
-        #store the MAF for all variants and extract old MAFs
-        MAF = {}
-        prevMAF_df = extractPreviousMAF(chainName, multichainLoc, datadir, chrom)
-        ##store all positions
-        positions = []
-        for pos_region in list(pos_regions.values())[:len(pos_regions.values())]:
-            ##insert variant data
-            alt_genotypes, positions = extractVariant(variantFile, positions, pos_region, sample_person, colnames, chrom)
-            publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom, MAF, sample_size, prevMAF_df, publishVariant = True )
-        ##publish MAF data
-        publishMAF(chainName, multichainLoc, datadir, MAF, chrom)
-        ##publish mapping of positions added
-        publishPositions(chainName, multichainLoc, datadir, positions, chrom)
-
-        print('Inserted {}'.format(variantFile))
+        #allele counts of previous insertions, only rebuilt from the chain if missing or out of date
+        #when resuming the chain already holds part of this insertion so the counts must not be rebuilt from it
+        stores[chrom] = openStore(chainName, datadir, chrom, multichainLoc, countsDir, rebuildCounts and not resume, checkStale = not resume)
+        for region, pos_region in pos_regions.items():
+            last = region == len(pos_regions) - 1
+            tasks.append((chainName, multichainLoc, datadir, variantFile, chrom, pos_region, last, sample_person,
+                          colnames, sample_size, batchSize, batchBytes, countsDir, personView, compact))
+    return tasks, stores
 
+
+def publishRegion(task):
+    '''
+    Publish the variant data of one region. Positions are never split between regions so the MAF of every
+    position-genotype is complete within the region and the results can be merged by the caller
+    Input:
+        task - tuple created by planTasks
+    Output:
+        variantFile, chrom, whether it is the last region of the file, MAF of the region, positions added
+    '''
+    chainName, multichainLoc, datadir, variantFile, chrom, pos_region, last, sample_person, colnames, sample_size, batchSize, batchBytes, countsDir, personView, compact = task
+    journal = InsertJournal(chainName, datadir, JOURNAL_NAME)
+    unitId = '{}|{}-{}'.format(variantFile, pos_region[0], pos_region[1])
+    ##region finished in a previous run, only its results are needed
+    result = journal.unitResult(unitId)
+    if result is not None:
+        journal.close()
+        return variantFile, chrom, last, {tuple(key): value for key, value in result['MAF']}, result['positions']
+    MAF = {}
+    alt_genotypes, positions, person_variants = extractVariant(variantFile, [], pos_region, sample_person, colnames, chrom, personView)
+    ##previous counts of only the position-genotypes in this region
+    store = AlleleCountStore(chainName, datadir, chrom, multichainLoc, countsDir)
+    prevMAF = store.lookup((str(pos), ref, alt, str(gt)) for pos, row in alt_genotypes.items() for ref, alt, gt in row)
+    store.close()
+    ##insert variant data, remaining items are sent when the block exits. Items already in the journal are skipped
+    with getClient(chainName, datadir, multichainLoc).batchPublisher(batchSize, batchBytes, journal) as publisher:
+        publishToDataStreams(chainName, multichainLoc, datadir, alt_genotypes, chrom, MAF, sample_size, prevMAF, publishVariant = True, publisher = publisher, compact = compact)
+        if personView:
+            publishPersons(chainName, multichainLoc, datadir, person_variants, chrom, pos_region, publisher)
+    journal.finishUnit(unitId, {'MAF': [[list(key), value] for key, value in MAF.items()], 'positions': positions})
+    journal.close()
+    return variantFile, chrom, last, MAF, positions
+
+
+def publishVariants(chainName, multichainLoc, datadir, tasks, stores, workers, batchSize, batchBytes):
+    '''
+    Publish the variant data, regions of all chromosomes are shared out over one pool of workers so a large chromosome
+    uses every worker. Once all regions of a chromosome are in, its merged MAF and positions are published
+    Input:
+        tasks - (chromosome, region) tasks from planTasks
+        stores - allele count store of each chromosome, updated once the chromosome is inserted
+        workers - number of worker processes
+    '''
+    MAFs, positions = {}, {}
+    journal = InsertJournal(chainName, datadir, JOURNAL_NAME)
+    pool = multiprocessing.Pool(workers)
+    with getClient(chainName, datadir, multichainLoc).batchPublisher(batchSize, batchBytes, journal) as publisher:
+        ##imap returns the regions in task order so positions keep their order within a chromosome
+        for variantFile, chrom, last, MAF, region_positions in pool.imap(publishRegion, tasks):
+            MAFs.setdefault(chrom, {}).update(MAF)
+            positions.setdefault(chrom, []).extend(region_positions)
+            if last:
+                ##publish MAF data
+                MAF = MAFs.pop(chrom)
+                publishMAF(chainName, multichainLoc, datadir, MAF, chrom, publisher)
+                ##record the new counts, chrom_N is fully published by the workers at this point
+                stores[chrom].update(MAF)
+                stores[chrom].markSynced()
+                ##sorted MAF index of the chromosome, only the shards changed by this insertion are published
+                publishMAFIndex(chainName, multichainLoc, datadir, chrom, stores[chrom], publisher)
+                ##publish mapping of positions added
+                publishPositions(chainName, multichainLoc, datadir, positions.pop(chrom), chrom, publisher)
+                publisher.flush()
+                journal.finishUnit('{}|chromosome'.format(variantFile))
+                print('Inserted {}'.format(variantFile))
+    pool.close()
+    pool.join()
     return
 
 
@@ -480,30 +529,48 @@ def main():
     parser.add_argument("-vf", "--variantfile", help = "variant files to add", default = "all")
     parser.add_argument("-np", "--numberPeople", help = "number of people to add", default = "100")
     parser.add_argument("-sq", "--sequencing", help = "sequencing type") #NEWLINE
+    parser.add_argument("-bs", "--batchSize", type = int, help = "stream items per publishmulti transaction", default = None)
+    parser.add_argument("-bb", "--batchBytes", type = int, help = "approximate maximum bytes per publishmulti transaction", default = None)
+    parser.add_argument("-wk", "--workers", type = int, help = "number of worker processes inserting regions", default = 4)
+    parser.add_argument("-cd", "--countsDir", help = "directory of the allele count stores", default = None)
+    parser.add_argument("-rc", "--rebuildCounts", action = "store_true", help = "rebuild the allele count stores from the chain")
+    parser.add_argument("--resume", action = "store_true", help = "resume an interrupted insertion using the journal")
+    parser.add_argument("-cp", "--compactIds", action = "store_true", help = "publish chrom_N person ids in the compact (delta/bitmap) encoding")
+    parser.add_argument("-pv", "--personView", action = "store_true", help = "also insert the person view (person_chrom_N) in the same pass")
     args = parser.parse_args()
 
     start = time.time()
     
-    cpu = multiprocessing.cpu_count() * 2
     person = int(args.numberPeople)
-    cpu = 4
+    cpu = args.workers
     print('CPUs available: {}'.format(cpu))
     
     try:
-        subscribeToStreams(args.chainName, args.multichainLoc, args.datadir)
+        subscribeToStreams(args.chainName, args.multichainLoc, args.datadir, args.personView)
         print('Subscribed to streams') 
         
         paths = loadFilePaths(args.dataPath, args.variantfile)
         
-        cpu = min(cpu, len(paths))
-        paths_split = np.array_split(paths, cpu)
-        arguments = []
-        for paths_split_ins in paths_split:
-            arguments.append((args.chainName, args.multichainLoc, args.datadir, paths_split_ins, person, args.metafile, args.sequencing)) #NEW_LINE#
-        pool = multiprocessing.Pool(cpu)
-        pool.map(publishVariants, arguments)
-        pool.close()
-        pool.join()
+        ##check the items that were in flight when the previous run stopped, otherwise start a new journal
+        journal = InsertJournal(args.chainName, args.datadir, JOURNAL_NAME)
+        if args.resume:
+            found, removed = journal.recover(getClient(args.chainName, args.datadir, args.multichainLoc))
+            print('Resuming: {} in-flight items were published, {} will be published again'.format(found, removed))
+        else:
+            journal.reset()
+        ##person mapping of the person view is published once for the whole insertion
+        if args.personView and journal.unitResult('personMapping') is None:
+            meta = sampleMetadata(args.metafile, person, args.sequencing)
+            publishMappingPerson(args.chainName, args.multichainLoc, args.datadir, meta)
+            journal.finishUnit('personMapping', True)
+        journal.close()
+        
+        ##queue of (chromosome, region) tasks shared by all workers
+        tasks, stores = planTasks(args.chainName, args.multichainLoc, args.datadir, paths, person, args.metafile,
+                                  args.sequencing, args.batchSize, args.batchBytes, args.countsDir, args.rebuildCounts, args.resume,
+                                  args.personView, args.compactIds)
+        cpu = max(1, min(cpu, len(tasks)))
+        publishVariants(args.chainName, args.multichainLoc, args.datadir, tasks, stores, cpu, args.batchSize, args.batchBytes)
         
 
         
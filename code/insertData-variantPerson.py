@@ -27,10 +27,16 @@ from io import BytesIO
 from itertools import islice
 warnings.simplefilter("ignore")
 import persons
+from chainClient import getClient
+from insertJournal import InsertJournal
+from personView import transposeGenotypes, chunkDictionary, publishMappingPerson
+from regionPlanner import planRegions, readRegion
 
 # Read environmental variables
 NTASKS = int(os.environ.get('NTASKS', 1))
 JOB_ID = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0))
+# one journal per array task as every task inserts its own samples
+JOURNAL_NAME = 'insertData-variantPerson_{}'.format(JOB_ID)
 
 
 
@@ -39,10 +45,8 @@ JOB_ID = int(os.environ.get('SLURM_ARRAY_TASK_ID', 0))
 
 #Given a chain name and the name of the new stream, subscribe to that stream
 def subscribeToStream(chainName, streamName, multichainLoc, datadir):
-    subscribeStreamCommand=multichainLoc+'multichain-cli {} -datadir={} subscribe {}'.format(chainName,datadir,streamName)
     #subscribe to the stream
-    procSubscribe = subprocess.Popen(subscribeStreamCommand.split(), stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procSubscribe.wait()
+    getClient(chainName, datadir, multichainLoc).subscribe(streamName)
     return
 
 
@@ -143,149 +147,99 @@ def extractPersonVariants(file, sample_id):
         return chrom , False
 
 
-# In[26]:
-
-
-def chunkDictionary(values_dict, SIZE=2000):
-    '''
-    chunk the person variant dictionary as its too large for a single entry
-    Input:
-        values_dict: person variant dictionary from extractPersonVariants
-    '''
-    def chunks(values_dict, SIZE=2000):
-        it = iter(values_dict)
-        for i in range(0, len(values_dict), SIZE):
-            yield {k:values_dict[k] for k in islice(it, SIZE)}
-    
-    split_variants = {}
-    for i, chunk in enumerate(chunks(values_dict, SIZE = 2000)):
-        split_variants[i] = chunk
-    return split_variants
-
 # In[27]:
 
 
-def publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues):
+def publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues, journal = None, itemId = None):
     '''
     Publish person entry to field
     Input:
         streamName: chromosome being added
         streamKeys: person_id
         streamValues: all the variants:genotype for that person 
+        journal: optional InsertJournal, the entry is skipped if itemId was already published
     '''
-    publishCommand = [multichainLoc+'multichain-cli', 
-        str('{}'.format(chainName)), 
-        str('-datadir={}'.format(datadir)),
-        'publish',
-        str('person_chrom_{}'.format(streamName)), 
-        str('{}'.format(streamKeys)),
-        str('{}'.format(streamValues))]
-    procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-    procPublish.wait()
+    client = getClient(chainName, datadir, multichainLoc)
+    if journal is not None:
+        journal.publish(client, itemId, 'person_chrom_{}'.format(streamName), str(streamKeys), streamValues)
+    else:
+        client.publish('person_chrom_{}'.format(streamName), str(streamKeys), streamValues)
     return
 
 
-# In[28]:
+# In[29]:
 
 
-def publishMappingPerson(chainName, multichainLoc, datadir, meta):
+def publishSampleBlock(chainName, multichainLoc, datadir, variantFile, pos_regions, contig, block, journal):
     '''
-    Publish the samples that were added during this insertion
+    Publish the variants of a block of samples reading the VCF one region at a time for the whole block, instead of
+    one full pass of the file per sample. Memory is bounded by the region size times the block size
     Input:
-        samples: List of all sample ID in file
+        pos_regions - regions of the VCF from planRegions
+        contig - contig of the regions
+        block - sample ids read together
+        journal - InsertJournal, chunks already published are skipped
     '''
-    # Benchmarking. Only publish from the main node
-    if int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) > 0:
-        print("Skipping publishToMappingStream in worker nodes")
-        return
-    samples = list(meta['id'].values)
-    
-    num_groups = 1 + len(samples) // 3000
-    samples_split = np.array_split(samples, num_groups)
-    samples_split = [list(s) for s in samples_split]
-    for s in samples_split:
-        streamName = 'mappingData_variants'
-        streamKeys = 'samples'
-        streamValues = '{'+'"json":{}'.format(json.dumps(s)) + '}'
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('{}'.format(streamName)), 
-            str('{}'.format(streamKeys)),
-            str('{}'.format(streamValues))]
-    
-    
-        procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        procPublish.wait()
-    
-    ## person mapping
-    for i, row in meta.iterrows():
-        streamName = 'mappingData_variants'
-        streamKeys = f"{row['id']}, {row['company']}, {row['seq_machine']}, {row['seq_protocol']}, {str(row['coverage'])}, {row['alignment_protocol']}, {row['variant_calling']}"
-        streamValues = '{'+'"json":{}'+ '}'
-        publishCommand = [multichainLoc+'multichain-cli', 
-            str('{}'.format(chainName)), 
-            str('-datadir={}'.format(datadir)),
-            'publish',
-            str('{}'.format(streamName)), 
-            str('{}'.format(streamKeys)),
-            str('{}'.format(streamValues))]
-        procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-        procPublish.wait()
-
-    ## by sequence
-    for seq in meta['sequence'].unique():
-        samples_seq = list(meta['id'][meta['sequence'] == seq])
-        num_groups = 1 + len(samples_seq) // 3000
-        samples_split = np.array_split(samples_seq, num_groups)
-        samples_split = [list(s) for s in samples_split]
-        for s in samples_split:
-            streamName = 'mappingData_variants'
-            streamKeys = f'{seq}'
-            streamValues = '{'+'"json":{}'.format(json.dumps(s)) + '}'
-            publishCommand = [multichainLoc+'multichain-cli', 
-                str('{}'.format(chainName)), 
-                str('-datadir={}'.format(datadir)),
-                'publish',
-                str('{}'.format(streamName)), 
-                str('{}'.format(streamKeys)),
-                str('{}'.format(streamValues))]
-
-            procPublish = subprocess.Popen(publishCommand, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            procPublish.wait()
+    with getClient(chainName, datadir, multichainLoc).batchPublisher(journal = journal) as publisher:
+        for pos_region in pos_regions.values():
+            df = readRegion(variantFile, contig, pos_region, block)
+            ##per-sample non-reference variants of the region
+            person_variants = transposeGenotypes(df)
+            del df
+            for sample_id, variants in person_variants.items():
+                ##chunk the dictionary as too large for one entry
+                for n, v in chunkDictionary(variants, SIZE=200).items():
+                    itemId = '{}|{}|{}|{}'.format(variantFile, sample_id, pos_region[0], n)
+                    publisher.add('person_chrom_{}'.format(contig), str(sample_id), {'json': v}, itemId)
     return
 
 
-# In[29]:
-
-
 def publishToDataStreams(fields):
-    chainName, multichainLoc, datadir, metaFile, paths, people, sequencing = fields #NEW_LINE#
+    chainName, multichainLoc, datadir, metaFile, paths, people, sequencing, sampleBlock = fields #NEW_LINE#
     '''
     loop through all samples and add to multichain
     Input:
         mappingFile - path where the person:vcf ID mapping is held
         paths - path for the VCF files being added
+        sampleBlock - number of samples read together per region, 0 reads the file once per sample
     '''
+    journal = InsertJournal(chainName, datadir, JOURNAL_NAME)
     for variantFile in paths:
         #load mapping dictionary and file paths
         meta, samples = metadataPerson(metaFile, sequencing, people) #NEW_LINE#
-        publishMappingPerson(chainName, multichainLoc, datadir, meta)
+        ##samples and chunks already published by an interrupted run are skipped
+        if journal.unitResult('{}|mapping'.format(variantFile)) is None:
+            publishMappingPerson(chainName, multichainLoc, datadir, meta)
+            journal.finishUnit('{}|mapping'.format(variantFile), True)
+        if sampleBlock > 0:
+            contig, pos_regions = planRegions(variantFile)
+            remaining = [sample_id for sample_id in samples if journal.unitResult('{}|{}'.format(variantFile, sample_id)) is None]
+            for i in range(0, len(remaining), sampleBlock):
+                block = remaining[i:i + sampleBlock]
+                publishSampleBlock(chainName, multichainLoc, datadir, variantFile, pos_regions, contig, block, journal)
+                for sample_id in block:
+                    journal.finishUnit('{}|{}'.format(variantFile, sample_id), True)
+            print('Inserted {}'.format(variantFile))
+            continue
         for sample_id in samples:
+            if journal.unitResult('{}|{}'.format(variantFile, sample_id)) is not None:
+                continue
             streamName, streamValues = extractPersonVariants(variantFile, sample_id)
             ## only submit if have non ./. alleles
             if isinstance(streamValues, dict):
                 ##chunk the dictionary as too large for one entry
                 split_variants = chunkDictionary(streamValues, SIZE=200)
-                for v in split_variants.values():
+                for n, v in split_variants.items():
                     streamKeys = sample_id
-                    streamValues ='{'+'"json":{}'.format(json.dumps(v)) +'}'#create JSON data object
-                    publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues)
+                    streamValues = {'json': v} #create JSON data object
+                    publishToDataStream(chainName, multichainLoc, datadir, streamName, streamKeys, streamValues,
+                                        journal, '{}|{}|{}'.format(variantFile, sample_id, n))
             else:
                 pass
+            journal.finishUnit('{}|{}'.format(variantFile, sample_id), True)
                     
         print('Inserted {}'.format(variantFile))
+    journal.close()
 
     return
 
@@ -299,6 +253,8 @@ def main():
     parser.add_argument("-vf", "--variantfile", help = "variant files to add", default = "all")
     parser.add_argument("-np", "--numberPeople", help = "number of people to add", default = "100")
     parser.add_argument("-sq", "--sequencing", help = "sequencing type") #NEWLINE
+    parser.add_argument("-sb", "--sampleBlock", type = int, help = "samples read together per VCF region, 0 runs bcftools once per sample", default = 0)
+    parser.add_argument("--resume", action = "store_true", help = "resume an interrupted insertion using the journal")
     
     args = parser.parse_args()
 
@@ -312,12 +268,20 @@ def main():
     try:
         subscribeToStreams(args.chainName, args.multichainLoc, args.datadir)
         print('Subscribed to streams') 
+
+        journal = InsertJournal(args.chainName, args.datadir, JOURNAL_NAME)
+        if args.resume:
+            found, removed = journal.recover(getClient(args.chainName, args.datadir, args.multichainLoc))
+            print('Resuming: {} in-flight items were published, {} will be published again'.format(found, removed))
+        else:
+            journal.reset()
+        journal.close()
         
         paths = loadFilePaths(args.dataPath, args.variantfile)
         paths_split = np.array_split(paths, cpu)
         arguments = []
         for paths_split_ins in paths_split:
-            arguments.append((args.chainName, args.multichainLoc, args.datadir, args.metafile, paths_split_ins, people, args.sequencing))
+            arguments.append((args.chainName, args.multichainLoc, args.datadir, args.metafile, paths_split_ins, people, args.sequencing, args.sampleBlock))
         pool = multiprocessing.Pool(cpu)
         pool.map(publishToDataStreams, arguments)
         pool.close()
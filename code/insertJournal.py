@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+insertJournal.py
+Write-ahead journal for the insertion scripts so that an interrupted insertion can be resumed without publishing
+the same stream item twice. Every item is recorded as pending before it is sent and marked with its txid once
+the node has accepted it. Larger units of work (a region, a sample) are recorded once all their items are in.
+On --resume, pending items are looked up on the chain: found items are marked done, the rest are sent again.
+Usage: from insertJournal import InsertJournal
+       journal = InsertJournal(chainName, datadir, 'insertData-variant')
+       journal.reset() or journal.recover(client)
+       journal.publish(client, itemId, streamName, streamKeys, streamValues)
+'''
+
+import os
+import json
+import sqlite3
+import hashlib
+
+
+def dataDigest(streamValues):
+    '''
+    Digest of a stream item's data used to recognise it on the chain
+    '''
+    return hashlib.sha1(json.dumps(streamValues, sort_keys = True, separators = (',', ':')).encode('utf-8')).hexdigest()
+
+
+class InsertJournal:
+    '''
+    Journal of the items and units published by one insertion script
+    Input:
+        chainName - name of the chain
+        datadir - directory where multichain stores the chain
+        name - name of the insertion script, one journal per script
+        journalDir - directory holding the journals, defaults to <datadir>/<chainName>/journal
+    '''
+    def __init__(self, chainName, datadir, name, journalDir = None):
+        if journalDir is None:
+            journalDir = os.path.join(datadir if datadir else os.path.expanduser('~/.multichain'), chainName, 'journal')
+        os.makedirs(journalDir, exist_ok = True)
+        self.path = os.path.join(journalDir, '{}.sqlite'.format(name))
+        self.connection = sqlite3.connect(self.path, timeout = 120)
+        ##WAL lets the worker processes read while another one writes
+        self.connection.execute('PRAGMA journal_mode=WAL')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS items (id TEXT PRIMARY KEY, stream TEXT, keys TEXT, digest TEXT, txid TEXT)')
+        self.connection.execute('CREATE TABLE IF NOT EXISTS units (id TEXT PRIMARY KEY, result TEXT)')
+        self.connection.commit()
+
+    def reset(self):
+        '''
+        Forget previous runs (used when not resuming)
+        '''
+        self.connection.execute('DELETE FROM items')
+        self.connection.execute('DELETE FROM units')
+        self.connection.commit()
+        return
+
+    ##items
+    def isDone(self, itemId):
+        row = self.connection.execute('SELECT txid FROM items WHERE id = ?', (itemId,)).fetchone()
+        return row is not None and row[0] is not None
+
+    def begin(self, entries):
+        '''
+        Record items as pending before they are sent
+        Input:
+            entries - list of (itemId, streamName, streamKeys, streamValues)
+        '''
+        self.connection.executemany('INSERT OR REPLACE INTO items VALUES (?, ?, ?, ?, NULL)',
+                                    [(itemId, streamName, json.dumps(streamKeys if isinstance(streamKeys, list) else [streamKeys]),
+                                      dataDigest(streamValues)) for itemId, streamName, streamKeys, streamValues in entries])
+        self.connection.commit()
+        return
+
+    def commit(self, itemIds, txid):
+        '''
+        Mark items as confirmed by the transaction that published them
+        '''
+        self.connection.executemany('UPDATE items SET txid = ? WHERE id = ?', [(txid, itemId) for itemId in itemIds])
+        self.connection.commit()
+        return
+
+    def publish(self, client, itemId, streamName, streamKeys, streamValues):
+        '''
+        Publish a single item unless the journal shows it was already published
+        Output:
+            txid of the item
+        '''
+        if self.isDone(itemId):
+            return self.connection.execute('SELECT txid FROM items WHERE id = ?', (itemId,)).fetchone()[0]
+        self.begin([(itemId, streamName, streamKeys, streamValues)])
+        txid = client.publish(streamName, streamKeys, streamValues)
+        self.commit([itemId], txid)
+        return txid
+
+    ##units
+    def unitResult(self, unitId):
+        '''
+        Result stored when the unit finished or None if it has not finished
+        '''
+        row = self.connection.execute('SELECT result FROM units WHERE id = ?', (unitId,)).fetchone()
+        return None if row is None else json.loads(row[0])
+
+    def finishUnit(self, unitId, result = None):
+        self.connection.execute('INSERT OR REPLACE INTO units VALUES (?, ?)', (unitId, json.dumps(result)))
+        self.connection.commit()
+        return
+
+    def recover(self, client):
+        '''
+        Check the items that were in flight when the previous run stopped. Items found on the chain (same keys and data)
+        are marked done, the others are removed from the journal so that they are published again
+        Input:
+            client - MultichainClient of the chain
+        Output:
+            number of in-flight items found on the chain, number removed
+        '''
+        pending = self.connection.execute('SELECT id, stream, keys, digest FROM items WHERE txid IS NULL').fetchall()
+        found, removed, matches = 0, 0, {}
+        for itemId, streamName, streamKeys, digest in pending:
+            streamKeys = json.loads(streamKeys)
+            if (streamName, streamKeys[0]) not in matches:
+                matches[(streamName, streamKeys[0])] = list(client.streamItems(streamName, streamKeys[0]))
+            txid = None
+            for match in matches[(streamName, streamKeys[0])]:
+                if match['keys'] != streamKeys:
+                    continue
+                ##reading the data of a large item fetches it from the item's own output (see chainClient.StreamItem)
+                if dataDigest(match['data']) == digest:
+                    txid = match['txid']
+                    break
+            if txid is not None:
+                self.commit([itemId], txid)
+                found += 1
+            else:
+                self.connection.execute('DELETE FROM items WHERE id = ?', (itemId,))
+                self.connection.commit()
+                removed += 1
+        return found, removed
+
+    def close(self):
+        self.connection.close()
@@ -0,0 +1,222 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+mafIndex.py
+Sorted MAF index of a chromosome, published to MAF_chrom_N next to the fixed MAF buckets. After every insertion the
+frequencies of all position-genotypes (from the local allele count store) are sorted and cut into shards of about
+MAF_SHARD_SIZE entries. Cuts are placed after the entries whose position-genotype hashes to a cut point, so an insertion
+only changes the shards that its new or updated entries leave or join. Each shard is stored as columnar arrays (freq,
+pos, ref, alt, gt, count, total) under a key named after the digest of its content, and only shards that are not already
+on the chain are published. A manifest under key 'index' lists the shards with their [lo, hi] frequency bounds. A query
+reads the latest manifest, fetches only the shards that overlap the requested range and binary-searches them.
+The MAF buckets use the same versioned columnar payload (encodeMAFPayload). decodeMAFPayloads reads it, and the string
+payloads published before it, straight into a typed DataFrame without eval.
+Usage: from mafIndex import publishMAFIndex, queryMAFRange, encodeMAFPayload, decodeMAFPayloads
+       publishMAFIndex(chainName, multichainLoc, datadir, chrom, store, publisher)
+       df = queryMAFRange(chainName, datadir, chrom, 0.01, 0.2)  -> pos, ref, alt, gt, maf (None if no index)
+       df = decodeMAFPayloads([match['data']['json'] for match in matches])  -> pos, ref, alt, gt, maf
+'''
+
+import os
+import json
+import hashlib
+import numpy as np
+import pandas as pd
+from concurrent.futures import ThreadPoolExecutor
+from chainClient import getClient
+
+
+# entries per shard, and the payload layout version readers accept
+MAF_SHARD_SIZE = int(os.environ.get('MAF_SHARD_SIZE', 5000))
+# a run of entries without a cut point is split so no shard holds more than this many times MAF_SHARD_SIZE entries
+MAX_SHARD_FACTOR = 4
+MAF_FORMAT = 1
+MANIFEST_KEY = 'index'
+COLUMNS = ['pos', 'ref', 'alt', 'gt', 'count', 'total']
+MAF_COLUMNS = ['pos', 'ref', 'alt', 'gt', 'maf']
+# one '(pos, ref, alt, gt):freq' entry of a legacy payload (keys were also written as [..] by older pandas)
+LEGACY_ENTRY = r'[\(\[]([^\)\]]*)[\)\]]"?\s*:\s*([-+0-9.eE]+|NaN|null)'
+
+
+def encodeMAFPayload(df):
+    '''
+    Versioned columnar payload of MAF entries
+    Input:
+        df - DataFrame with pos, ref, alt, gt, count, total and freq columns
+    '''
+    payload = {'format': MAF_FORMAT, 'freq': df['freq'].astype(float).tolist()}
+    for column in ['pos', 'ref', 'alt', 'gt']:
+        payload[column] = df[column].astype(str).tolist()
+    for column in ['count', 'total']:
+        payload[column] = df[column].astype(int).tolist()
+    return payload
+
+
+def decodeLegacyMAF(payload):
+    '''
+    Compatibility shim for the payloads published before MAF_FORMAT: the freq series to_json with the quotes stripped
+    e.g. '{(100, A, T, 1|0):0.25,...}', or the same keys still quoted. Parsed with a regular expression, never evaluated
+    '''
+    if isinstance(payload, dict):
+        payload = '{' + ','.join('{}:{}'.format(key, value) for key, value in payload.items()) + '}'
+    entries = pd.Series([payload], dtype = object).str.extractall(LEGACY_ENTRY)
+    if entries.empty:
+        return pd.DataFrame(columns = MAF_COLUMNS)
+    parts = entries[0].str.replace('[\\s\'"]', '', regex = True).str.split(',')
+    ##alt may itself hold commas (multi-allelic sites), it is everything between ref and gt
+    return pd.DataFrame({'pos': parts.str[0], 'ref': parts.str[1], 'alt': parts.str[2:-1].str.join(','), 'gt': parts.str[-1],
+                         'maf': pd.to_numeric(entries[1], errors = 'coerce')}).reset_index(drop = True)
+
+
+def decodeMAFPayloads(payloads):
+    '''
+    Decode MAF_chrom_N bucket or shard payloads
+    Input:
+        payloads - the 'json' values of the items, in stream order
+    Output:
+        DataFrame with pos, ref, alt, gt (str) and maf (float), the latest entry of each position-genotype
+    '''
+    frames = []
+    for payload in payloads:
+        if isinstance(payload, dict) and 'format' in payload:
+            if payload['format'] > MAF_FORMAT:
+                raise ValueError('MAF payload format {} is newer than this reader ({})'.format(payload['format'], MAF_FORMAT))
+            frames.append(pd.DataFrame({'pos': payload['pos'], 'ref': payload['ref'], 'alt': payload['alt'], 'gt': payload['gt'], 'maf': payload['freq']}))
+        else:
+            frames.append(decodeLegacyMAF(payload))
+    if not frames:
+        return pd.DataFrame({column: pd.Series(dtype = float if column == 'maf' else str) for column in MAF_COLUMNS})
+    MAF_df = pd.concat(frames, ignore_index = True).astype({'pos': str, 'ref': str, 'alt': str, 'gt': str, 'maf': float})
+    ##items are oldest first, a position-genotype republished by a later insertion keeps its newest MAF
+    return MAF_df.drop_duplicates(['pos', 'ref', 'alt', 'gt'], keep = 'last').reset_index(drop = True)
+
+
+def shardBounds(df, shardSize):
+    '''
+    Content defined cut points of the sorted entries: a shard ends after each entry whose position-genotype hashes to 0
+    modulo shardSize, so the cuts do not move when entries elsewhere are added or change frequency
+    Output:
+        array of shard boundaries, starting at 0 and ending at len(df)
+    '''
+    hashes = pd.util.hash_pandas_object(df[['pos', 'ref', 'alt', 'gt']], index = False).to_numpy()
+    cuts = np.flatnonzero(hashes % np.uint64(shardSize) == 0) + 1
+    bounds = np.unique(np.concatenate([[0], cuts, [len(df)]]))
+    ##long runs without a cut point are split evenly, which only changes the shards of that run
+    limit = shardSize * MAX_SHARD_FACTOR
+    split = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        split.extend(np.linspace(start, end, -(-(end - start) // limit) + 1).astype(int)[:-1])
+    return np.array(split + [len(df)])
+
+
+def buildMAFIndex(counts, shardSize = None):
+    '''
+    Sort the position-genotype frequencies and cut them into content addressed shards
+    Input:
+        counts - rows of (pos, ref, alt, gt, count, total) for every position-genotype of the chromosome
+        shardSize - average entries per shard, defaults to MAF_SHARD_SIZE
+    Output:
+        manifest dictionary and list of (shard key, shard payload)
+    '''
+    shardSize = shardSize if shardSize else MAF_SHARD_SIZE
+    df = pd.DataFrame(list(counts), columns = COLUMNS)
+    df[['pos', 'ref', 'alt', 'gt']] = df[['pos', 'ref', 'alt', 'gt']].astype(str)
+    df[['count', 'total']] = df[['count', 'total']].astype(np.int64)
+    df['freq'] = df['count'] / df['total']
+    ##ties are ordered by position-genotype so the same counts always give the same shards
+    df = df.sort_values(['freq', 'pos', 'ref', 'alt', 'gt'], kind = 'stable').reset_index(drop = True)
+    bounds = shardBounds(df, shardSize)
+    manifest = {'format': MAF_FORMAT, 'entries': len(df), 'shards': []}
+    shards = []
+    for start, end in zip(bounds[:-1], bounds[1:]):
+        part = df.iloc[start:end]
+        payload = encodeMAFPayload(part)
+        ##keys are named after the content, a shard that did not change keeps its key and is not published again
+        key = 'shard-{}'.format(hashlib.sha1(json.dumps(payload, sort_keys = True).encode()).hexdigest()[:16])
+        shards.append((key, payload))
+        manifest['shards'].append({'key': key, 'lo': float(part['freq'].iloc[0]), 'hi': float(part['freq'].iloc[-1]), 'count': len(part)})
+    manifest['generation'] = hashlib.sha1(' '.join(shard['key'] for shard in manifest['shards']).encode()).hexdigest()[:12]
+    return manifest, shards
+
+
+def publishMAFIndex(chainName, multichainLoc, datadir, chrom, store, publisher = None, shardSize = None):
+    '''
+    Publish the MAF index of a chromosome built from its allele count store. Only the shards that are not in the
+    previous manifest are published, the new manifest refers to the unchanged shards by their existing keys
+    Input:
+        store - AlleleCountStore holding the counts after this insertion
+        publisher: BatchPublisher that groups the items into publishmulti transactions
+    '''
+    counts = store.allCounts()
+    if not counts:
+        return
+    manifest, shards = buildMAFIndex(counts, shardSize)
+    previous = latestManifest(chainName, datadir, chrom, multichainLoc)
+    if previous is not None and previous.get('generation') == manifest['generation']:
+        return
+    published = set(shard['key'] for shard in previous['shards']) if previous is not None else set()
+    stream = 'MAF_chrom_{}'.format(chrom)
+    def publish(key, payload, itemId):
+        if publisher is not None:
+            publisher.add(stream, key, {'json': payload}, itemId)
+        else:
+            getClient(chainName, datadir, multichainLoc).publish(stream, key, {'json': payload})
+    for key, payload in shards:
+        if key not in published:
+            publish(key, payload, '{}|{}'.format(stream, key))
+    ##the manifest goes last so it never points at shards that are not on the chain
+    publish(MANIFEST_KEY, manifest, '{}|{}|{}'.format(stream, MANIFEST_KEY, manifest['generation']))
+    return
+
+
+def latestManifest(chainName, datadir, chrom, multichainLoc = ''):
+    '''
+    The newest manifest of a chromosome's MAF index, or None if the chromosome was inserted before the index existed
+    '''
+    item = getClient(chainName, datadir, multichainLoc).latestItem('MAF_chrom_{}'.format(chrom), MANIFEST_KEY)
+    if item is None:
+        return None
+    manifest = item['data']['json']
+    if manifest.get('format', 0) > MAF_FORMAT:
+        raise ValueError('MAF index format {} is newer than this reader ({})'.format(manifest.get('format'), MAF_FORMAT))
+    return manifest
+
+
+def overlappingShards(manifest, lo, hi):
+    '''
+    Shards whose [lo, hi] bounds overlap the range, shards are in frequency order so they are a contiguous run
+    '''
+    los = np.array([shard['lo'] for shard in manifest['shards']])
+    his = np.array([shard['hi'] for shard in manifest['shards']])
+    first = np.searchsorted(his, lo, 'left')
+    last = np.searchsorted(los, hi, 'right')
+    return manifest['shards'][first:last]
+
+
+def queryMAFRange(chainName, datadir, chrom, lo, hi, multichainLoc = '', manifest = None):
+    '''
+    Position-genotypes with lo <= MAF <= hi
+    Output:
+        DataFrame with pos, ref, alt, gt and maf in MAF order, or None if the chromosome has no MAF index
+    '''
+    manifest = manifest if manifest is not None else latestManifest(chainName, datadir, chrom, multichainLoc)
+    if manifest is None:
+        return None
+    client = getClient(chainName, datadir, multichainLoc)
+    stream = 'MAF_chrom_{}'.format(chrom)
+    shards = overlappingShards(manifest, lo, hi)
+    def fetch(shard):
+        return client.latestItem(stream, shard['key'])['data']['json']
+    with ThreadPoolExecutor(max_workers = max(1, min(client.poolSize, len(shards)))) as executor:
+        payloads = list(executor.map(fetch, shards))
+    parts = []
+    for payload in payloads:
+        freq = np.asarray(payload['freq'], dtype = np.float64)
+        start, end = np.searchsorted(freq, lo, 'left'), np.searchsorted(freq, hi, 'right')
+        part = pd.DataFrame({column: payload[column][start:end] for column in ['pos', 'ref', 'alt', 'gt']})
+        part['maf'] = freq[start:end]
+        parts.append(part)
+    if not parts:
+        return pd.DataFrame(columns = ['pos', 'ref', 'alt', 'gt', 'maf'])
+    return pd.concat(parts, ignore_index = True)
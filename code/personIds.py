@@ -0,0 +1,106 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+personIds.py
+Compact encoding of the person-id lists stored in the chrom_N streams. Instead of a JSON array of ids the payload is a
+small versioned object holding the ids base64 encoded, either as delta varints of the sorted ids or as a bitmap over
+[start, start + bits), whichever is smaller. Readers go through decodePersonIds which also accepts the plain JSON
+arrays published before, so both formats can live in the same stream.
+Usage: from personIds import packPersonIds, decodePersonIds
+       streamValues = {'json': packPersonIds(ids)}
+       ids = decodePersonIds(match['data']['json'])
+'''
+
+import json
+import base64
+import numpy as np
+
+
+# bumped when the payload layout changes, readers refuse payloads newer than they know
+PAYLOAD_VERSION = 1
+
+
+def _encodeVarints(values):
+    '''
+    LEB128 varints (7 bits per byte, high bit set on all but the last byte) of non-negative integers
+    '''
+    values = np.asarray(values, dtype = np.uint64)
+    nbytes = 1 + sum((values >= np.uint64(1 << (7 * k))).astype(np.int64) for k in range(1, 10))
+    ends = np.cumsum(nbytes)
+    owner = np.repeat(np.arange(len(values)), nbytes)
+    position = np.arange(ends[-1]) - np.repeat(ends - nbytes, nbytes) if len(values) else np.array([], dtype = np.int64)
+    out = ((values[owner] >> (7 * position).astype(np.uint64)) & np.uint64(0x7F)).astype(np.uint8)
+    ##continuation bit on every byte except the last of each value
+    out[position < nbytes[owner] - 1] |= 0x80
+    return out.tobytes()
+
+
+def _decodeVarints(data):
+    buffer = np.frombuffer(data, dtype = np.uint8)
+    if len(buffer) == 0:
+        return np.array([], dtype = np.int64)
+    last = (buffer & 0x80) == 0
+    owner = np.concatenate([[0], np.cumsum(last[:-1])])
+    starts = np.flatnonzero(np.concatenate([[True], last[:-1]]))
+    position = np.arange(len(buffer)) - starts[owner]
+    parts = (buffer & 0x7F).astype(np.uint64) << (7 * position).astype(np.uint64)
+    return np.add.reduceat(parts, starts).astype(np.int64)
+
+
+def encodePersonIds(ids):
+    '''
+    Encode a list of integer person ids
+    Input:
+        ids - person ids (order is not kept, duplicates are removed)
+    Output:
+        dictionary with format, encoding, count and the base64 ids (plus start for the bitmap encoding)
+    '''
+    ids = np.unique(np.asarray(ids, dtype = np.int64))
+    if len(ids) and ids[0] < 0:
+        raise ValueError('person ids must be non-negative to be encoded')
+    deltas = np.diff(ids, prepend = 0)
+    delta = _encodeVarints(deltas)
+    payload = {'format': PAYLOAD_VERSION, 'count': int(len(ids))}
+    ##a bitmap wins for common variants where the carriers are dense over the id range
+    span = int(ids[-1] - ids[0] + 1) if len(ids) else 0
+    if len(ids) and (span + 7) // 8 < len(delta):
+        bits = np.zeros(span, dtype = np.uint8)
+        bits[ids - ids[0]] = 1
+        payload.update({'encoding': 'bitmap', 'start': int(ids[0]), 'ids': base64.b64encode(np.packbits(bits, bitorder = 'little').tobytes()).decode('ascii')})
+    else:
+        payload.update({'encoding': 'delta', 'ids': base64.b64encode(delta).decode('ascii')})
+    return payload
+
+
+def packPersonIds(ids):
+    '''
+    Payload for a list of person ids: the compact encoding, or the plain JSON array when that is shorter (rare variants
+    carried by a handful of people)
+    '''
+    encoded = encodePersonIds(ids)
+    plain = [int(i) for i in ids]
+    return plain if len(json.dumps(plain)) <= len(json.dumps(encoded)) else encoded
+
+
+def decodePersonIds(payload):
+    '''
+    Decode the person ids of a chrom_N item
+    Input:
+        payload - the 'json' value of the item data, a list of ids (original format) or an encoded dictionary
+    Output:
+        list of person ids
+    '''
+    if not isinstance(payload, dict):
+        return payload
+    if payload.get('format', 0) > PAYLOAD_VERSION:
+        raise ValueError('person id payload format {} is newer than this reader ({})'.format(payload.get('format'), PAYLOAD_VERSION))
+    data = base64.b64decode(payload['ids'])
+    if payload['encoding'] == 'delta':
+        ids = np.cumsum(_decodeVarints(data))
+    elif payload['encoding'] == 'bitmap':
+        bits = np.unpackbits(np.frombuffer(data, dtype = np.uint8), bitorder = 'little')
+        ids = np.flatnonzero(bits) + payload['start']
+    else:
+        raise ValueError('unknown person id encoding {}'.format(payload['encoding']))
+    return ids.tolist()
@@ -0,0 +1,134 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+personView.py
+Build and publish the person-view (person_chrom_N) records of a VCF. The records of many samples are taken from one
+region genotype matrix (see regionPlanner.readRegion) instead of reading the VCF once per sample.
+Usage: from personView import transposeGenotypes, chunkDictionary
+       person_variants = transposeGenotypes(df)  -> {sample_id: {pos: [ref, alt, gt]}}
+       for v in chunkDictionary(person_variants[sample_id]).values(): publish {'json': v} to person_chrom_N
+'''
+
+import os
+import numpy as np
+import pandas as pd
+from itertools import islice
+from chainClient import getClient
+
+
+def normaliseGenotype(gt):
+    '''
+    Genotype in the form stored in person_chrom_N (same as extractPersonVariants): missing alleles are read as 0 and
+    heterozygous genotypes are written larger allele first e.g. 0|1 -> 1|0
+    Output:
+        the genotype or None if it has no alternative allele
+    '''
+    if not isinstance(gt, str) or len(gt) < 3 or gt[1] not in '|/':
+        return None
+    alleles = gt.split(gt[1])
+    if len(alleles) != 2:
+        return None
+    alleles = [a.replace('.', '0') for a in alleles]
+    if not all(a.isdigit() for a in alleles) or int(alleles[0]) + int(alleles[1]) == 0:
+        return None
+    if int(alleles[0]) < int(alleles[1]):
+        return '{}|{}'.format(alleles[1], alleles[0])
+    return '{}{}{}'.format(alleles[0], gt[1], alleles[1])
+
+
+def transposeGenotypes(df):
+    '''
+    Turn a region genotype matrix into the non-reference variants of every sample. Every distinct GT string is parsed once
+    and the matrix is walked sample by sample with numpy
+    Input:
+        df - VCF region indexed by position with ref, alt and one GT column per sample
+    Output:
+        dictionary of sample_id: {pos: [ref, alt, gt]}, samples with no variants in the region are left out
+    '''
+    samples = df.columns.drop(['ref', 'alt'])
+    positions = df.index.map(str).to_numpy()
+    refs, alts = df['ref'].to_numpy(), df['alt'].to_numpy()
+    codes, uniques = pd.factorize(df[samples].to_numpy().ravel())
+    ##code -1 (missing value) maps to the last slot which is None
+    normalised = np.array([normaliseGenotype(gt) for gt in uniques] + [None], dtype = object)
+    codes = codes.reshape(len(df), len(samples))
+    keep = np.array([gt is not None for gt in normalised])[codes]
+    ##transposed so the entries come out sample by sample, positions in file order within a sample
+    cols, rows = np.nonzero(keep.T)
+    person_variants = {}
+    bounds = np.searchsorted(cols, np.arange(len(samples) + 1))
+    for i, sample_id in enumerate(samples):
+        sample_rows = rows[bounds[i]:bounds[i + 1]]
+        if len(sample_rows) == 0:
+            continue
+        gts = normalised[codes[sample_rows, i]]
+        person_variants[str(sample_id)] = {pos: [ref, alt, gt] for pos, ref, alt, gt in
+                                           zip(positions[sample_rows], refs[sample_rows], alts[sample_rows], gts)}
+    return person_variants
+
+
+def chunkDictionary(values_dict, SIZE=2000):
+    '''
+    chunk the person variant dictionary as its too large for a single entry
+    Input:
+        values_dict: person variant dictionary from extractPersonVariants
+    '''
+    def chunks(values_dict, SIZE=2000):
+        it = iter(values_dict)
+        for i in range(0, len(values_dict), SIZE):
+            yield {k:values_dict[k] for k in islice(it, SIZE)}
+
+    split_variants = {}
+    for i, chunk in enumerate(chunks(values_dict, SIZE = 2000)):
+        split_variants[i] = chunk
+    return split_variants
+
+
+def publishMappingPerson(chainName, multichainLoc, datadir, meta, publisher = None):
+    '''
+    Publish the samples that were added during this insertion
+    Input:
+        meta: metadata of the samples being added
+        publisher: optional BatchPublisher that groups the items into publishmulti transactions
+    '''
+    # Benchmarking. Only publish from the main node
+    if int(os.environ.get('SLURM_ARRAY_TASK_ID', 0)) > 0:
+        print("Skipping publishToMappingStream in worker nodes")
+        return
+    def publish(streamName, streamKeys, streamValues):
+        if publisher is not None:
+            publisher.add(streamName, streamKeys, streamValues)
+        else:
+            getClient(chainName, datadir, multichainLoc).publish(streamName, streamKeys, streamValues)
+
+    samples = list(meta['id'].values)
+
+    num_groups = 1 + len(samples) // 3000
+    samples_split = np.array_split(samples, num_groups)
+    samples_split = [list(s) for s in samples_split]
+    for s in samples_split:
+        streamName = 'mappingData_variants'
+        streamKeys = 'samples'
+        streamValues = {'json': s}
+        publish(streamName, streamKeys, streamValues)
+
+    ## person mapping
+    for i, row in meta.iterrows():
+        streamName = 'mappingData_variants'
+        streamKeys = f"{row['id']}, {row['company']}, {row['seq_machine']}, {row['seq_protocol']}, {str(row['coverage'])}, {row['alignment_protocol']}, {row['variant_calling']}"
+        streamValues = {'json': {}}
+        publish(streamName, streamKeys, streamValues)
+
+    ## by sequence
+    for seq in meta['sequence'].unique():
+        samples_seq = list(meta['id'][meta['sequence'] == seq])
+        num_groups = 1 + len(samples_seq) // 3000
+        samples_split = np.array_split(samples_seq, num_groups)
+        samples_split = [list(s) for s in samples_split]
+        for s in samples_split:
+            streamName = 'mappingData_variants'
+            streamKeys = f'{seq}'
+            streamValues = {'json': s}
+            publish(streamName, streamKeys, streamValues)
+    return
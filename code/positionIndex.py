@@ -0,0 +1,96 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+positionIndex.py
+Index of the variant positions stored for a chromosome (the 'pos:ref:alt' lists under key chrom_N of
+mappingData_variants). The positions are kept as a sorted int array with matching ref/alt arrays, so membership and range
+lookups are binary searches. One index is built per chromosome per process and reused until mappingData_variants gets
+new items (see resultCache).
+Usage: from positionIndex import loadPositionIndex
+       index = loadPositionIndex(chainName, datadir, chrom, multichainLoc)
+       '12345' in index; index.lookup(12345) -> [(ref, alt)]; index.range(10000, 20000) -> ['pos', ...]
+'''
+
+import numpy as np
+import pandas as pd
+from chainClient import getClient
+from resultCache import cachedQuery
+
+
+class PositionIndex:
+    '''
+    Read-only index of stored positions
+    Input:
+        entries - 'pos:ref:alt' strings in the order they were published
+    '''
+    def __init__(self, entries):
+        split = pd.Series(list(entries), dtype = object).str.split(':', n = 2, expand = True).reindex(columns = range(3))
+        positions = pd.to_numeric(split[0], errors = 'coerce')
+        ##entries whose position is not a number cannot be searched and are left out
+        valid = positions.notna().to_numpy()
+        positions = positions.to_numpy()[valid].astype(np.int64)
+        ##stable so entries for the same position keep their published order
+        order = np.argsort(positions, kind = 'stable')
+        self.positions = positions[order]
+        self.keys = split[0].to_numpy(dtype = object)[valid][order]
+        self.refs = split[1].to_numpy(dtype = object)[valid][order]
+        self.alts = split[2].to_numpy(dtype = object)[valid][order]
+        for array in (self.positions, self.keys, self.refs, self.alts):
+            array.flags.writeable = False
+
+    def __len__(self):
+        return len(self.positions)
+
+    def _bounds(self, start, end):
+        return np.searchsorted(self.positions, start, 'left'), np.searchsorted(self.positions, end, 'right')
+
+    def __contains__(self, pos):
+        try:
+            pos = int(pos)
+        except (TypeError, ValueError):
+            return False
+        lo, hi = self._bounds(pos, pos)
+        return hi > lo
+
+    def lookup(self, pos):
+        '''
+        Output:
+            list of (ref, alt) stored for a position, empty if the position is not stored
+        '''
+        if pos not in self:
+            return []
+        lo, hi = self._bounds(int(pos), int(pos))
+        return list(zip(self.refs[lo:hi], self.alts[lo:hi]))
+
+    def range(self, start, end):
+        '''
+        Output:
+            the stored positions (as strings) in [start, end], in position order
+        '''
+        lo, hi = self._bounds(int(start), int(end))
+        return list(self.keys[lo:hi])
+
+    def positionSet(self):
+        return set(self.keys)
+
+    def records(self):
+        '''
+        Output:
+            list of [pos, ref, alt] for every stored entry (the format of extractAllPosition)
+        '''
+        return [list(record) for record in zip(self.keys, self.refs, self.alts)]
+
+
+##the index is read only so it is shared between callers instead of copied
+@cachedQuery('mappingData_variants', copyResults = False)
+def loadPositionIndex(chainName, datadir, chrom, multichainLoc = ''):
+    '''
+    Build the position index of a chromosome from every chrom_N item of mappingData_variants
+    '''
+    matches = getClient(chainName, datadir, multichainLoc).streamItems('mappingData_variants', 'chrom_{}'.format(chrom), prefetch = True)
+    entries = []
+    for match in matches:
+        ##off-chain chunks are fetched when the data is read
+        entries.extend(match['data']['json'])
+    return PositionIndex(entries)
@@ -0,0 +1,136 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+queryService.py
+Long-running HTTP service for the query scripts. The query modules, the RPC connection pool, the off-chain payload
+cache and the audit log writer are loaded once and shared by every request instead of being rebuilt by a new python
+process for each query. Every endpoint takes the same arguments as the matching command line option (query string or
+JSON body) and returns JSON.
+Usage: $ python queryService.py -cn=<chain name> -dr=<Chain path> -pt=<port>
+       $ QUERY_CHAIN_NAME=<chain name> QUERY_DATADIR=<Chain path> gunicorn -w 4 -b 127.0.0.1:5000 "queryService:createApp()"
+       $ curl "http://127.0.0.1:5000/queryVariants?chromosomes=1&positions=12345&genotypes=1|0"
+'''
+
+import os
+import sys
+import json
+import argparse
+import traceback
+import numpy as np
+import pandas as pd
+from flask import Flask, request, jsonify
+import QueryVariant
+import QueryClinical
+import QueryAnalysis
+from chainClient import getClient
+from resultCache import cacheStats
+from cohortAlgebra import queryCohort
+
+
+class MissingArgument(Exception):
+    pass
+
+
+def toJSON(result):
+    '''
+    Convert a query result (dataframes, JSON strings, stream items, numpy values) into JSON serialisable objects
+    '''
+    if isinstance(result, pd.DataFrame) or isinstance(result, pd.Series):
+        ##orient index matches the command line output, split keeps duplicated indexes
+        return json.loads(result.to_json(orient = 'index' if result.index.is_unique else 'split'))
+    if isinstance(result, str):
+        try:
+            return json.loads(result)
+        except ValueError:
+            return result
+    if isinstance(result, dict):
+        ##indexing (not items()) so stream items fetch their off-chain data
+        return {str(key): toJSON(result[key]) for key in result}
+    if isinstance(result, (list, tuple, set)):
+        return [toJSON(value) for value in result]
+    if isinstance(result, np.generic):
+        return result.item()
+    if isinstance(result, np.ndarray):
+        return result.tolist()
+    return result
+
+
+def createApp(chainName = None, multichainLoc = None, datadir = None):
+    '''
+    Build the Flask app for one chain, defaults are read from QUERY_CHAIN_NAME, QUERY_MULTICHAIN_LOC and QUERY_DATADIR
+    (used by gunicorn)
+    '''
+    chainName = chainName if chainName else os.environ.get('QUERY_CHAIN_NAME', 'chain1')
+    multichainLoc = multichainLoc if multichainLoc is not None else os.environ.get('QUERY_MULTICHAIN_LOC', '')
+    datadir = datadir if datadir else os.environ.get('QUERY_DATADIR')
+    app = Flask(__name__)
+
+    ##subscribed once for the lifetime of the service
+    QueryVariant.subscribeToStream(chainName, multichainLoc, datadir)
+
+    def argument(name, default = MissingArgument):
+        body = request.get_json(silent = True) or {}
+        value = body.get(name, request.args.get(name, default))
+        if value is MissingArgument:
+            raise MissingArgument(name)
+        return value if value is None or isinstance(value, str) else str(value) if not isinstance(value, list) else ','.join(map(str, value))
+
+    def flag(name):
+        return str(argument(name, 'false')).lower() in ('true', '1', 'yes')
+
+    def endpoint(name, query):
+        def run():
+            try:
+                return jsonify(toJSON(query()))
+            except MissingArgument as e:
+                return jsonify({'error': 'missing argument {}'.format(e)}), 400
+            except Exception as e:
+                traceback.print_exc()
+                return jsonify({'error': str(e)}), 500
+        app.add_url_rule('/{}'.format(name), name, run, methods = ['GET', 'POST'])
+
+    def queryVariants():
+        variants_json, variant_annotations = QueryVariant.queryVariants(chainName, multichainLoc, datadir, argument('chromosomes'),
+                                                                        argument('positions'), argument('genotypes', 'all'), argument('metadata', None))
+        return {'variants': variants_json, 'annotations': variant_annotations}
+
+    endpoint('queryVariants', queryVariants)
+    endpoint('queryPersonsChroms', lambda: QueryVariant.queryPersonsChroms(chainName, multichainLoc, datadir, argument('chromosomes'),
+                                                                           argument('person_ids'), argument('positions', 'all')))
+    endpoint('MAFqueries', lambda: QueryVariant.MAFqueries(chainName, multichainLoc, datadir, argument('chromosomes'), argument('inputRange')))
+    endpoint('domainQuery', lambda: QueryClinical.domainQuery(chainName, multichainLoc, datadir, argument('cohortKeys'), argument('searchKeys'),
+                                                              flag('include_descendants')))
+    endpoint('personQuery', lambda: QueryClinical.personQuery(chainName, multichainLoc, datadir, argument('person_ids'), argument('searchKeys')))
+    endpoint('queryCohort', lambda: queryCohort(chainName, multichainLoc, datadir, argument('cohortExpression'), flag('include_descendants')))
+    endpoint('queryKinship', lambda: QueryAnalysis.queryKinship(chainName, datadir, argument('sampleSearch', None)))
+    endpoint('querySamplePCA', lambda: QueryAnalysis.querySamplePCA(chainName, datadir, argument('sampleSearch', None), argument('kSearch', '20')))
+
+    def cacheCounters():
+        payloads = getClient(chainName, datadir, multichainLoc).payloads
+        return {'results': cacheStats(), 'payloads': {'hits': payloads.hits, 'misses': payloads.misses, 'entries': len(payloads.cache)}}
+
+    ##hit/miss counters of this worker's caches, for sizing QUERY_CACHE_SIZE and MULTICHAIN_PAYLOAD_CACHE_SIZE
+    endpoint('cacheStats', cacheCounters)
+    return app
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("-cn", "--chainName", help = "the name of the chain to query", default = "chain1")
+    parser.add_argument("-ml", "--multichainLoc", help = "path to multichain commands", default = "")
+    parser.add_argument("-dr", "--datadir", help = "path where the chain is stored")
+    parser.add_argument("-ho", "--host", help = "address to listen on", default = "127.0.0.1")
+    parser.add_argument("-pt", "--port", type = int, help = "port to listen on", default = 5000)
+    args = parser.parse_args()
+    try:
+        app = createApp(args.chainName, args.multichainLoc, args.datadir)
+        app.run(host = args.host, port = args.port, threaded = True)
+    except Exception as e:
+        print(e)
+        sys.stderr.write("\nERROR: Failed to start the query service. Please try again.\n")
+        quit()
+
+
+if __name__ == "__main__":
+    main()
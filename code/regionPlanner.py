@@ -0,0 +1,234 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+regionPlanner.py
+Split a bgzipped VCF into regions holding roughly the same number of records so that bcftools -r queries load a
+bounded amount of data at a time. Regions are planned from the .tbi/.csi index when there is one (no decompression
+of the VCF), otherwise from a single streaming pass over the record positions.
+Usage: from regionPlanner import planRegions, readRegion
+       contig, pos_regions = planRegions(variantFile)
+       for pos_region in pos_regions.values(): df = readRegion(variantFile, contig, pos_region, samples)
+'''
+
+import os
+import gzip
+import math
+import struct
+import tempfile
+import subprocess
+import numpy as np
+import pandas as pd
+from io import BytesIO
+
+
+# target number of records per region, the whole chromosome is covered whatever its size
+REGION_RECORDS = int(os.environ.get('REGION_RECORDS', 20000))
+
+
+def _readBinningIndex(f, nRef, csi):
+    '''
+    Read the per-contig bins of a tabix/csi index
+    Output:
+        list (one per contig) of {bin: [(chunk_begin, chunk_end), ...]} with virtual file offsets
+    '''
+    refs = []
+    for _ in range(nRef):
+        bins = {}
+        nBin, = struct.unpack('<i', f.read(4))
+        for _ in range(nBin):
+            if csi:
+                binId, _, nChunk = struct.unpack('<IQi', f.read(16))
+            else:
+                binId, nChunk = struct.unpack('<Ii', f.read(8))
+            chunks = struct.unpack('<{}Q'.format(2 * nChunk), f.read(16 * nChunk))
+            bins[binId] = list(zip(chunks[::2], chunks[1::2]))
+        if not csi:
+            ##linear index, not needed as the leaf bins give the same information
+            nIntv, = struct.unpack('<i', f.read(4))
+            f.read(8 * nIntv)
+        refs.append(bins)
+    return refs
+
+
+def readIndex(variantFile):
+    '''
+    Parse the .tbi or .csi index of a bgzipped VCF
+    Input:
+        variantFile - path of the VCF, the index is expected next to it
+    Output:
+        dictionary of contig: {'records': number of records, 'windows': [(start, end, bytes), ...], 'end': last coordinate}
+        windows are the leaf bins holding data (1-based inclusive coordinates) and bytes the compressed data they hold
+        or None if there is no usable index
+    '''
+    for suffix in ['.tbi', '.csi']:
+        if os.path.exists(variantFile + suffix):
+            indexFile = variantFile + suffix
+            break
+    else:
+        return None
+
+    with gzip.open(indexFile, 'rb') as f:
+        magic = f.read(4)
+        if magic == b'TBI\x01':
+            minShift, depth, csi = 14, 5, False
+            nRef, = struct.unpack('<i', f.read(4))
+            meta = f.read(28)
+        elif magic == b'CSI\x01':
+            minShift, depth, lAux = struct.unpack('<iii', f.read(12))
+            csi = True
+            meta = f.read(lAux)
+            nRef, = struct.unpack('<i', f.read(4))
+        else:
+            return None
+        ##contig names are stored after the tabix configuration (absent for BCF csi indexes)
+        if len(meta) < 28:
+            return None
+        lNm, = struct.unpack('<i', meta[24:28])
+        names = (meta[28:28 + lNm] if csi else f.read(lNm)).split(b'\x00')[:nRef]
+        refs = _readBinningIndex(f, nRef, csi)
+
+    leafOffset = ((1 << (3 * depth)) - 1) // 7
+    pseudoBin = ((1 << (3 * (depth + 1))) - 1) // 7 + 1
+    contigs = {}
+    for name, bins in zip(names, refs):
+        ##the pseudo bin holds (virtual start, virtual end), (mapped records, unmapped records)
+        if pseudoBin not in bins or len(bins[pseudoBin]) < 2:
+            return None
+        records = bins[pseudoBin][1][0]
+        windows, end = [], 0
+        for binId in sorted(b for b in bins if b != pseudoBin):
+            ##level of the bin determines its span
+            level, offset = 0, 0
+            while binId >= offset + (1 << (3 * level)):
+                offset += 1 << (3 * level)
+                level += 1
+            shift = minShift + 3 * (depth - level)
+            binStart = (binId - offset) << shift
+            end = max(end, binStart + (1 << shift))
+            if binId >= leafOffset:
+                size = sum(max(1, (chunkEnd >> 16) - (chunkStart >> 16)) for chunkStart, chunkEnd in bins[binId])
+                windows.append((binStart + 1, binStart + (1 << shift), size))
+        contigs[name.decode('utf-8')] = {'records': records, 'windows': windows, 'end': end}
+    return contigs
+
+
+def streamPositions(variantFile, contig = None):
+    '''
+    Read the position of every record with one streaming pass of bcftools (no genotypes are decoded)
+    Input:
+        variantFile - path of the VCF
+        contig - only keep this contig, defaults to the one with the most records
+    Output:
+        contig name, sorted numpy array of positions
+    Raises subprocess.CalledProcessError (with bcftools' stderr) if the VCF could not be read, so an unreadable file is
+    never planned as one without records
+    '''
+    command = ['bcftools', 'query', '-f', '%CHROM\t%POS\n', variantFile]
+    ##stderr goes to a temporary file so a verbose bcftools can not block on a full pipe while stdout is read
+    with tempfile.TemporaryFile() as errors:
+        process = subprocess.Popen(command, stdout = subprocess.PIPE, stderr = errors)
+        positions = {}
+        try:
+            for chunk in pd.read_csv(process.stdout, sep = '\t', names = ['chrom', 'pos'], dtype = {'chrom': str, 'pos': np.int64},
+                                     chunksize = 1000000):
+                for name, group in chunk.groupby('chrom', sort = False):
+                    positions.setdefault(name, []).append(group['pos'].to_numpy())
+        finally:
+            process.stdout.close()
+            returncode = process.wait()
+        if returncode != 0:
+            errors.seek(0)
+            raise subprocess.CalledProcessError(returncode, command, stderr = errors.read().decode('utf-8', 'replace'))
+    if not positions:
+        return contig, np.array([], dtype = np.int64)
+    if contig is None:
+        contig = max(positions, key = lambda name: sum(len(p) for p in positions[name]))
+    return contig, np.sort(np.concatenate(positions.get(contig, [np.array([], dtype = np.int64)])), kind = 'stable')
+
+
+def _splitWindows(windows, end, numRegions):
+    '''
+    Cut the index windows into numRegions groups of roughly equal compressed size
+    '''
+    sizes = np.array([w[2] for w in windows], dtype = np.float64)
+    cumulative = np.cumsum(sizes)
+    targets = cumulative[-1] * np.arange(1, numRegions) / numRegions
+    cuts = sorted(set(np.searchsorted(cumulative, targets).tolist()) - {len(windows) - 1})
+    ##the first and last region are left open so records outside the leaf bins (e.g. long SVs) are still covered
+    starts = [1] + [windows[c][1] + 1 for c in cuts]
+    ends = [windows[c][1] for c in cuts] + [end]
+    return starts, ends
+
+
+def _splitPositions(positions, numRegions):
+    '''
+    Cut a sorted array of positions into numRegions groups with roughly the same number of records
+    Records sharing a position always stay in the same region
+    '''
+    cuts = positions[(len(positions) * np.arange(1, numRegions)) // numRegions]
+    cuts = sorted(set(cuts[cuts > positions[0]].tolist()))
+    starts = [int(positions[0])] + cuts
+    ends = [c - 1 for c in cuts] + [int(positions[-1])]
+    return starts, ends
+
+
+def planRegions(variantFile, recordsPerRegion = None, contig = None):
+    '''
+    Plan the bcftools regions for a VCF file so that the whole contig is covered and every region holds about
+    recordsPerRegion records. Regions do not overlap, but bcftools -r also returns records that start before a region
+    and overlap it, so callers should drop records whose position is before the region start
+    Input:
+        variantFile - path of the bgzipped VCF
+        recordsPerRegion - target number of records per region, defaults to REGION_RECORDS
+        contig - contig to plan, defaults to the one with the most records
+    Output:
+        contig name, dictionary of region number: [start, end]
+    '''
+    recordsPerRegion = recordsPerRegion if recordsPerRegion else REGION_RECORDS
+    index = readIndex(variantFile)
+    if index:
+        if contig is None:
+            contig = max(index, key = lambda name: index[name]['records'])
+        if contig in index and index[contig]['windows']:
+            numRegions = max(1, math.ceil(index[contig]['records'] / recordsPerRegion))
+            starts, ends = _splitWindows(index[contig]['windows'], index[contig]['end'], numRegions)
+            return contig, {i: [start, end] for i, (start, end) in enumerate(zip(starts, ends))}
+
+    ##no index: one pass over the positions
+    contig, positions = streamPositions(variantFile, contig)
+    if len(positions) == 0:
+        return contig, {}
+    numRegions = max(1, math.ceil(len(positions) / recordsPerRegion))
+    starts, ends = _splitPositions(positions, numRegions)
+    return contig, {i: [start, end] for i, (start, end) in enumerate(zip(starts, ends))}
+
+
+def readRegion(variantFile, contig, pos_region, samples, sampleChunk = 1000):
+    '''
+    Read the genotype matrix of one region, samples are requested from bcftools in chunks of sampleChunk
+    Records that start before the region (returned by bcftools because they overlap it) are dropped
+    Input:
+        variantFile - path of the bgzipped VCF
+        contig - contig of the region
+        pos_region - [start, end] of the region
+        samples - sample ids to read
+    Output:
+        dataframe indexed by position with ref, alt and one GT column per sample
+    '''
+    samples = list(samples)
+    df = None
+    for i in range(0, len(samples), sampleChunk):
+        sample_chunk = samples[i:i + sampleChunk]
+        colnames = ['pos', 'ref', 'alt'] + sample_chunk
+        sample_list = ','.join(map(str, sample_chunk))
+        request = f'bcftools query -r {contig}:{pos_region[0]}-{pos_region[1]} -f \'%POS %REF %ALT [ %GT]\n\' -s "{sample_list}" {variantFile}'
+        output = subprocess.check_output(request, shell = True)
+        df_partial = pd.read_csv(BytesIO(output), sep = r'\s+', names = colnames, index_col = 'pos')
+        ##bcftools also returns records that start in the previous region and overlap this one
+        df_partial = df_partial[df_partial.index >= int(pos_region[0])]
+        if df is None:
+            df = df_partial
+        else:
+            df = pd.concat([df, df_partial.drop(['ref', 'alt'], axis = 1)], axis = 1)
+    return df
@@ -0,0 +1,167 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+resultCache.py
+In-process cache of query results. Streams are append-only, so a query over a set of streams returns the same answer
+until one of them gets new items. Results are stored under (function, arguments) together with the item counts of the
+streams they were read from (liststreams) and are dropped as soon as one of those streams has grown.
+Usage: from resultCache import cachedQuery, streamSnapshot, cacheStats
+       @cachedQuery('mappingData_variants')          stream names may use the arguments e.g. 'chrom_{chrom}'
+       def extractVariantsStored(chainName, datadir, chrom): ...
+       items = streamSnapshot(chainName, datadir, 'analysis', 'PCA')
+       cacheStats()  -> {'hits': .., 'misses': .., 'invalidations': .., 'entries': ..}
+'''
+
+import os
+import copy
+import json
+import inspect
+import functools
+import threading
+import subprocess
+import pandas as pd
+from collections import OrderedDict
+from chainClient import getClient, MultichainError
+
+
+# results kept per process (least recently used are dropped first), 0 turns the cache off
+CACHE_SIZE = int(os.environ.get('QUERY_CACHE_SIZE', 256))
+
+
+class ResultCache:
+    '''
+    Bounded LRU of query results, each tagged with the stream item counts it was computed from
+    Input:
+        cacheSize - number of results kept, defaults to QUERY_CACHE_SIZE
+    '''
+    def __init__(self, cacheSize = None):
+        self.cacheSize = cacheSize if cacheSize is not None else CACHE_SIZE
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits, self.misses, self.invalidations = 0, 0, 0
+
+    def lookup(self, key, tags):
+        '''
+        Output:
+            (True, result) if the key is cached and its streams still have the same item counts, (False, None) otherwise
+        '''
+        with self.lock:
+            if key in self.entries:
+                cachedTags, result = self.entries[key]
+                if cachedTags == tags:
+                    self.entries.move_to_end(key)
+                    self.hits += 1
+                    return True, result
+                ##a stream has new items since the result was computed
+                del self.entries[key]
+                self.invalidations += 1
+            self.misses += 1
+        return False, None
+
+    def store(self, key, tags, result):
+        if self.cacheSize <= 0:
+            return
+        with self.lock:
+            self.entries[key] = (tags, result)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.cacheSize:
+                self.entries.popitem(last = False)
+        return
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'invalidations': self.invalidations, 'entries': len(self.entries)}
+
+
+_caches = {}
+
+def getCache():
+    '''
+    Return the result cache of this process (not shared across multiprocessing forks)
+    '''
+    if os.getpid() not in _caches:
+        _caches[os.getpid()] = ResultCache()
+    return _caches[os.getpid()]
+
+
+def cacheStats():
+    return getCache().stats()
+
+
+def streamCounts(chainName, datadir, multichainLoc, streamNames):
+    '''
+    Number of items in each stream, or None if they could not be read (the query then runs uncached)
+    '''
+    try:
+        streams = getClient(chainName, datadir, multichainLoc).call('liststreams', streamNames)
+    except (MultichainError, subprocess.CalledProcessError):
+        return None
+    counts = {stream['name']: int(stream.get('items', 0)) for stream in streams}
+    return tuple(counts.get(name) for name in streamNames)
+
+
+def copyResult(result):
+    '''
+    Copy of a cached result so callers can modify what they get back, immutable values are returned as they are
+    '''
+    if result is None or isinstance(result, (str, bytes, int, float, frozenset)):
+        return result
+    if isinstance(result, tuple):
+        return tuple(copyResult(value) for value in result)
+    if isinstance(result, (pd.DataFrame, pd.Series)):
+        return result.copy()
+    return copy.deepcopy(result)
+
+
+def cachedQuery(*streams, copyResults = True):
+    '''
+    Decorator caching the results of a query function that only reads the given streams. The function must take
+    chainName and datadir (and optionally multichainLoc) arguments
+    Input:
+        streams - names of the streams read, formatted with the function arguments e.g. 'chrom_{chrom}'
+        copyResults - return a copy of the cached result, False for results that are never modified
+    '''
+    def decorator(function):
+        signature = inspect.signature(function)
+        name = '{}.{}'.format(function.__module__, function.__qualname__)
+
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            bound = signature.bind(*args, **kwargs)
+            bound.apply_defaults()
+            arguments = bound.arguments
+            cache = getCache()
+            if cache.cacheSize <= 0:
+                return function(*args, **kwargs)
+            ##positional and keyword calls with the same values share an entry
+            key = (name, json.dumps(arguments, sort_keys = True, default = str))
+            ##counts are read before running the query, if a stream grows meanwhile the next call recomputes
+            tags = streamCounts(arguments['chainName'], arguments['datadir'], arguments.get('multichainLoc') or '',
+                                [stream.format(**arguments) for stream in streams])
+            if tags is None:
+                return function(*args, **kwargs)
+            found, result = cache.lookup(key, tags)
+            if not found:
+                result = function(*args, **kwargs)
+                cache.store(key, tags, result)
+            return copyResult(result) if copyResults else result
+
+        wrapper.uncached = function
+        return wrapper
+    return decorator
+
+
+@cachedQuery('{streamName}')
+def streamSnapshot(chainName, datadir, streamName, key = None, multichainLoc = ''):
+    '''
+    Every item of a stream (or of one key in it) with the off-chain data already fetched
+    Output:
+        list of dictionaries with keys, data and txid
+    '''
+    matches = getClient(chainName, datadir, multichainLoc).streamItems(streamName, key, prefetch = True)
+    return [{'keys': match['keys'], 'data': match['data'], 'txid': match.get('txid')} for match in matches]
@@ -0,0 +1,142 @@
+#!/usr/bin/env python
+# coding: utf-8
+
+'''
+tableCache.py
+Load-once cache of the CSV tables read by the OMOP domain scripts (data tables and the vocabulary hierarchy). A table is
+parsed once per process and kept in memory; the parsed columns are also saved as .npy files (one per column, strings
+as their UTF-8 bytes with an offsets array and a null mask) keyed by the CSV's mtime and size, so later runs, the other
+processes of a run and createStream load the columns instead of parsing the CSV again. A changed CSV is parsed again and
+its cache rewritten.
+By default the cache is written into the data directory itself, in a .table_cache directory next to each CSV, and takes
+about as much space as the CSVs. Set TABLE_CACHE_DIR to write it elsewhere (e.g. when the data directory is shared or
+read-only, in which case the tables are only kept in memory).
+Usage: from tableCache import readTable
+       df = readTable(dataPath + 'condition_occurrence.csv')
+       df = readTable(hierarchyPath, sep = '|')
+'''
+
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+
+# cache format, caches written by another version are parsed again
+CACHE_FORMAT = 2
+META_FILE = 'meta.json'
+
+_tables = {}
+
+
+def cacheDir(path):
+    '''
+    Directory of a table's column cache, .table_cache/<file name> next to the CSV unless TABLE_CACHE_DIR is set
+    '''
+    path = os.path.abspath(path)
+    if os.environ.get('TABLE_CACHE_DIR'):
+        name = '{}-{}'.format(os.path.basename(path), hashlib.sha1(path.encode()).hexdigest()[:12])
+        return os.path.join(os.environ['TABLE_CACHE_DIR'], name)
+    return os.path.join(os.path.dirname(path), '.table_cache', os.path.basename(path))
+
+
+def fileVersion(path):
+    stat = os.stat(path)
+    return {'mtime': stat.st_mtime, 'size': stat.st_size}
+
+
+def saveColumns(df, outputDir, version, sep):
+    '''
+    Save the columns of a parsed table, written to a temporary directory that replaces the old cache when complete
+    '''
+    tmpDir = '{}.tmp-{}'.format(outputDir, os.getpid())
+    shutil.rmtree(tmpDir, ignore_errors = True)
+    os.makedirs(tmpDir)
+    columns = []
+    for i, column in enumerate(df.columns):
+        series = df[column]
+        if pd.api.types.is_numeric_dtype(series) or pd.api.types.is_bool_dtype(series):
+            np.save(os.path.join(tmpDir, '{}.npy'.format(i)), series.to_numpy())
+            columns.append({'name': column, 'dtype': str(series.dtype), 'kind': 'values'})
+        else:
+            ##strings as their concatenated UTF-8 bytes, the offset of each value and a mask of the missing values, so
+            ##nothing is pickled and a single long value does not widen every row as a fixed width array would
+            missing = series.isna().to_numpy()
+            encoded = [value.encode('utf-8') for value in series.fillna('').astype(str)]
+            offsets = np.zeros(len(encoded) + 1, dtype = np.int64)
+            np.cumsum([len(value) for value in encoded], out = offsets[1:])
+            np.save(os.path.join(tmpDir, '{}.npy'.format(i)), np.frombuffer(b''.join(encoded), dtype = np.uint8))
+            np.save(os.path.join(tmpDir, '{}.offsets.npy'.format(i)), offsets)
+            np.save(os.path.join(tmpDir, '{}.mask.npy'.format(i)), missing)
+            columns.append({'name': column, 'dtype': str(series.dtype), 'kind': 'strings'})
+    with open(os.path.join(tmpDir, META_FILE), 'w') as f:
+        json.dump({'format': CACHE_FORMAT, 'sep': sep, 'rows': len(df), 'columns': columns, **version}, f)
+    shutil.rmtree(outputDir, ignore_errors = True)
+    os.replace(tmpDir, outputDir)
+    return
+
+
+def loadColumns(outputDir, version, sep):
+    '''
+    Load a cached table
+    Output:
+        DataFrame, or None if there is no cache for this version of the CSV
+    '''
+    try:
+        with open(os.path.join(outputDir, META_FILE)) as f:
+            meta = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if meta.get('format') != CACHE_FORMAT or meta.get('sep') != sep or meta.get('mtime') != version['mtime'] or meta.get('size') != version['size']:
+        return None
+    data = {}
+    for i, column in enumerate(meta['columns']):
+        values = np.load(os.path.join(outputDir, '{}.npy'.format(i)))
+        if column['kind'] == 'strings':
+            buffer = values.tobytes()
+            offsets = np.load(os.path.join(outputDir, '{}.offsets.npy'.format(i))).tolist()
+            values = np.empty(len(offsets) - 1, dtype = object)
+            values[:] = [buffer[start:end].decode('utf-8') for start, end in zip(offsets[:-1], offsets[1:])]
+            values[np.load(os.path.join(outputDir, '{}.mask.npy'.format(i)))] = np.nan
+            data[column['name']] = pd.Series(values, dtype = object).astype(column['dtype'])
+        else:
+            data[column['name']] = pd.Series(values, dtype = column['dtype'])
+    return pd.DataFrame(data, columns = [column['name'] for column in meta['columns']])
+
+
+def readTable(path, sep = ','):
+    '''
+    Read a CSV table, parsing it only if neither this process nor the column cache has the current version of the file
+    Input:
+        path - path of the CSV file
+        sep - field separator
+    Output:
+        DataFrame as pd.read_csv(path, sep = sep) returns it, a copy the caller can modify
+    '''
+    key = (os.path.abspath(path), sep)
+    version = fileVersion(path)
+    if key not in _tables or _tables[key][0] != version:
+        outputDir = cacheDir(path)
+        try:
+            df = loadColumns(outputDir, version, sep)
+        except (OSError, ValueError, KeyError):
+            ##a cache being rewritten by another process, parse the file instead
+            df = None
+        if df is None:
+            df = pd.read_csv(path, sep = sep)
+            try:
+                saveColumns(df, outputDir, version, sep)
+            except OSError:
+                ##e.g. a read-only data directory, the table is still kept for this process
+                pass
+        _tables[key] = (version, df)
+    return _tables[key][1].copy()
+
+
+def clearTables():
+    '''
+    Drop the tables kept in memory (the column caches on disk are kept)
+    '''
+    _tables.clear()
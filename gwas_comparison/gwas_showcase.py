@@ -208,6 +208,7 @@ from QueryParse import (
                         getPCs,
                         getAgeGenderRace,
                         getPhenotype,
+                        getCohort,
                         getVariantDF2,
                         runGwas2
                           )
@@ -229,45 +230,16 @@ demos = getAgeGenderRace(chainName, multichainLoc, datadir)
 demos = demos[demos['race_concept_id'] == '8527']
 
 # #### Phenotype of interest
-## INCLUSION ##
-#DM diagnosis
-dm_cond = '201820'
-dm_id_cond =  getPhenotype(dm_cond)
-
-#DM medication
-dm_drug = '21600744'
-dm_id_drug=  getPhenotype(dm_drug)
-
-#DM self reprot
-dm_self = '123456789'
-dm_id_self=  getPhenotype(dm_self)
-
-## EXCLUSION ##
-# Gestational DM
-gest_dm_cond = '4024659'
-gest_dm_id_cond =  getPhenotype(gest_dm_cond)
-
-# Metformin
-dm_drug_met = '21600745'
-dm_id_met=  getPhenotype(dm_drug_met)
-
-## CADD PHENOTYPE ##
-# CADD diagnosis
-cadd_cond = '317576'
-cadd_id_cond =  getPhenotype(cadd_cond)
-
-# CADD Procedure
-cadd_proc = '4336464'
-cadd_id_proc =  getPhenotype(cadd_proc)
-
-#CADD self report
-cadd_self = '23456789'
-cadd_id_self=  getPhenotype(cadd_self)
-
-# Phenotyping logic
-all_dm_ids = list(set(list(dm_id_drug['person_id']) + list(dm_id_cond['person_id']) + list(dm_id_self['person_id'])) - set(list(gest_dm_id_cond['person_id']) + list(dm_id_met['person_id'])))
-all_cadd_ids = list(set(list(cadd_id_cond['person_id']) + list(cadd_id_proc['person_id']) + list(cadd_id_self['person_id'])))
-only_dm_ids = list(set(all_dm_ids) - set(all_cadd_ids))
+# Inclusion: DM diagnosis (201820), DM medication (21600744), DM self report (123456789)
+# Exclusion: gestational DM (4024659), metformin (21600745)
+dm_cohort = '(201820 OR 21600744 OR 123456789) AND NOT (4024659 OR 21600745)'
+# CADD: diagnosis (317576), procedure (4336464), self report (23456789)
+cadd_cohort = '317576 OR 4336464 OR 23456789'
+
+# Phenotyping logic, the concept cohorts are combined as person id bitmaps
+all_dm_ids = getCohort(dm_cohort)
+all_cadd_ids = getCohort(cadd_cohort)
+only_dm_ids = getCohort(f'({dm_cohort}) AND NOT ({cadd_cohort})')
 phenotype = pd.DataFrame(all_dm_ids, columns=['eid']) 
 phenotype['phenotype'] = np.where(phenotype['eid'].isin(all_cadd_ids), 2, 1)
 phenos = phenotype.set_index('eid')